@@ -0,0 +1,19 @@
+"""
+Benchmarks for ingest, rule evaluation and the /api/resources endpoint.
+
+    python -m benchmarks.run --size 100000 --out before.json
+    python -m benchmarks.run --size 100000 --out after.json
+    python -m benchmarks.compare before.json after.json
+"""
+
+import os
+import sys
+
+# Same flat imports as the cloud_scanner package itself. Inserted first so the
+# package's decorator module wins over any installed 'decorator' distribution.
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "cloud_scanner"
+    ),
+)
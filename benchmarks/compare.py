@@ -0,0 +1,90 @@
+"""
+compare.py
+
+Diff two benchmarks.run result files and flag regressions.
+
+Timings are compared on their median (or seconds, for ingest) and memory
+on its bytes per finding; a metric regresses when the new run is slower, or
+holds more memory, than the old one by more than the threshold. Exits with status 1 if anything regressed.
+
+    python -m benchmarks.compare before.json after.json --threshold 0.1
+"""
+
+import argparse
+import json
+import sys
+from typing import List
+
+
+def metric_value(result: dict) -> float:
+    for key in ("median", "seconds", "bytes_per_finding"):
+        if key in result:
+            return result[key]
+
+
+def compare(old: dict, new: dict, threshold: float) -> List[dict]:
+    """
+    Compare every metric present in both reports.
+
+    returns:
+        list of {size, metric, old, new, change, regression}
+    """
+    rows = []
+    for size, new_run in new["sizes"].items():
+        old_run = old["sizes"].get(size)
+        if old_run is None:
+            continue
+        for metric, new_result in new_run["results"].items():
+            old_result = old_run["results"].get(metric)
+            if old_result is None:
+                continue
+            before, after = metric_value(old_result), metric_value(new_result)
+            change = (after - before) / before if before else 0.0
+            rows.append(
+                {
+                    "size": size,
+                    "metric": metric,
+                    "old": before,
+                    "new": after,
+                    "change": round(change, 4),
+                    "regression": change > threshold,
+                }
+            )
+    return rows
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Compare two benchmark runs.")
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative slowdown counted as a regression (default: 0.1).",
+    )
+    parser.add_argument("--json", action="store_true", help="Print the diff as JSON.")
+    args = parser.parse_args(argv)
+
+    with open(args.old) as fp:
+        old = json.load(fp)
+    with open(args.new) as fp:
+        new = json.load(fp)
+
+    rows = compare(old, new, args.threshold)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        for row in rows:
+            flag = "REGRESSION" if row["regression"] else ""
+            unit = "B" if row["metric"].startswith("memory.") else "s"
+            print(
+                f"{row['size']:>8} {row['metric']:<28} {row['old']:>10.4f}{unit} "
+                f"{row['new']:>10.4f}{unit} {row['change']:>+8.1%} {flag}"
+            )
+    if any(row["regression"] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
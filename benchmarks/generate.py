@@ -0,0 +1,164 @@
+"""
+generate.py
+
+Seeded generator of synthetic inventories in the /upload JSON format.
+
+Resources are written one at a time, so a 1M resource inventory never has to
+fit in memory. The same seed, size and violation rate always produce the same
+file.
+
+    python -m benchmarks.generate --size 1000000 --seed 7 --violation-rate 0.2 -o inventory.json
+"""
+
+import argparse
+import datetime
+import json
+import random
+from typing import IO, Iterator
+
+SIZES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+
+ENGINES = {
+    "postgres": 5432,
+    "mysql": 3306,
+    "mariadb": 3306,
+    "sqlserver-se": 1433,
+    "oracle-ee": 1521,
+}
+INSTANCE_CLASSES = ("db.t3.micro", "db.t3.medium", "db.m5.large", "db.r6g.xlarge")
+SAFE_PORTS = ((80, 80), (443, 443), (8080, 8090), (5432, 5432))
+ADMIN_PORTS = ((22, 22), (3389, 3389), (0, 65535))
+PRIVATE_CIDRS = ("10.0.0.0/16", "10.1.2.0/24", "172.16.0.0/12", "192.168.0.0/24")
+WIDE_CIDRS = ("0.0.0.0/0", "10.0.0.0/8")
+
+
+def _ip(rng: random.Random, private: bool) -> str:
+    if private:
+        return f"10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}"
+    return f"{rng.randrange(1, 224)}.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}"
+
+
+def _date(rng: random.Random) -> str:
+    start = datetime.datetime(2015, 1, 1)
+    return (start + datetime.timedelta(seconds=rng.randrange(300_000_000))).isoformat()
+
+
+def ec2_instances(count: int, rng: random.Random, rate: float) -> Iterator[dict]:
+    for i in range(count):
+        permissions = []
+        for _ in range(rng.randrange(4)):
+            from_port, to_port = rng.choice(SAFE_PORTS)
+            permissions.append(
+                {
+                    "IpProtocol": "tcp",
+                    "FromPort": from_port,
+                    "ToPort": to_port,
+                    "IpRanges": [{"CidrIp": rng.choice(PRIVATE_CIDRS)}],
+                }
+            )
+        if rng.random() < rate:
+            from_port, to_port = rng.choice(ADMIN_PORTS)
+            permission = {
+                "IpProtocol": "tcp",
+                "FromPort": from_port,
+                "ToPort": to_port,
+                "IpRanges": [{"CidrIp": rng.choice(WIDE_CIDRS)}],
+            }
+            if rng.random() < 0.25:
+                permission["Ipv6Ranges"] = [{"CidrIpv6": "::/0"}]
+            permissions.append(permission)
+        yield {
+            "GroupId": f"sg-{i:017x}",
+            "GroupName": f"group-{i}",
+            "IpPermissions": permissions,
+            "Description": f"Synthetic security group {i}",
+            "PublicIp": _ip(rng, False) if rng.random() < rate else None,
+            "PrivateIp": _ip(rng, True),
+        }
+
+
+def s3_buckets(count: int, rng: random.Random, rate: float) -> Iterator[dict]:
+    for i in range(count):
+        yield {
+            "Name": f"bucket-{i}",
+            "CreationDate": _date(rng),
+            "PublicAccess": rng.random() < rate,
+            "Encrypted": rng.random() >= rate,
+            "LoggingEnabled": rng.random() >= rate,
+        }
+
+
+def rds_instances(count: int, rng: random.Random, rate: float) -> Iterator[dict]:
+    for i in range(count):
+        engine = rng.choice(list(ENGINES))
+        public = rng.random() < rate
+        yield {
+            "DBInstanceIdentifier": f"db-{i}",
+            "DBInstanceClass": rng.choice(INSTANCE_CLASSES),
+            "Engine": engine,
+            "PubliclyAccessible": public,
+            "StorageEncrypted": rng.random() >= rate,
+            "DBPortNumber": ENGINES[engine],
+            "PublicIp": _ip(rng, False) if public else None,
+            "PrivateIp": _ip(rng, True),
+        }
+
+
+def write_inventory(
+    fp: IO, size: int, seed: int = 0, violation_rate: float = 0.2
+) -> dict:
+    """
+    Write an inventory of size resources, split evenly over EC2, S3 and RDS.
+
+    fp: Text file object to write to
+    size: Total number of resources
+    seed: Random seed
+    violation_rate: Probability of each violating attribute being set
+
+    returns:
+        dict of the number of resources written per type
+    """
+    rng = random.Random(seed)
+    counts = {
+        "EC2Instances": size // 3 + (size % 3 > 0),
+        "S3Buckets": size // 3 + (size % 3 > 1),
+        "RDSInstances": size // 3,
+    }
+    generators = {
+        "EC2Instances": ec2_instances,
+        "S3Buckets": s3_buckets,
+        "RDSInstances": rds_instances,
+    }
+
+    fp.write("{")
+    for n, (key, generator) in enumerate(generators.items()):
+        fp.write(f'{"," if n else ""}"{key}": [')
+        for i, item in enumerate(generator(counts[key], rng, violation_rate)):
+            if i:
+                fp.write(",")
+            fp.write(json.dumps(item))
+        fp.write("]")
+    fp.write("}")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic inventory.")
+    parser.add_argument(
+        "--size",
+        type=lambda value: SIZES.get(value.lower()) or int(value),
+        default=SIZES["10k"],
+        help="Total resources: 10k, 100k, 1m or a number.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--violation-rate", type=float, default=0.2)
+    parser.add_argument("-o", "--output", required=True)
+    args = parser.parse_args()
+
+    with open(args.output, "w") as fp:
+        counts = write_inventory(fp, args.size, args.seed, args.violation_rate)
+    print(json.dumps(counts))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+run.py
+
+Times ingest, each rule check and the /api/resources endpoint against a
+synthetic inventory, measures the memory held by the findings of each check,
+and writes the results as JSON for benchmarks.compare.
+
+Every size runs in its own temporary directory, so the data.db of the working
+directory is never touched.
+
+    python -m benchmarks.run --size 10k 100k --repeat 5 --out results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, List
+
+from benchmarks.generate import SIZES, write_inventory
+
+
+def timed(func: Callable, repeat: int, setup: Callable = None) -> dict:
+    """
+    Run func repeat times and summarize the wall-clock durations in seconds.
+    """
+    durations = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return {
+        "min": round(min(durations), 6),
+        "median": round(statistics.median(durations), 6),
+        "max": round(max(durations), 6),
+        "runs": repeat,
+    }
+
+
+def retained(func: Callable) -> dict:
+    """
+    Bytes allocated by func that are still held by its result, per finding,
+    both for the Finding records and for their JSON-ready dicts.
+    """
+    from rule_runner import to_dicts
+
+    tracemalloc.start()
+    try:
+        found = func()
+        records = tracemalloc.get_traced_memory()[0]
+        dicts = to_dicts(found)
+        total = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    count = max(len(found), 1)
+    return {
+        "findings": len(found),
+        "bytes_per_finding": round(records / count, 1),
+        "dict_bytes_per_finding": round((total - records) / count, 1),
+    }
+
+
+def run_size(size: int, seed: int, violation_rate: float, repeat: int) -> dict:
+    """
+    Benchmark one inventory size.
+    """
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            return _run_size(size, seed, violation_rate, repeat)
+        finally:
+            os.chdir(cwd)
+
+
+def _run_size(size: int, seed: int, violation_rate: float, repeat: int) -> dict:
+    import database_ops as db
+    import findings
+    import ingest
+    import rule_runner
+
+    with open("inventory.json", "w") as fp:
+        counts = write_inventory(fp, size, seed, violation_rate)
+
+    db.setup_database()
+    findings.setup_findings()
+
+    results = {}
+    for name in ("ingest", "reingest"):
+        with open("inventory.json", "rb") as fp:
+            stats = ingest.stream_ingest(fp)
+        results[name] = {
+            "seconds": stats["seconds"],
+            "rows_per_sec": stats["rows_per_sec"],
+        }
+
+    checks = {
+        "s3": rule_runner.s3_rule_check,
+        "ec2": rule_runner.ec2_instance_check,
+        "rds": rule_runner.rds_rule_check,
+    }
+    for resource_type, check in checks.items():
+        results[f"rule_check.{resource_type}"] = timed(check, repeat)
+        results[f"findings_check.{resource_type}"] = timed(
+            lambda: findings.findings_check(resource_type), repeat
+        )
+        results[f"findings_check.{resource_type}.top10"] = timed(
+            lambda: findings.findings_check(resource_type, top=10), repeat
+        )
+        results[f"memory.findings_check.{resource_type}"] = retained(
+            lambda: findings.findings_check(resource_type)
+        )
+        results[f"memory.rule_check.{resource_type}"] = retained(check)
+
+    from app import app
+    from result_cache import results as result_cache
+
+    client = app.test_client()
+    for resource_type in checks:
+        payload = {"type": resource_type, "min_score": 1}
+        response = client.post("/api/resources", json=payload)
+        results[f"api.{resource_type}.cold"] = timed(
+            lambda: client.post("/api/resources", json=payload),
+            repeat,
+            setup=result_cache.clear,
+        )
+        results[f"api.{resource_type}.warm"] = timed(
+            lambda: client.post("/api/resources", json=payload), repeat
+        )
+        results[f"api.{resource_type}.cold"]["bytes"] = len(response.data)
+        gzipped = {"Accept-Encoding": "gzip"}
+        compressed = client.post("/api/resources", json=payload, headers=gzipped)
+        results[f"api.{resource_type}.gzip"] = timed(
+            lambda: client.post("/api/resources", json=payload, headers=gzipped),
+            repeat,
+        )
+        results[f"api.{resource_type}.gzip"]["bytes"] = len(compressed.data)
+        etag = {"If-None-Match": response.headers["ETag"]}
+        results[f"api.{resource_type}.not_modified"] = timed(
+            lambda: client.post("/api/resources", json=payload, headers=etag),
+            repeat,
+        )
+
+    payload = {"type": "all", "min_score": 1}
+    results["api.all.cold"] = timed(
+        lambda: client.post("/api/resources", json=payload),
+        repeat,
+        setup=result_cache.clear,
+    )
+
+    db.close_pools()
+    return {"counts": counts, "results": results}
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Run the cloud scanner benchmarks.")
+    parser.add_argument(
+        "--size",
+        nargs="+",
+        type=lambda value: SIZES.get(value.lower()) or int(value),
+        default=[SIZES["10k"]],
+        help="Total resources per run: 10k, 100k, 1m or a number.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--violation-rate", type=float, default=0.2)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--out", type=str, help="Write the JSON results here.")
+    args = parser.parse_args(argv)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "seed": args.seed,
+            "violation_rate": args.violation_rate,
+            "repeat": args.repeat,
+        },
+        "sizes": {},
+    }
+    for size in args.size:
+        print(f"Benchmarking {size} resources...", file=sys.stderr)
+        report["sizes"][str(size)] = run_size(
+            size, args.seed, args.violation_rate, args.repeat
+        )
+    report["meta"]["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as fp:
+            fp.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+startup.py
+
+Check the startup budget of the headless `cloudscanner scan` mode.
+
+Runs `python -m cloud_scanner scan` on a small generated inventory in fresh
+interpreters and compares the median wall-clock time with the budget. Also
+checks that importing the CLI does not pull in the web server or AWS SDK.
+Exits with status 1 if the budget is exceeded or a heavy module is imported.
+tests/test_startup.py runs the same checks under pytest.
+
+    python -m benchmarks.startup --budget 0.25 --runs 10
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List
+
+from benchmarks.generate import write_inventory
+
+# Must not be imported by `cloudscanner scan`.
+HEAVY_MODULES = ("flask", "werkzeug", "boto3", "botocore")
+
+DEFAULT_BUDGET = 0.25
+DEFAULT_SIZE = 300
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def heavy_imports() -> List[str]:
+    """
+    Heavy modules imported by the CLI module, in a fresh interpreter.
+    """
+    code = (
+        "import json, sys; import cloud_scanner.__main__; "
+        f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=REPO_ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output)
+
+
+def time_scan(inventory: str, runs: int, size: int) -> List[float]:
+    """
+    Wall-clock seconds of each `cloud_scanner scan` run.
+
+    Raises:
+        RuntimeError: if a run does not report loading all size resources
+    """
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-m", "cloud_scanner", "scan", inventory, "--top", "10"],
+            cwd=REPO_ROOT,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        timings.append(time.perf_counter() - start)
+        loaded = json.loads(output)["summary"]["loaded"]
+        if loaded != size:
+            raise RuntimeError(f"scan loaded {loaded} of {size} resources")
+    return timings
+
+
+def measure(size: int = DEFAULT_SIZE, runs: int = 10) -> List[float]:
+    """
+    Time `cloud_scanner scan` on a generated inventory of size resources.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        inventory = os.path.join(tmp, "inventory.json")
+        with open(inventory, "w") as fp:
+            write_inventory(fp, size, 0, 0.2)
+        return time_scan(inventory, runs, size)
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=DEFAULT_BUDGET,
+        help=f"Maximum median seconds per scan (default: {DEFAULT_BUDGET}).",
+    )
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=DEFAULT_SIZE,
+        help="Resources in the scanned inventory.",
+    )
+    args = parser.parse_args(argv)
+
+    timings = measure(args.size, args.runs)
+    heavy = heavy_imports()
+    median = statistics.median(timings)
+    print(
+        f"scan of {args.size} resources: median {median:.3f}s, "
+        f"min {min(timings):.3f}s, max {max(timings):.3f}s "
+        f"(budget {args.budget:.3f}s)"
+    )
+    failed = False
+    if median > args.budget:
+        print(f"Startup budget exceeded by {median - args.budget:.3f}s")
+        failed = True
+    if heavy:
+        print(f"Heavy modules imported: {', '.join(heavy)}")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
 import os, sys
 
-sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+# The modules import each other by their flat names; put them ahead of any
+# installed package with the same name (e.g. decorator).
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
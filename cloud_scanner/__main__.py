@@ -1,31 +1,242 @@
-import json
-import boto3
 import sys
 import os
 import argparse
+import json
+import tempfile
+import time
 import database_ops as db
-from app import app
-
+from ingest import (
+    CHUNK_SIZE,
+    BulkLoadError,
+    bulk_ingest,
+    expand_paths,
+    stream_ingest,
+)
+from findings import (
+    findings_check,
+    merge_ranked,
+    rebuild_findings,
+    resolve_types,
+    setup_findings,
+)
+from rule_engine import rulesets
+from rule_runner import tag, to_dicts
+from shards import prepare_shard
+from collector import MAX_WORKERS, collect, recorded_client_factory
 
-def breakdown_json(json_file):
-    ec2_instances = json_file.get("EC2Instances", [])
-    s3_buckets = json_file.get("S3Buckets", [])
-    rds_instances = json_file.get("RDSInstances", [])
-    return ec2_instances, s3_buckets, rds_instances
+# Flask (through app) and boto3 (through collector's client factory) are only
+# imported when they are used, so `cloudscanner scan` starts without them.
 
 
-def load_json_input(source=None):
+def open_json_input(source=None):
     if source:
-        with open(source, "r") as file:
-            return json.load(file)
+        return open(source, "rb")
     elif not sys.stdin.isatty():
-        return json.load(sys.stdin)
+        return sys.stdin.buffer
     else:
         raise ValueError(
             "No input provided. Please provide JSON via stdin or specify a file path."
         )
 
 
+def print_changes(stats):
+    print(
+        f"{stats['inserted']} new, {stats['updated']} updated, "
+        f"{stats['unchanged']} unchanged."
+    )
+
+
+def load_bulk(
+    patterns, workers=None, fast_load=False, db_path="data.db", partial=False
+):
+    paths = expand_paths(patterns)
+    if not paths:
+        print("No JSON files matched.")
+        sys.exit(1)
+
+    try:
+        stats = bulk_ingest(
+            paths, workers=workers, bulk=fast_load, partial=partial, db_path=db_path
+        )
+    except BulkLoadError as e:
+        for path, error in e.errors.items():
+            print(f"Failed to load {path}: {error}")
+        print(f"{e}. Fix the files, or pass --partial to load the others.")
+        sys.exit(1)
+    print(
+        f"Loaded {stats['total']} items from {len(paths) - len(stats['errors'])}/"
+        f"{len(paths)} files in {stats['seconds']} seconds "
+        f"({stats['rows_per_sec']} rows/sec)."
+    )
+    print_changes(stats)
+    for path, error in stats["errors"].items():
+        print(f"Failed to load {path}: {error}")
+    if stats["errors"]:
+        sys.exit(1)
+
+
+def collect_resources(
+    regions, accounts, recorded=None, workers=None, db_path="data.db"
+):
+    client_factory = recorded_client_factory(recorded) if recorded else None
+    stats = collect(
+        regions=regions,
+        accounts=accounts,
+        client_factory=client_factory,
+        max_workers=workers or MAX_WORKERS,
+        db_path=db_path,
+    )
+    print(
+        f"Collected {stats['total']} items in {stats['pages']} pages in "
+        f"{stats['seconds']} seconds ({stats['rows_per_sec']} rows/sec)."
+    )
+    print_changes(stats)
+    for error in stats["errors"]:
+        print(
+            f"Failed to collect {error['type']} from "
+            f"{error['account'] or 'default account'}/{error['region']}: {error['error']}"
+        )
+    if stats["errors"]:
+        sys.exit(1)
+
+
+def serve():
+    from app import app
+
+    app.run()
+
+
+def scan(args):
+    """
+    Headless run: load the inputs, evaluate them and write the findings to
+    stdout, without the web server.
+
+    Inputs are loaded into a temporary database with the bulk profile unless
+    --db names one to keep. Findings of every requested type are merged,
+    highest score first, and written as one JSON document (with a summary)
+    or as NDJSON, one resource per line, with the summary on stderr.
+
+    returns:
+        exit status
+    """
+    start = time.perf_counter()
+    try:
+        types = resolve_types(args.type, None)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    inputs = args.inputs
+    if not inputs and not sys.stdin.isatty():
+        inputs = ["-"]
+    if not inputs and args.db is None:
+        print("No input provided. Give JSON files or pipe JSON in.", file=sys.stderr)
+        return 2
+
+    with tempfile.TemporaryDirectory(prefix="cloudscanner-scan-") as tmp:
+        db_path = args.db or os.path.join(tmp, "scan.db")
+        db.setup_database(db_path=db_path)
+        setup_findings(db_path=db_path)
+        try:
+            types = resolve_types(types, args.violation, rulesets(db_path=db_path))
+        except ValueError as e:
+            db.close_pools()
+            print(e, file=sys.stderr)
+            return 2
+
+        loaded = 0
+        for source in inputs:
+            try:
+                fp = sys.stdin.buffer if source == "-" else open(source, "rb")
+            except OSError as e:
+                print(f"Cannot read {source}: {e}", file=sys.stderr)
+                return 1
+            with fp:
+                try:
+                    stats = stream_ingest(
+                        fp,
+                        chunk_size=args.chunk_size,
+                        bulk=args.db is None,
+                        db_path=db_path,
+                    )
+                except ValueError as e:
+                    print(f"Invalid JSON input in {source}: {e}", file=sys.stderr)
+                    return 1
+            loaded += stats["total"]
+
+        found = {
+            resource_type: findings_check(
+                resource_type,
+                min_score=args.min_score,
+                violation=args.violation,
+                top=args.top,
+                db_path=db_path,
+            )
+            for resource_type in types
+        }
+        db.close_pools()
+
+    for resource_type, resources in found.items():
+        tag(resources.values(), type=resource_type)
+    resources = merge_ranked((list(r.values()) for r in found.values()), args.top)
+    summary = {
+        "loaded": loaded,
+        "findings": {t: len(r) for t, r in found.items()},
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+    out = sys.stdout
+    if args.format == "ndjson":
+        for finding in resources:
+            out.write(json.dumps(finding.to_dict(), separators=(",", ":")) + "\n")
+        print(json.dumps(summary), file=sys.stderr)
+    else:
+        json.dump({"summary": summary, "resources": to_dicts(resources)}, out)
+        out.write("\n")
+    out.flush()
+    return 0
+
+
+def add_scan_parser(subparsers):
+    parser = subparsers.add_parser(
+        "scan",
+        help="Load JSON input, evaluate it and write the findings to stdout.",
+        description="Load JSON input, evaluate it and write the findings to "
+        "stdout, without starting the web server.",
+    )
+    parser.add_argument(
+        "inputs",
+        nargs="*",
+        metavar="FILE",
+        help="JSON files to scan, or - for stdin (default: stdin).",
+    )
+    parser.add_argument(
+        "--format",
+        choices=("json", "ndjson"),
+        default="json",
+        help="json: one document with a summary (default). ndjson: one resource "
+        "per line, summary on stderr.",
+    )
+    parser.add_argument(
+        "--type",
+        type=lambda value: ["s3", "ec2", "rds"] if value == "all" else value.split(","),
+        default=["s3", "ec2", "rds"],
+        help="Comma separated resource types to report, or all (default).",
+    )
+    parser.add_argument("--min-score", type=float, default=0)
+    parser.add_argument("--violation", type=str, default=None)
+    parser.add_argument(
+        "--top", type=int, default=None, help="Only report the N highest scores."
+    )
+    parser.add_argument(
+        "--db",
+        type=str,
+        default=None,
+        help="Load into and evaluate this database file instead of a temporary one.",
+    )
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+
+
 def main():
     """
     Main function that starts the party.
@@ -33,12 +244,16 @@ def main():
     Starts the db up
 
     Checks if arguments are attached to command invocation, redirecting
-    to load_json_input to control initial data load.
+    to open_json_input to control initial data load.
 
-    Then breaks down the json into the 3 types (S3Buckets, EC2Instances, RDSInstances)
-    and sends them to the DB.
+    Then streams the json into the DB in chunks, split into the 3 types
+    (S3Buckets, EC2Instances, RDSInstances), and reports throughput. With
+    --bulk, many files are parsed in parallel and loaded by one writer instead,
+    and with --collect the resources are fetched from the AWS APIs.
 
     Then starts the flask server to access the contents
+
+    `cloudscanner scan` instead loads, evaluates and reports in one go, see scan().
     """
     parser = argparse.ArgumentParser(
         description="Load cloud resource data from JSON into the database."
@@ -49,23 +264,133 @@ def main():
         type=str,
         help="Path to the JSON file containing the cloud resource data.",
     )
+    parser.add_argument(
+        "--bulk",
+        nargs="+",
+        metavar="PATH",
+        help="Directories or glob patterns of JSON files to load in parallel.",
+    )
+    parser.add_argument(
+        "--partial",
+        action="store_true",
+        help="With --bulk, load the files that parse even if others fail. By "
+        "default one bad file rolls back the whole load.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of parser processes for --bulk (default: CPU count), or of "
+        "concurrent API tasks for --collect (default: 8).",
+    )
+    parser.add_argument(
+        "--collect",
+        action="store_true",
+        help="Collect resources directly from AWS instead of loading JSON.",
+    )
+    parser.add_argument(
+        "--regions",
+        type=lambda value: value.split(","),
+        default=["us-east-1"],
+        help="Comma separated regions to collect from (default: us-east-1).",
+    )
+    parser.add_argument(
+        "--accounts",
+        type=lambda value: value.split(","),
+        default=[None],
+        help="Comma separated IAM role ARNs to assume, one per account.",
+    )
+    parser.add_argument(
+        "--recorded",
+        type=str,
+        help="Serve --collect from recorded API responses in this JSON file.",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=CHUNK_SIZE,
+        help="Number of resources inserted per batch while streaming the input.",
+    )
+    parser.add_argument(
+        "--fast-load",
+        action="store_true",
+        help="Load -f or --bulk input with the bulk profile: relaxed durability and "
+        "indexes rebuilt once at the end. Best for large or initial loads.",
+    )
+    parser.add_argument(
+        "--account",
+        type=str,
+        help="Load -f, --bulk or --collect input into this account's own database file "
+        "(see shards.py), or rebuild its findings with --rebuild-findings.",
+    )
+    parser.add_argument(
+        "--rebuild-findings",
+        action="store_true",
+        help="Recompute the findings table from the current rules and exit.",
+    )
     parser.add_argument(
         "--serve", "-s", action="store_true", help="Start the Flask server on port 5000"
     )
+    add_scan_parser(parser.add_subparsers(dest="command"))
     args = parser.parse_args()
 
+    if args.command == "scan":
+        sys.exit(scan(args))
+
     db.setup_database()
+    setup_findings()
+    try:
+        db_path = prepare_shard(args.account)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    if args.rebuild_findings:
+        rebuild_findings(db_path=db_path)
+        print("Findings rebuilt.")
+        return
+
+    if args.collect:
+        collect_resources(
+            args.regions, args.accounts, args.recorded, args.workers, db_path
+        )
+        if args.serve:
+            serve()
+        return
+
+    if args.bulk:
+        load_bulk(args.bulk, args.workers, args.fast_load, db_path, args.partial)
+        if args.serve:
+            serve()
+        return
 
     try:
-        json_input = load_json_input(args.file)
+        json_input = open_json_input(args.file)
     except ValueError as e:
         print(e)
         sys.exit(1)
 
-    ec2_instances, s3_buckets, rds_instances = breakdown_json(json_input)
-    db.batch_insert_ec2(data=ec2_instances)
-    db.batch_insert_s3(data=s3_buckets)
-    db.batch_insert_rds(data=rds_instances)
+    with json_input:
+        try:
+            stats = stream_ingest(
+                json_input,
+                chunk_size=args.chunk_size,
+                bulk=args.fast_load,
+                db_path=db_path,
+            )
+        except ValueError as e:
+            print(f"Invalid JSON input: {e}")
+            sys.exit(1)
+
+    print(
+        f"Loaded {stats['total']} items in {stats['seconds']} seconds "
+        f"({stats['rows_per_sec']} rows/sec)."
+    )
+    print_changes(stats)
 
     if args.serve:
-        app.run()
+        serve()
+
+
+if __name__ == "__main__":
+    main()
@@ -10,33 +10,110 @@ to assess resources and fetching evaluation results based on security criteria.
 Key Features:
 Upload Endpoint (/upload): POST a JSON file to insert cloud resource data into
 the database. The file should include EC2Instances, S3Buckets, and RDSInstances.
+The upload is spooled to disk and loaded by a background worker (see jobs.py):
+the endpoint answers 202 Accepted with a job id right away, or 429 when too many
+uploads are already waiting. GET /jobs/<id> reports the job's progress, row
+counts and errors. An optional "account" form field loads the file into that
+account's own database file (see shards.py) instead of the shared one.
 
 Assessment Endpoint (/api/resources): POST a request to get security risk scores
 for specified resources (ec2, s3, rds), filtering by a minimum risk score if needed.
 
 Quick Start:
 Upload: Send your JSON file with cloud resource data to /upload. Make sure the file
-matches the expected structure.
+matches the expected structure, then poll the returned status_url until the
+job is done.
 
 Fetch Results: Post to /api/resources with the resource type and an optional
-minimum score to see which resources pass or need attention.
+minimum score to see which resources pass or need attention. Scores are the
+sum of the risk_score weights of the violated rules; top returns only the N
+highest-scoring resources. A type of "all", or a list of types, reads every
+type in parallel and returns one ranked list with per-type timings. Passing an
+account (a name, a list, or "*" for every account) reads those accounts'
+shards in parallel the same way. Violations are
+read from the findings table, which is kept up to date as data is inserted
+(see findings.py). Passing a limit
+(and then the returned next_cursor) pages through the results, highest score
+first. Results are cached
+per resource type until the next upload or rules change; GET /api/cache shows
+the hit/miss counters.
+Responses carry an ETag derived from the data and rules version and the query,
+so a request with a matching If-None-Match gets 304 Not Modified without any
+check being run, and large bodies are gzip-compressed, once, for clients that
+accept it (see http_cache.py).
+
+Diff Endpoint (/api/diff?since=<generation>): GET the resources whose findings
+were added, resolved or changed since a data generation, read from the change
+log written at ingest time (see changes.py). The response carries the current
+generation to pass as since next time; GET /api/scans lists the recent loads
+and their generations. Both take an optional account.
+
+Profiling: with CLOUDSCANNER_ADMIN_TOKEN set, a request sent with
+"X-Profile: sample" (or cprofile) and "X-Admin-Token: <token>" is profiled and
+answered with an X-Profile-Id header; POST /admin/profiling profiles every
+request until switched off. GET /admin/profiles/<id> returns the profile as
+collapsed stacks (or ?format=pstats). See profiler.py.
 """
 
-from flask import Flask, request, jsonify
-from rule_runner import s3_rule_check, ec2_instance_check, rds_rule_check
-import json
+from flask import Flask, Response, g, request, jsonify
+from findings import (
+    setup_findings,
+    findings_check,
+    findings_check_types,
+    findings_page,
+)
 import database_ops as db
+from rule_runner import to_dicts
+from http_cache import cached_json
+from changes import HistoryUnavailable, findings_diff, scan_history
+from jobs import QueueFull, jobs
+import shards
+from result_cache import results as result_cache
+import metrics
+import profiler
 
 app = Flask(__name__)
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+RESOURCE_TYPES = ("s3", "ec2", "rds")
+
 db.setup_database()
+setup_findings()
+
 
+@app.before_request
+def start_profile():
+    profile_mode = profiler.requested_mode(
+        request.headers.get("X-Profile"),
+        lambda: request.headers.get("X-Admin-Token"),
+    )
+    if profile_mode is not None:
+        g.profile = profiler.Profile(
+            f"{request.method} {request.path}", profile_mode
+        ).start()
 
-def breakdown_json(json_file):
-    ec2_instances = json_file["EC2Instances"]
-    s3_buckets = json_file["S3Buckets"]
-    rds_instances = json_file["RDSInstances"]
-    return ec2_instances, s3_buckets, rds_instances
+
+@app.after_request
+def stop_profile(response):
+    if not profiler.running:
+        return response
+    profile = g.pop("profile", None)
+    if profile is not None:
+        profiler.store.add(profile.stop())
+        response.headers["X-Profile-Id"] = profile.id
+    return response
+
+
+@app.teardown_request
+def discard_profile(exc):
+    # Requests that raised skip after_request; keep their profile too.
+    if not profiler.running:
+        return
+    profile = g.pop("profile", None)
+    if profile is not None:
+        profiler.store.add(profile.stop())
 
 
 @app.route("/upload", methods=["POST"])
@@ -56,54 +133,315 @@ def upload_json():
     if file.filename == "":
         return jsonify({"error": "No selected file."}), 400
 
+    account = request.form.get("account") or None
+    if account is not None:
+        try:
+            db.shard_path(account)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
     if file:
         try:
-            json_data = json.load(file)
-        except ValueError:
+            profile = g.get("profile")
+            job = jobs.submit(
+                file.stream, account, profile.mode if profile is not None else None
+            )
+        except QueueFull:
             return (
-                jsonify(
-                    "Your file was not accepted due to a ValueError during load. Please validate your file is valid JSON"
-                ),
-                400,
+                jsonify({"error": "Too many uploads are waiting. Retry later."}),
+                429,
+                {"Retry-After": "30"},
             )
 
-        ec2_instances, s3_buckets, rds_instances = breakdown_json(json_data)
-        db.batch_insert_ec2(data=ec2_instances)
-        db.batch_insert_s3(data=s3_buckets)
-        db.batch_insert_rds(data=rds_instances)
         return (
             jsonify(
-                f"Data has been loaded. {(len(ec2_instances) + len(s3_buckets) + len(rds_instances))} Items Accepted."
+                {
+                    "job_id": job.id,
+                    "status": job.status,
+                    "status_url": f"/jobs/{job.id}",
+                }
             ),
-            200,
+            202,
+            {"Location": f"/jobs/{job.id}"},
         )
 
 
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job.to_dict())
+
+
 @app.route("/api/resources", methods=["POST"])
 def get_resources():
     data = request.get_json()
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be a JSON object"}), 400
     resource_type = data.get("type")
     min_score = data.get("min_score", 0)
+    violation = data.get("violation")
+    limit = data.get("limit")
+    cursor = data.get("cursor")
+    top = data.get("top")
+    account = data.get("account")
 
-    if resource_type.lower() == "s3":
-        resources = s3_rule_check()
-    elif resource_type.lower() == "ec2":
-        resources = ec2_instance_check()
-    elif resource_type.lower() == "rds":
-        resources = rds_rule_check()
-    else:
+    if isinstance(min_score, bool) or not isinstance(min_score, (int, float)):
+        return jsonify({"error": "min_score must be a number"}), 400
+    if cursor is not None and not isinstance(cursor, str):
+        return jsonify({"error": "cursor must be a string"}), 400
+    if violation is not None and not isinstance(violation, str):
+        return jsonify({"error": "violation must be a string"}), 400
+    if top is not None:
+        if isinstance(top, bool) or not isinstance(top, int):
+            return jsonify({"error": "top must be an integer"}), 400
+        if limit is not None or cursor is not None:
+            return (
+                jsonify({"error": "top cannot be combined with limit or cursor"}),
+                400,
+            )
+
+    if str(resource_type).lower() == "all":
+        resource_type = list(RESOURCE_TYPES)
+    if account is not None:
+        if limit is not None or cursor is not None:
+            return (
+                jsonify({"error": "account cannot be combined with limit or cursor"}),
+                400,
+            )
+        if not isinstance(resource_type, list):
+            resource_type = [resource_type]
+        return get_account_resources(account, resource_type, min_score, violation, top)
+    if isinstance(resource_type, list):
+        return get_resources_of_types(resource_type, min_score, violation, top)
+    if str(resource_type).lower() not in RESOURCE_TYPES:
+        return jsonify({"error": "Invalid resource type"}), 400
+
+    resource_type = resource_type.lower()
+    paged = limit is not None or cursor is not None
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+    if isinstance(limit, bool) or not isinstance(limit, int):
+        return jsonify({"error": "limit must be an integer"}), 400
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    key = (resource_type, db.data_version(), min_score, violation)
+
+    def read_page():
+        page, next_cursor = findings_page(
+            resource_type,
+            min_score=min_score,
+            violation=violation,
+            limit=limit,
+            cursor=cursor,
+        )
+        return {"resources": to_dicts(page), "next_cursor": next_cursor}
+
+    try:
+        if not paged:
+            return cached_json(
+                key + (top,),
+                lambda: to_dicts(
+                    findings_check(
+                        resource_type, min_score=min_score, violation=violation, top=top
+                    )
+                ),
+            )
+        return cached_json(key + (limit, cursor), read_page)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+
+def get_resources_of_types(resource_types, min_score, violation, top):
+    """
+    /api/resources for several resource types, read concurrently and merged
+    into one ranking.
+    """
+    types = [str(t).lower() for t in resource_types]
+    if not types or any(t not in RESOURCE_TYPES for t in types):
+        return jsonify({"error": "Invalid resource type"}), 400
+
+    key = (tuple(types), db.data_version(), min_score, violation, top)
+
+    def read_types():
+        resources, timings = findings_check_types(
+            types, min_score=min_score, violation=violation, top=top
+        )
+        return {"resources": to_dicts(resources), "timings": timings}
+
+    try:
+        return cached_json(key, read_types)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+
+def get_account_resources(account, resource_types, min_score, violation, top):
+    """
+    /api/resources for the shards of one or more accounts ("*" for every
+    shard), read concurrently and merged into one ranking.
+    """
+    types = [str(t).lower() for t in resource_types]
+    if not types or any(t not in RESOURCE_TYPES for t in types):
         return jsonify({"error": "Invalid resource type"}), 400
+    if account == "*":
+        accounts = None
+    elif isinstance(account, str):
+        accounts = [account]
+    elif isinstance(account, list) and all(isinstance(a, str) for a in account):
+        accounts = account
+    else:
+        return jsonify({"error": "account must be a string or a list of strings"}), 400
+
+    def read_shards():
+        resources, timings = shards.findings_check_shards(
+            [account for account, _ in versions],
+            types,
+            min_score=min_score,
+            violation=violation,
+            top=top,
+        )
+        return {"resources": to_dicts(resources), "timings": timings}
+
+    try:
+        versions = tuple(shards.versions(accounts).items())
+        key = ("shards", versions, tuple(types), min_score, violation, top)
+        return cached_json(key, read_shards)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+
+def shard_for(account):
+    """
+    Database file of an account's shard, or of data.db for None.
+    """
+    if account is None:
+        return db.shard_path(None)
+    return shards.existing_shards([account])[account]
+
+
+@app.route("/api/diff", methods=["GET"])
+def get_diff():
+    since = request.args.get("since", type=int)
+    if since is None:
+        return jsonify({"error": "since must be an integer generation"}), 400
+    resource_type = request.args.get("type", "all").lower()
+    types = list(RESOURCE_TYPES) if resource_type == "all" else resource_type.split(",")
+    account = request.args.get("account")
+
+    try:
+        db_path = shard_for(account)
+        key = ("diff", account, db.data_version(db_path=db_path), since, tuple(types))
+        return cached_json(key, lambda: findings_diff(since, types, db_path=db_path))
+    except HistoryUnavailable as e:
+        return jsonify({"error": str(e)}), 410
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
 
+@app.route("/api/scans", methods=["GET"])
+def get_scans():
     try:
-        filtered_data = {
-            key: value
-            for key, value in resources.items()
-            if len(value.get("Violations", [])) >= min_score
-        }
-    except AttributeError as e:
-        return jsonify(f"Error processing data: {e}"), 400
-
-    return jsonify(filtered_data)
+        db_path = shard_for(request.args.get("account"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(scan_history(db_path=db_path))
+
+
+def admin_error():
+    """
+    Error response for a request without the admin token, or None.
+    """
+    if profiler.ADMIN_TOKEN is None:
+        return jsonify({"error": "Admin endpoints are disabled"}), 404
+    if not profiler.authorized(request.headers.get("X-Admin-Token")):
+        return jsonify({"error": "Invalid admin token"}), 403
+    return None
+
+
+@app.route("/admin/profiling", methods=["GET", "POST"])
+def profiling_settings():
+    error = admin_error()
+    if error is not None:
+        return error
+    if request.method == "POST":
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"error": "Request body must be a JSON object"}), 400
+        try:
+            profiler.set_enabled(bool(data.get("enabled")), data.get("mode", "sample"))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    return jsonify({"enabled": profiler.enabled, "mode": profiler.mode})
+
+
+@app.route("/admin/profiles", methods=["GET"])
+def list_profiles():
+    error = admin_error()
+    if error is not None:
+        return error
+    return jsonify(profiler.store.list())
+
+
+@app.route("/admin/profiles/<profile_id>", methods=["GET"])
+def get_profile(profile_id):
+    error = admin_error()
+    if error is not None:
+        return error
+    profile = profiler.store.get(profile_id)
+    if profile is None:
+        return jsonify({"error": "Unknown profile"}), 404
+    if request.args.get("format", "collapsed") == "pstats":
+        if profile.pstats is None:
+            return jsonify({"error": "Profile was sampled; use format=collapsed"}), 400
+        return Response(
+            profile.pstats,
+            mimetype="application/octet-stream",
+            headers={
+                "Content-Disposition": f"attachment; filename={profile.id}.pstats"
+            },
+        )
+    if profile.mode == "cprofile":
+        return jsonify({"error": "Profile has no samples; use format=pstats"}), 400
+    return Response(profile.collapsed(), mimetype="text/plain")
+
+
+@app.route("/api/cache", methods=["GET"])
+def cache_stats():
+    return jsonify(result_cache.stats())
+
+
+def cache_metrics():
+    stats = result_cache.stats()
+    yield (
+        "cloudscanner_result_cache_hits_total",
+        "counter",
+        "Result cache hits.",
+        {},
+        stats["hits"],
+    )
+    yield (
+        "cloudscanner_result_cache_misses_total",
+        "counter",
+        "Result cache misses.",
+        {},
+        stats["misses"],
+    )
+    yield (
+        "cloudscanner_result_cache_entries",
+        "gauge",
+        "Entries in the result cache.",
+        {},
+        stats["size"],
+    )
+
+
+metrics.register_collector(cache_metrics)
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,232 @@
+"""
+changes.py
+
+Scan-to-scan diffs of the findings.
+
+Every change to the findings table is recorded in the finding_changes
+log, stamped with the data generation that made it (see database_ops.py),
+and every load is recorded in the scans table. A diff since
+generation N therefore only reads the log entries after N and the current
+findings of the resources they name; nothing is re-evaluated and no snapshot
+is kept. The log only goes back CHANGE_LOG_SCANS scans (see
+database_ops.prune_changes()); older generations cannot be diffed from.
+
+For each resource the first logged old_score and last logged new_score of
+each violation give its state at generation N and now. Resources whose
+violations and score are the same at both ends are left out; the others are
+reported as added (no violations at N), resolved (none now) or changed.
+"""
+
+import json
+import sqlite3
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from database_ops import RESOURCE_COLUMNS, data_generation, with_db_connection
+from decorator import autolog
+from findings import resolve_types, sync_findings
+from rule_engine import RESOURCE_TABLES, rulesets
+from rule_runner import Finding, Layout
+
+DEFAULT_SCAN_HISTORY = 100
+
+
+class HistoryUnavailable(ValueError):
+    """
+    Raised by findings_diff() for a generation older than the change log.
+    """
+
+
+def change_log_start(conn: sqlite3.Connection) -> int:
+    """
+    Generation the change log starts at; earlier changes are unknown.
+    """
+    row = conn.execute(
+        "SELECT value FROM flags WHERE key = 'change_log_start'"
+    ).fetchone()
+    return int(row[0]) if row else 0
+
+
+def read_scans(
+    conn: sqlite3.Connection, since: int = -1, limit: Optional[int] = None
+) -> List[dict]:
+    """
+    Scans that ended after generation since, newest first.
+    """
+    cursor = conn.execute(
+        """
+        SELECT id, generation, previous_generation, started, finished,
+            finding_changes
+        FROM scans WHERE generation > ? ORDER BY id DESC LIMIT ?
+        """,
+        (since, -1 if limit is None else limit),
+    )
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor]
+
+
+@with_db_connection()
+def scan_history(
+    limit: int = DEFAULT_SCAN_HISTORY, conn: Optional[sqlite3.Connection] = None
+) -> dict:
+    """
+    The current data generation and the most recent scans.
+
+    conn (Optional): SQLite3 connection. Supplied by @with_db_connection() decorator
+    """
+    return {
+        "generation": data_generation(conn=conn),
+        "change_log_start": change_log_start(conn),
+        "scans": read_scans(conn, limit=limit),
+    }
+
+
+def net_changes(
+    rows: Iterable[Tuple[int, str, Optional[int], Optional[int]]]
+) -> Dict[int, Dict[str, Tuple[Optional[int], Optional[int]]]]:
+    """
+    Fold log rows ordered by (resource_id, violation, generation) into the
+    (old score, new score) of each violation of each resource.
+    """
+    changed = defaultdict(dict)
+    for resource_id, violation, old_score, new_score in rows:
+        scores = changed[resource_id]
+        first = scores.get(violation)
+        scores[violation] = (
+            old_score if first is None else first[0],
+            new_score,
+        )
+    return changed
+
+
+def _diff_table(
+    resource_type: str, since: int, conn: sqlite3.Connection
+) -> Dict[str, List[dict]]:
+    ruleset = rulesets(conn=conn)[resource_type]
+    table = ruleset["table"]
+    changed = net_changes(
+        conn.execute(
+            """
+            SELECT resource_id, violation, old_score, new_score
+            FROM finding_changes
+            WHERE generation > ? AND resource_table = ?
+            ORDER BY resource_id, violation, generation
+            """,
+            (since, table),
+        )
+    )
+    diff = {"added": [], "resolved": [], "changed": []}
+    if not changed:
+        return diff
+
+    ids = json.dumps(list(changed))
+    current = defaultdict(dict)
+    for resource_id, violation, score in conn.execute(
+        """
+        SELECT resource_id, violation, score FROM findings
+        WHERE resource_table = ? AND resource_id IN (SELECT value FROM json_each(?))
+        """,
+        (table, ids),
+    ):
+        current[resource_id][violation] = score
+    columns = RESOURCE_COLUMNS[table]
+    rows = {
+        row[0]: row
+        for row in conn.execute(
+            f"SELECT {', '.join(columns)} FROM {table} "
+            f"WHERE id IN (SELECT value FROM json_each(?))",
+            (ids,),
+        )
+    }
+
+    layout = Layout(columns, tuple(ruleset["rules"]), {"type": resource_type})
+    bits = {name: 1 << i for i, name in enumerate(layout.rules)}
+    for resource_id, scores in changed.items():
+        now = current.get(resource_id, {})
+        # Violations missing from the log are the same at both ends.
+        before = {v: s for v, s in now.items() if v not in scores}
+        before.update((v, old) for v, (old, _) in scores.items() if old is not None)
+        if before == now:
+            continue
+
+        score = next(iter(now.values()), 0)
+        finding = Finding(
+            rows.get(resource_id, (resource_id,)),
+            sum(bits.get(v, 0) for v in now),
+            score,
+            layout,
+        )
+        data = finding.to_dict()
+        data["Previous"] = {
+            "Violations": [name for name in layout.rules if name in before],
+            "RiskScore": next(iter(before.values()), 0),
+        }
+        if not before:
+            diff["added"].append(data)
+        elif not now:
+            diff["resolved"].append(data)
+        else:
+            diff["changed"].append(data)
+    return diff
+
+
+@autolog(__name__)
+@with_db_connection()
+def findings_diff(
+    since: int,
+    resource_types: Iterable[str] = tuple(RESOURCE_TABLES),
+    conn: Optional[sqlite3.Connection] = None,
+) -> dict:
+    """
+    Findings added, resolved or changed since a data generation.
+
+    since (int): Generation to diff from, usually the "generation" returned by
+        the previous diff or by scan_history()
+    resource_types: s3, ec2 and/or rds
+    conn (Optional): SQLite3 connection. Supplied by @with_db_connection() decorator
+
+    returns:
+        dict with the current generation, the scans since, and the added,
+        resolved and changed resources (each with its type, current
+        Violations and RiskScore and Previous ones), highest score first
+
+    Raises:
+        HistoryUnavailable: if since is older than the change log
+        ValueError: for a generation in the future or an invalid type
+    """
+    resource_types = resolve_types(resource_types, None)
+    sync_findings(conn)
+    conn.commit()
+
+    # One read transaction, so the log and the current findings agree.
+    conn.execute("BEGIN")
+    try:
+        generation = data_generation(conn=conn)
+        start = change_log_start(conn)
+        if since < start:
+            raise HistoryUnavailable(
+                f"Changes before generation {start} are not recorded"
+            )
+        if since > generation:
+            raise ValueError(f"Generation {since} is newer than {generation}")
+
+        result = {
+            "since": since,
+            "generation": generation,
+            "scans": read_scans(conn, since),
+            "added": [],
+            "resolved": [],
+            "changed": [],
+        }
+        for resource_type in resource_types:
+            for kind, resources in _diff_table(resource_type, since, conn).items():
+                result[kind].extend(resources)
+    finally:
+        conn.rollback()
+
+    result["added"].sort(key=lambda data: (-data["RiskScore"], data["id"]))
+    result["changed"].sort(key=lambda data: (-data["RiskScore"], data["id"]))
+    result["resolved"].sort(
+        key=lambda data: (-data["Previous"]["RiskScore"], data["id"])
+    )
+    return result
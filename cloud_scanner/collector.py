@@ -0,0 +1,513 @@
+"""
+collector.py
+
+Collects EC2 security groups, S3 buckets and RDS instances straight from AWS.
+
+Every (account, region) pair gets its own EC2 and RDS task, and every account
+one S3 task, all run on one bounded thread pool. The S3 task lists the
+buckets and submits the lookups of every BUCKET_CHUNK of them as further
+tasks on the same pool. Each task pages through its API and converts every
+page into the same dictionaries the JSON export uses, handing them to the
+calling thread through a bounded queue. The calling thread is the only writer:
+it feeds the pages into the batch_insert_* functions as they arrive, so
+nothing is held in memory beyond a few pages. If it fails, the tasks stop
+instead of waiting for room in the queue. A finished collection is recorded
+in the scans table like any other load (see changes.py).
+
+API calls use botocore's adaptive retry mode, and with_backoff() adds jittered
+exponential backoff on top for throttling errors that outlast it.
+
+Clients come from a client_factory(service, region, account) callable. The
+default builds boto3 clients (assuming a role per account when accounts are
+role ARNs); recorded_client_factory() serves recorded responses from a JSON
+file instead, and a factory returning clients wrapped in botocore's Stubber
+works as well, so collection can be exercised offline.
+"""
+
+import functools
+import json
+import logging
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterator, List, Optional, Sequence
+
+import database_ops as db
+from decorator import autolog
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REGION = "us-east-1"
+MAX_WORKERS = 8
+# Buckets looked up by one task
+BUCKET_CHUNK = 25
+RETRIES = {"max_attempts": 10, "mode": "adaptive"}
+THROTTLING_CODES = {
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestLimitExceeded",
+    "RequestThrottled",
+    "SlowDown",
+    "TooManyRequestsException",
+}
+
+# Operation: (request token parameter, response token key)
+PAGINATION = {
+    "describe_instances": ("NextToken", "NextToken"),
+    "describe_security_groups": ("NextToken", "NextToken"),
+    "describe_db_instances": ("Marker", "Marker"),
+    "list_buckets": ("ContinuationToken", "ContinuationToken"),
+}
+
+
+class _Stopped(Exception):
+    """
+    Raised in a collection task when collect() stops before it is done.
+    """
+
+
+INSERTERS = {
+    "ec2": db.batch_insert_ec2,
+    "s3": db.batch_insert_s3,
+    "rds": db.batch_insert_rds,
+}
+
+
+def _error_code(error: Exception) -> Optional[str]:
+    response = getattr(error, "response", None) or {}
+    return response.get("Error", {}).get("Code")
+
+
+def _backoff(attempt: int, base_delay: float = 0.5) -> None:
+    delay = base_delay * 2**attempt
+    time.sleep(delay + random.uniform(0, delay))
+
+
+def with_backoff(call: Callable, *args: Any, attempts: int = 5, **kwargs: Any) -> Any:
+    """
+    Call an API operation, retrying throttling errors with jittered
+    exponential backoff.
+    """
+    for attempt in range(attempts):
+        try:
+            return call(*args, **kwargs)
+        except Exception as e:
+            if _error_code(e) not in THROTTLING_CODES or attempt == attempts - 1:
+                raise
+            _backoff(attempt)
+
+
+def paginate(client: Any, operation: str, **kwargs: Any) -> Iterator[dict]:
+    """
+    Yield every page of an operation listed in PAGINATION.
+
+    Pages are requested one call at a time, passing on the previous page's
+    token, so a throttled call is retried on its own by with_backoff()
+    without restarting the listing.
+    """
+    input_token, output_token = PAGINATION[operation]
+    call = getattr(client, operation)
+    while True:
+        page = with_backoff(call, **kwargs)
+        yield page
+        token = page.get(output_token)
+        if not token:
+            return
+        kwargs = {**kwargs, input_token: token}
+
+
+def boto3_client_factory(
+    max_workers: int = MAX_WORKERS,
+) -> Callable[[str, str, Optional[str]], Any]:
+    """
+    Build a client factory backed by boto3.
+
+    Accounts are IAM role ARNs to assume from the base session, or None for
+    the base session itself. The base session reads the AMZN_ACCESS_KEY,
+    AMZN_SECRET_KEY and AMZN_REGION environment variables, falling back to
+    the default boto3 credential chain.
+    """
+    import boto3
+    from botocore.config import Config
+
+    config = Config(retries=RETRIES, max_pool_connections=max_workers * 2)
+    base = boto3.Session(
+        aws_access_key_id=os.getenv("AMZN_ACCESS_KEY"),
+        aws_secret_access_key=os.getenv("AMZN_SECRET_KEY"),
+        region_name=os.getenv("AMZN_REGION", DEFAULT_REGION),
+    )
+    sessions = {None: base}
+    lock = threading.Lock()
+
+    def factory(service: str, region: str, account: Optional[str]) -> Any:
+        # boto3 sessions are not thread-safe, clients are.
+        with lock:
+            session = sessions.get(account)
+            if session is None:
+                credentials = base.client("sts", config=config).assume_role(
+                    RoleArn=account, RoleSessionName="cloudscanner"
+                )["Credentials"]
+                session = boto3.Session(
+                    aws_access_key_id=credentials["AccessKeyId"],
+                    aws_secret_access_key=credentials["SecretAccessKey"],
+                    aws_session_token=credentials["SessionToken"],
+                )
+                sessions[account] = session
+            return session.client(service, region_name=region, config=config)
+
+    return factory
+
+
+class RecordedClient:
+    """
+    Stand-in client serving recorded responses.
+
+    responses maps operation names to a list of pages (for paginated
+    operations) or to a single response. Responses may also be keyed by
+    parameter value, e.g. {"get_bucket_logging": {"by": "Bucket", "responses":
+    {"my-bucket": {...}}}}. A response of {"Error": {"Code": ...}} is raised as
+    a botocore ClientError.
+    """
+
+    def __init__(self, responses: dict):
+        self.responses = responses
+
+    def _respond(self, operation: str, response: dict) -> dict:
+        if "Error" in response:
+            from botocore.exceptions import ClientError
+
+            raise ClientError(response, operation)
+        return response
+
+    def __getattr__(self, operation: str) -> Callable:
+        if operation.startswith("_"):
+            raise AttributeError(operation)
+
+        def call(**kwargs: Any) -> dict:
+            recorded = self.responses.get(operation, {})
+            if isinstance(recorded, list):
+                input_token, output_token = PAGINATION[operation]
+                index = int(kwargs.get(input_token) or 0)
+                page = dict(self._respond(operation, recorded[index]))
+                if index + 1 < len(recorded):
+                    page[output_token] = str(index + 1)
+                return page
+            if "by" in recorded:
+                recorded = recorded["responses"].get(
+                    str(kwargs.get(recorded["by"])), {}
+                )
+            return self._respond(operation, recorded)
+
+        return call
+
+
+def recorded_client_factory(
+    path: str,
+) -> Callable[[str, str, Optional[str]], RecordedClient]:
+    """
+    Client factory serving responses recorded in a JSON file shaped as
+    {service: {operation: response or [pages]}}, optionally nested under
+    account and region keys as {"accounts": {account: {region: {...}}}},
+    where the base credentials' account is "default".
+    """
+    with open(path, "r") as file:
+        recording = json.load(file)
+
+    def factory(service: str, region: str, account: Optional[str]) -> RecordedClient:
+        services = recording
+        if "accounts" in recording:
+            services = recording["accounts"].get(account or "default", {})
+            services = services.get(region, {})
+        return RecordedClient(services.get(service, {}))
+
+    return factory
+
+
+def collect_security_groups(client: Any) -> Iterator[List[dict]]:
+    """
+    Yield pages of EC2Instances entries, one per security group.
+
+    The public and private IP of the first instance using each group are
+    attached to it; groups without instances get no public IP and an empty
+    private IP.
+    """
+    addresses = {}
+    for page in paginate(client, "describe_instances", MaxResults=1000):
+        for reservation in page.get("Reservations", []):
+            for instance in reservation.get("Instances", []):
+                for group in instance.get("SecurityGroups", []):
+                    addresses.setdefault(
+                        group["GroupId"],
+                        (
+                            instance.get("PublicIpAddress"),
+                            instance.get("PrivateIpAddress", ""),
+                        ),
+                    )
+
+    for page in paginate(client, "describe_security_groups", MaxResults=1000):
+        records = []
+        for group in page.get("SecurityGroups", []):
+            public_ip, private_ip = addresses.get(group["GroupId"], (None, ""))
+            records.append(
+                {
+                    "GroupId": group["GroupId"],
+                    "GroupName": group.get("GroupName", ""),
+                    "IpPermissions": group.get("IpPermissions", []),
+                    "Description": group.get("Description", ""),
+                    "PublicIp": public_ip,
+                    "PrivateIp": private_ip or "",
+                }
+            )
+        yield records
+
+
+def _bucket_record(client: Any, bucket: dict) -> dict:
+    name = bucket["Name"]
+
+    try:
+        block = with_backoff(client.get_public_access_block, Bucket=name)
+        public_access = not all(
+            block["PublicAccessBlockConfiguration"].get(setting, False)
+            for setting in (
+                "BlockPublicAcls",
+                "IgnorePublicAcls",
+                "BlockPublicPolicy",
+                "RestrictPublicBuckets",
+            )
+        )
+    except Exception as e:
+        if _error_code(e) != "NoSuchPublicAccessBlockConfiguration":
+            raise
+        public_access = True
+
+    try:
+        with_backoff(client.get_bucket_encryption, Bucket=name)
+        encrypted = True
+    except Exception as e:
+        if _error_code(e) != "ServerSideEncryptionConfigurationNotFoundError":
+            raise
+        encrypted = False
+
+    logging_enabled = "LoggingEnabled" in with_backoff(
+        client.get_bucket_logging, Bucket=name
+    )
+
+    creation_date = bucket.get("CreationDate", "")
+    return {
+        "Name": name,
+        "CreationDate": (
+            creation_date.isoformat()
+            if hasattr(creation_date, "isoformat")
+            else str(creation_date)
+        ),
+        "PublicAccess": public_access,
+        "Encrypted": encrypted,
+        "LoggingEnabled": logging_enabled,
+    }
+
+
+def bucket_chunks(client: Any) -> Iterator[List[dict]]:
+    """
+    Yield the listed buckets in chunks of BUCKET_CHUNK.
+    """
+    for page in paginate(client, "list_buckets"):
+        buckets = page.get("Buckets", [])
+        for i in range(0, len(buckets), BUCKET_CHUNK):
+            yield buckets[i : i + BUCKET_CHUNK]
+
+
+def collect_buckets(client: Any, buckets: List[dict]) -> Iterator[List[dict]]:
+    """
+    Yield the S3Buckets entries of listed buckets, as one page.
+    """
+    yield [_bucket_record(client, bucket) for bucket in buckets]
+
+
+def collect_db_instances(client: Any) -> Iterator[List[dict]]:
+    """
+    Yield pages of RDSInstances entries. RDS exposes a DNS endpoint rather
+    than IP addresses, so the endpoint address is stored as the private IP.
+    """
+    for page in paginate(client, "describe_db_instances", MaxRecords=100):
+        records = []
+        for instance in page.get("DBInstances", []):
+            endpoint = instance.get("Endpoint", {})
+            records.append(
+                {
+                    "DBInstanceIdentifier": instance["DBInstanceIdentifier"],
+                    "DBInstanceClass": instance.get("DBInstanceClass", ""),
+                    "Engine": instance.get("Engine", ""),
+                    "PubliclyAccessible": instance.get("PubliclyAccessible", False),
+                    "StorageEncrypted": instance.get("StorageEncrypted", False),
+                    "DBPortNumber": endpoint.get(
+                        "Port", instance.get("DbInstancePort", 0)
+                    ),
+                    "PublicIp": None,
+                    "PrivateIp": endpoint.get("Address", ""),
+                }
+            )
+        yield records
+
+
+@autolog(__name__)
+@db.with_db_connection()
+def collect(
+    regions: Sequence[str] = (DEFAULT_REGION,),
+    accounts: Sequence[Optional[str]] = (None,),
+    client_factory: Optional[Callable] = None,
+    max_workers: int = MAX_WORKERS,
+    conn: Optional[sqlite3.Connection] = None,
+) -> dict:
+    """
+    Collect resources from every account and region into the database.
+
+    regions: Regions to collect EC2 and RDS from; S3 is collected once per
+        account from the first region
+    accounts: Role ARNs to assume, or None for the base credentials
+    client_factory: Callable(service, region, account) returning a client
+        (default: boto3_client_factory())
+    max_workers: Number of collection tasks run at once
+    conn (Optional): SQLite3 connection. Supplied by @with_db_connection() decorator
+
+    returns:
+        dict of per-type counts, inserted/updated/unchanged counts, pages,
+        elapsed seconds, rows/sec and the errors of the tasks that failed
+    """
+    start = time.perf_counter()
+    started = time.time()
+    previous = db.data_generation(conn=conn)
+    client_factory = client_factory or boto3_client_factory(max_workers)
+
+    tasks = []
+    for account in accounts:
+        tasks.append(("s3", regions[0], account))
+        for region in regions:
+            tasks.append(("ec2", region, account))
+            tasks.append(("rds", region, account))
+
+    pages = queue.Queue(maxsize=max_workers * 2)
+    stop = threading.Event()
+    done = object()
+    spawned = object()
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def emit(item: tuple) -> None:
+        # Gives up once collect() is leaving, so no worker stays blocked on a
+        # full queue that nobody reads any more.
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise _Stopped()
+
+    def list_buckets(client: Any, region: str, account: Optional[str]) -> Iterator:
+        # The lookups of each chunk are further tasks on the same pool,
+        # counted before they are submitted so they are waited for.
+        for buckets in bucket_chunks(client):
+            emit((spawned, None))
+            source = functools.partial(collect_buckets, client, buckets)
+            pool.submit(run, "s3", region, account, source)
+        yield from ()
+
+    def open_source(kind: str, region: str, account: Optional[str]) -> Iterator:
+        client = client_factory(kind, region, account)
+        if kind == "ec2":
+            return collect_security_groups(client)
+        if kind == "s3":
+            return list_buckets(client, region, account)
+        return collect_db_instances(client)
+
+    def run(kind: str, region: str, account: Optional[str], source: Callable) -> None:
+        error = None
+        try:
+            for records in source():
+                emit((kind, records))
+        except _Stopped:
+            return
+        except Exception as e:
+            logger.warning(
+                "Collecting %s from %s/%s failed: %s", kind, account, region, e
+            )
+            error = (kind, region, account, f"{type(e).__name__}: {e}")
+        try:
+            emit((done, error))
+        except _Stopped:
+            pass
+
+    counts = {kind: 0 for kind in INSERTERS}
+    changes = dict.fromkeys(db.CHANGE_COUNTS, 0)
+    errors = []
+    page_count = 0
+    try:
+        for task in tasks:
+            pool.submit(run, *task, functools.partial(open_source, *task))
+
+        remaining = len(tasks)
+        while remaining:
+            kind, records = pages.get()
+            if kind is spawned:
+                remaining += 1
+                continue
+            if kind is done:
+                remaining -= 1
+                if records is not None:
+                    kind, region, account, error = records
+                    errors.append(
+                        {
+                            "type": kind,
+                            "region": region,
+                            "account": account,
+                            "error": error,
+                        }
+                    )
+                continue
+            if records:
+                written = INSERTERS[kind](data=records, conn=conn)
+                # Commit per page: a collection can run for minutes, and
+                # holding the write lock that long would block uploads.
+                conn.commit()
+                for key in db.CHANGE_COUNTS:
+                    changes[key] += written[key]
+                counts[kind] += len(records)
+            page_count += 1
+    finally:
+        # On an error here, stop the workers rather than wait for tasks that
+        # can never hand over their pages.
+        stop.set()
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    # Recorded like an ingest_session() load, which also prunes the change log.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        db.record_scan(conn, previous, started)
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+    elapsed = time.perf_counter() - start
+    total = sum(counts.values())
+    stats = {
+        **counts,
+        "total": total,
+        **changes,
+        "pages": page_count,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": round(total / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+    logger.info(
+        "Collected %d resources in %d pages from %d tasks in %.3f seconds",
+        total,
+        page_count,
+        len(tasks),
+        elapsed,
+    )
+    return stats
@@ -5,51 +5,393 @@ Handles the creation, reading, and writing of data into the SQLite DB
 
 Usage of the with_db_connection() decorator defines a default path to
 data.db (which can be overwritten) and simplifies db connection management.
+Callers can also pick the file per call with a db_path= keyword argument.
+Connections are pooled per database file and reused across calls, with the
+WAL journal and cache PRAGMAS applied once when each connection is opened.
+
+Resources can also be kept in one database file per account,
+shard_path(account) under SHARD_DIR; see shards.py.
 
 All queries are parameterized, and where possible, executemany is used to
-limit the number of transactions.
+limit the number of transactions. The batch_insert_* functions take the raw
+resource dictionaries; the insert_*_rows functions take rows already built
+with ec2_row(), s3_row() and rds_row(), so parsing can happen elsewhere.
+None of them commit on a supplied connection: ingest_session() wraps a whole
+load of every resource type in one transaction.
+
+The schema is built by the numbered MIGRATIONS, applied once each and tracked
+in PRAGMA user_version, so setup_database() on an up-to-date database is a
+single PRAGMA read. Besides the tables, they create partial indexes
+(RULE_INDEXES) over the rows each rule predicate matches.
+
+The rules table is seeded once with DEFAULT_RULES, and any change to it bumps
+the 'rules_version' key in the flags table so compiled rulesets can be
+invalidated (see rule_engine.py). Likewise every batch insert that changes
+rows bumps the 'data_generation' key, which keys the cached results in result_cache.py.
+
+The writes that maintain the findings table also record every finding added,
+resolved or rescored in the finding_changes log, under the generation the
+write in progress will be committed as (the current one plus one). When bump_generation() moves to it, entries that cancelled out within
+the write are dropped, so the log answers "what changed since generation N"
+(see changes.py). Every ingest_session() also records a row in the scans table,
+and the log only keeps the changes of the last CHANGE_LOG_SCANS scans.
+
+Every resource row carries a content_hash of its values. The insert_*_rows
+functions look up the stored hashes of the rows they are given and only insert
+new rows and update changed ones, in place, so ids stay stable and re-loading
+an unchanged snapshot writes nothing. RESOURCE_COLUMNS lists the columns
+returned to API clients, which excludes the hash.
+
+EC2 IpPermissions are kept as JSON in ec2instances.ip_perms and also exploded
+into ec2permissions, one row per CIDR range with ports and addresses stored as
+integers, so rules can test them with plain comparisons that the
+ec2permissions_by_group index serves within each security group.
 
 """
 
+import contextlib
 import functools
+import hashlib
+import ipaddress
 import json
+import logging
+import os
+import queue
+import re
 import sqlite3
-from typing import Optional, Callable, List, Tuple, Any
+import threading
+import time
+from typing import Optional, Callable, Dict, Iterator, List, Tuple, Any
 from decorator import autolog
+import metrics
+
+logger = logging.getLogger(__name__)
+
+RESOURCE_COLUMNS = {
+    "ec2instances": (
+        "id",
+        "group_id",
+        "group_name",
+        "ip_perms",
+        "description",
+        "public_ip",
+        "private_ip",
+    ),
+    "s3buckets": (
+        "id",
+        "name",
+        "creation_date",
+        "public_access",
+        "encryption",
+        "logging_enabled",
+    ),
+    "rdsinstances": (
+        "id",
+        "db_name",
+        "db_instance_type",
+        "db_software",
+        "public_access",
+        "encryption",
+        "db_portnumber",
+        "public_ip",
+        "private_ip",
+    ),
+}
+# Leading columns of each row built by ec2_row(), s3_row() and rds_row() that
+# identify the resource.
+RESOURCE_KEYS = {
+    "ec2instances": ("group_id",),
+    "s3buckets": ("name", "creation_date"),
+    "rdsinstances": ("db_name",),
+}
+CHANGE_COUNTS = ("inserted", "updated", "unchanged")
+
+# (index, table, columns, predicate) for the rule predicates of DEFAULT_RULES.
+# The predicate has to match the rule's text for SQLite to use the index, and
+# the columns are the ruleset's group_by so grouped rule queries need no sort.
+RULE_INDEXES = (
+    (
+        "s3buckets_public_access",
+        "s3buckets",
+        "name, creation_date",
+        "public_access = 1",
+    ),
+    (
+        "s3buckets_encryption_disabled",
+        "s3buckets",
+        "name, creation_date",
+        "encryption = 0",
+    ),
+    (
+        "s3buckets_logging_disabled",
+        "s3buckets",
+        "name, creation_date",
+        "logging_enabled = 0",
+    ),
+    ("rdsinstances_public_access", "rdsinstances", "db_name", "public_access = 1"),
+    ("rdsinstances_encryption_disabled", "rdsinstances", "db_name", "encryption = 0"),
+    (
+        "ec2instances_public_ip",
+        "ec2instances",
+        "group_id, group_name",
+        "public_ip IS NOT NULL",
+    ),
+)
+LOOKUP_CHUNK = 500
+# Scans whose finding changes are kept; older ones are pruned by record_scan().
+CHANGE_LOG_SCANS = 100
+
+SHARD_DIR = os.environ.get("CLOUDSCANNER_SHARD_DIR", "shards")
+ACCOUNT_NAME = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]{0,63}")
+
+# SSH, Telnet, RDP and WinRM
+ADMIN_PORTS = (22, 23, 3389, 5985, 5986)
+
+# An admin port open to a /8 or wider IPv4 range (16777216 addresses), or to
+# ::/0 through /8 for IPv6.
+INSECURE_CIDR_RANGE = (
+    "EXISTS permissions (prefix_len <= 8 AND protocol IN ('tcp', '6', '-1') AND ("
+    + " OR ".join(f"from_port <= {port} AND to_port >= {port}" for port in ADMIN_PORTS)
+    + "))"
+)
+
+# (rule_name, resource_table, condition_field, condition_value, risk_score,
+# remediation_steps). With no condition_field, condition_value is a rule_dsl
+# expression (see rule_engine.py).
+DEFAULT_RULES: List[Tuple[str, str, Optional[str], str, int, str]] = [
+    (
+        "PublicAccessEnabled",
+        "s3buckets",
+        None,
+        "public_access = 1",
+        1,
+        "Block public access on the bucket.",
+    ),
+    (
+        "EncryptionDisabled",
+        "s3buckets",
+        None,
+        "encryption = 0",
+        1,
+        "Enable default encryption on the bucket.",
+    ),
+    (
+        "LoggingDisabled",
+        "s3buckets",
+        None,
+        "logging_enabled = 0",
+        1,
+        "Enable server access logging on the bucket.",
+    ),
+    (
+        "PublicIPExposure",
+        "ec2instances",
+        None,
+        "public_ip IS NOT NULL",
+        1,
+        "Remove the public IP or place the instance behind a load balancer.",
+    ),
+    (
+        "InsecureCIDRRange",
+        "ec2instances",
+        None,
+        INSECURE_CIDR_RANGE,
+        1,
+        "Restrict security group ingress to known CIDR ranges.",
+    ),
+    (
+        "PublicAccessEnabled",
+        "rdsinstances",
+        None,
+        "public_access = 1",
+        1,
+        "Disable public accessibility on the instance.",
+    ),
+    (
+        "EncryptionDisabled",
+        "rdsinstances",
+        None,
+        "encryption = 0",
+        1,
+        "Enable storage encryption on the instance.",
+    ),
+]
+
+# condition_field and condition_value of DEFAULT_RULES as first seeded, when
+# the rules only weighted predicates that were hard-coded in rule_runner.py.
+LEGACY_CONDITIONS = {
+    ("PublicAccessEnabled", "s3buckets"): ("public_access", "1"),
+    ("EncryptionDisabled", "s3buckets"): ("encryption", "0"),
+    ("LoggingDisabled", "s3buckets"): ("logging_enabled", "0"),
+    ("PublicIPExposure", "ec2instances"): ("public_ip", "!=NULL"),
+    ("InsecureCIDRRange", "ec2instances"): ("ip_perms", "!=[]"),
+    ("PublicAccessEnabled", "rdsinstances"): ("public_access", "1"),
+    ("EncryptionDisabled", "rdsinstances"): ("encryption", "0"),
+}
+
+
+PRAGMAS: List[Tuple[str, Any]] = [
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("cache_size", -64000),
+    ("mmap_size", 256 * 1024 * 1024),
+    ("busy_timeout", 5000),
+    ("temp_store", "MEMORY"),
+]
+
+# Applied by ingest_session(bulk=True) for the length of the load, and reset
+# to PRAGMAS afterwards. A crash during the load can lose the transaction but
+# not corrupt the database, as the WAL is still used.
+BULK_PRAGMAS = [
+    ("synchronous", "OFF"),
+    ("cache_size", -256000),
+]
+
+# Secondary indexes only used by reads. ingest_session(bulk=True) drops them
+# for the load and rebuilds them once, in the same transaction, instead of
+# updating them row by row.
+DEFERRED_INDEXES = (
+    "findings_by_score",
+    "findings_by_violation",
+) + tuple(index[0] for index in RULE_INDEXES)
+
+
+class ConnectionPool:
+    """
+    Pool of idle connections to one database file.
+
+    Connections are created on demand, configured with PRAGMAS once, and
+    handed back to the pool after each call instead of being closed. WAL
+    journaling lets readers proceed while an ingest is writing.
+    """
+
+    def __init__(self, db_path: str, max_idle: int = 8):
+        self.db_path = db_path
+        self._idle = queue.LifoQueue(maxsize=max_idle)
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        for pragma, value in PRAGMAS:
+            conn.execute(f"PRAGMA {pragma} = {value}")
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self.connect()
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.row_factory = None
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def shard_path(account: Optional[str]) -> str:
+    """
+    Database file of an account: SHARD_DIR/<account>.db, or data.db for None.
+
+    Raises:
+        ValueError: if the account is not a valid ACCOUNT_NAME
+    """
+    if account is None:
+        return "data.db"
+    if not ACCOUNT_NAME.fullmatch(str(account)):
+        raise ValueError(f"Invalid account: {account}")
+    return os.path.join(SHARD_DIR, f"{account}.db")
+
+
+def shard_accounts() -> List[str]:
+    """
+    Accounts with a database file in SHARD_DIR, sorted.
+    """
+    try:
+        names = os.listdir(SHARD_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted(
+        name[:-3]
+        for name in names
+        if name.endswith(".db") and ACCOUNT_NAME.fullmatch(name[:-3])
+    )
+
+
+def get_pool(db_path: str = "data.db") -> ConnectionPool:
+    """
+    Get the connection pool for a database file, creating it on first use.
+    """
+    key = os.path.abspath(db_path)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(key, ConnectionPool(key))
+    return pool
+
+
+def close_pools() -> None:
+    """
+    Close every idle pooled connection.
+    """
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
 
 
 @autolog(__name__)
 def with_db_connection(db_path: str = "data.db") -> Callable:
     """
-    Open new connection if not already supplied.
+    Borrow a pooled connection if one is not already supplied.
+
+    The call runs inside the connection's context manager, committing on
+    success and rolling back on error, before the connection is returned to
+    the pool. A db_path= keyword argument on the call overrides db_path.
     """
 
     def decorator(func: Callable) -> Callable:
         @functools.wraps(func)
         def wrapper_decorator(*args: Any, **kwargs: Any) -> Any:
+            path = kwargs.pop("db_path", db_path)
 
             conn = kwargs.get("conn")
             if conn is not None and isinstance(conn, sqlite3.Connection):
                 return func(*args, **kwargs)
 
-            with sqlite3.connect(db_path) as conn:
-                kwargs["conn"] = conn
-                return func(*args, **kwargs)
+            pool = get_pool(path)
+            conn = pool.acquire()
+            try:
+                with conn:
+                    kwargs["conn"] = conn
+                    return func(*args, **kwargs)
+            finally:
+                pool.release(conn)
 
         return wrapper_decorator
 
     return decorator
 
 
-@autolog(__name__)
-@with_db_connection()
-def setup_database(conn: Optional[sqlite3.Connection] = None) -> None:
+def _base_schema(conn: sqlite3.Connection) -> None:
     """
-    Sets up the database and associated tables.
+    Resource, flags and rules tables, as created before schema versioning.
 
-    Args:
-        conn (sqlite3.Connection, optional): An existing database
-        connection. If not provided, a new connection will be created.
+    Every statement is idempotent, so databases created by earlier releases
+    (user_version 0) are brought up to date in place.
     """
     cursor = conn.cursor()
     cursor.execute(
@@ -62,11 +404,11 @@ def setup_database(conn: Optional[sqlite3.Connection] = None) -> None:
             description TEXT NOT NULL,
             public_ip TEXT,
             private_ip TEXT NOT NULL,
+            content_hash BLOB,
             UNIQUE(group_id)
         )
     """
     )
-    conn.commit()
     cursor.execute(
         """
         CREATE TABLE IF NOT EXISTS s3buckets (
@@ -76,11 +418,11 @@ def setup_database(conn: Optional[sqlite3.Connection] = None) -> None:
             public_access BOOLEAN NOT NULL,
             encryption BOOLEAN NOT NULL,
             logging_enabled BOOLEAN NOT NULL,
+            content_hash BLOB,
             UNIQUE(name, creation_date)
         )
     """
     )
-    conn.commit()
     cursor.execute(
         """
         CREATE TABLE IF NOT EXISTS rdsinstances (
@@ -93,11 +435,70 @@ def setup_database(conn: Optional[sqlite3.Connection] = None) -> None:
             db_portnumber INT NOT NULL,
             public_ip TEXT,
             private_ip TEXT NOT NULL,
+            content_hash BLOB,
             UNIQUE(db_name)
         )
     """
     )
-    conn.commit()
+    # Databases created before change detection get the column added; their
+    # rows are rewritten once, on the first load that includes them.
+    for table in RESOURCE_COLUMNS:
+        cursor.execute(f"PRAGMA table_info({table})")
+        if "content_hash" not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN content_hash BLOB")
+        # Rows changed outside write_changes() keep no hash, so the next load
+        # rewrites them instead of skipping them as unchanged.
+        cursor.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_content_hash_reset
+            AFTER UPDATE ON {table}
+            WHEN NEW.content_hash IS OLD.content_hash AND NEW.content_hash IS NOT NULL
+            BEGIN
+                UPDATE {table} SET content_hash = NULL WHERE id = NEW.id;
+            END
+            """
+        )
+
+    cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ec2permissions'"
+    )
+    backfill_permissions = cursor.fetchone() is None
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ec2permissions (
+            id INTEGER PRIMARY KEY,
+            group_id TEXT NOT NULL,
+            protocol TEXT NOT NULL,
+            from_port INT NOT NULL,
+            to_port INT NOT NULL,
+            family INT NOT NULL,
+            prefix_len INT NOT NULL,
+            cidr_start INT,
+            cidr_end INT
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS ec2permissions_by_group
+        ON ec2permissions (group_id, prefix_len, protocol, from_port, to_port)
+        """
+    )
+    if backfill_permissions:
+        cursor.execute("SELECT group_id, ip_perms FROM ec2instances")
+        conn.executemany(
+            """
+            INSERT INTO ec2permissions (group_id, protocol, from_port, to_port, family, prefix_len, cidr_start, cidr_end)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                permission
+                for group_id, ip_perms in cursor
+                for permission in explode_ip_permissions(
+                    group_id, json.loads(ip_perms or "[]")
+                )
+            ),
+        )
 
     cursor.execute(
         """
@@ -122,104 +523,796 @@ def setup_database(conn: Optional[sqlite3.Connection] = None) -> None:
         )
         """
     )
+
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        cursor.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS rules_version_{event.lower()}
+            AFTER {event} ON rules
+            BEGIN
+                INSERT INTO flags (key, value) VALUES ('rules_version', 1)
+                ON CONFLICT(key) DO UPDATE SET value = value + 1;
+            END
+            """
+        )
+
+    cursor.execute("SELECT 1 FROM flags WHERE key = 'rules_seeded'")
+    if cursor.fetchone() is None:
+        cursor.executemany(
+            """
+            INSERT INTO rules (rule_name, resource_table, condition_field, condition_value, risk_score, remediation_steps)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            DEFAULT_RULES,
+        )
+        cursor.execute("INSERT INTO flags (key, value) VALUES ('rules_seeded', 1)")
+
+
+def _rule_indexes(conn: sqlite3.Connection) -> None:
+    """
+    Partial indexes on the rows each rule predicate matches, so a rule query
+    reads only the violating rows instead of scanning the table.
+    """
+    for name, table, columns, predicate in RULE_INDEXES:
+        conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns}) WHERE {predicate}"
+        )
+
+
+def _findings_table(conn: sqlite3.Connection) -> None:
+    """
+    Materialized findings (see findings.py).
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS findings (
+            resource_table TEXT NOT NULL,
+            resource_id INTEGER NOT NULL,
+            violation TEXT NOT NULL,
+            score INTEGER NOT NULL,
+            PRIMARY KEY (resource_table, resource_id, violation)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS findings_by_score
+        ON findings (resource_table, score DESC, resource_id)
+        """
+    )
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS findings_by_violation
+        ON findings (resource_table, violation, resource_id)
+        """
+    )
+
+
+def _change_log(conn: sqlite3.Connection) -> None:
+    """
+    Log of finding changes and the scans that made them, appended to by every
+    write and pruned by prune_changes().
+
+    old_score is NULL for a finding that did not exist before, new_score is
+    NULL for one that was resolved. The entries are written by the findings
+    triggers and recompute_findings() (see findings.py) under the next
+    generation, which bump_generation() makes current at the end of the write.
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS finding_changes (
+            generation INTEGER NOT NULL,
+            resource_table TEXT NOT NULL,
+            resource_id INTEGER NOT NULL,
+            violation TEXT NOT NULL,
+            old_score INTEGER,
+            new_score INTEGER,
+            PRIMARY KEY (generation, resource_table, resource_id, violation)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS scans (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            generation INTEGER NOT NULL,
+            previous_generation INTEGER NOT NULL,
+            started REAL NOT NULL,
+            finished REAL NOT NULL,
+            finding_changes INTEGER NOT NULL
+        )
+        """
+    )
+    # Changes made before the log existed are unknown.
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO flags (key, value)
+        SELECT 'change_log_start', COALESCE(
+            (SELECT value FROM flags WHERE key = 'data_generation'), 0)
+        """
+    )
+
+
+def _expression_rules(conn: sqlite3.Connection) -> None:
+    """
+    Rewrite the rules seeded with LEGACY_CONDITIONS, and left unchanged since,
+    into the expressions of DEFAULT_RULES, which now decide what is flagged.
+    """
+    conn.executemany(
+        """
+        UPDATE rules SET condition_field = NULL, condition_value = ?
+        WHERE rule_name = ? AND resource_table = ?
+        AND condition_field = ? AND condition_value = ?
+        """,
+        (
+            (value, name, table) + LEGACY_CONDITIONS[(name, table)]
+            for name, table, _, value, _, _ in DEFAULT_RULES
+        ),
+    )
+
+
+def _drop_range_index(conn: sqlite3.Connection) -> None:
+    """
+    Drop the ec2permissions (cidr_start, cidr_end) index: rules look up the
+    permissions of one group by ec2permissions_by_group, so nothing read it.
+    """
+    conn.execute("DROP INDEX IF EXISTS ec2permissions_by_range")
+
+
+# Applied in order, each exactly once; the number of migrations applied is the
+# database's PRAGMA user_version. Only ever append to this list.
+MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _base_schema,
+    _rule_indexes,
+    _findings_table,
+    _change_log,
+    _expression_rules,
+    _drop_range_index,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+BULK_LOAD_HOOKS: List[Tuple[str, Callable[[sqlite3.Connection], None]]] = []
+
+
+def register_bulk_load_hook(
+    triggers: str, after_load: Callable[[sqlite3.Connection], None]
+) -> None:
+    """
+    Have ingest_session(bulk=True) drop the triggers whose names match the
+    LIKE pattern for the load, recreate them at the end and then call
+    after_load(conn) to bring whatever they maintain up to date in one pass.
+    """
+    BULK_LOAD_HOOKS.append((triggers, after_load))
+
+
+@contextlib.contextmanager
+def ingest_session(
+    bulk: bool = False, db_path: str = "data.db"
+) -> Iterator[sqlite3.Connection]:
+    """
+    Load resources of every type in one transaction on one connection.
+
+    The insert_*_rows and batch_insert_* functions do not commit, so every
+    write made with the yielded connection lands together when the block
+    exits, or is rolled back if it raises.
+
+    with ingest_session() as conn:
+        batch_insert_ec2(ec2, conn=conn)
+        batch_insert_s3(s3, conn=conn)
+
+    bulk: Use the bulk profile: BULK_PRAGMAS during the load, DEFERRED_INDEXES
+        and the triggers of BULK_LOAD_HOOKS rebuilt once at the end, then
+        ANALYZE. Worth it for large loads; for small ones rebuilding costs
+        more than it saves.
+    db_path: Database file
+    """
+    pool = get_pool(db_path)
+    conn = pool.acquire()
+    try:
+        if bulk:
+            for pragma, value in BULK_PRAGMAS:
+                conn.execute(f"PRAGMA {pragma} = {value}")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            started = time.time()
+            previous = data_generation(conn=conn)
+            indexes, triggers = [], []
+            if bulk:
+                placeholders = ", ".join("?" * len(DEFERRED_INDEXES))
+                indexes = conn.execute(
+                    f"SELECT name, sql FROM sqlite_master "
+                    f"WHERE type = 'index' AND name IN ({placeholders})",
+                    DEFERRED_INDEXES,
+                ).fetchall()
+                for name, _ in indexes:
+                    conn.execute(f"DROP INDEX {name}")
+                for pattern, _ in BULK_LOAD_HOOKS:
+                    matched = conn.execute(
+                        "SELECT name, sql FROM sqlite_master "
+                        "WHERE type = 'trigger' AND name LIKE ?",
+                        (pattern,),
+                    ).fetchall()
+                    for name, _ in matched:
+                        conn.execute(f"DROP TRIGGER {name}")
+                    triggers.extend(matched)
+
+            yield conn
+
+            if bulk:
+                for _, sql in triggers:
+                    conn.execute(sql)
+                for _, after_load in BULK_LOAD_HOOKS:
+                    after_load(conn)
+                for _, sql in indexes:
+                    conn.execute(sql)
+                conn.execute("ANALYZE")
+            record_scan(conn, previous, started)
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+    finally:
+        if bulk:
+            for pragma, value in PRAGMAS:
+                if pragma in dict(BULK_PRAGMAS):
+                    conn.execute(f"PRAGMA {pragma} = {value}")
+        pool.release(conn)
+
+
+def with_ingest_session(db_path: str = "data.db") -> Callable:
+    """
+    Like with_db_connection(), but runs the call in an ingest_session(), with
+    the bulk profile if it is called with bulk=True.
+    """
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper_decorator(*args: Any, **kwargs: Any) -> Any:
+            path = kwargs.pop("db_path", db_path)
+
+            conn = kwargs.get("conn")
+            if conn is not None and isinstance(conn, sqlite3.Connection):
+                return func(*args, **kwargs)
+
+            with ingest_session(kwargs.get("bulk", False), path) as conn:
+                kwargs["conn"] = conn
+                return func(*args, **kwargs)
+
+        return wrapper_decorator
+
+    return decorator
+
+
+@autolog(__name__)
+@with_db_connection()
+def setup_database(conn: Optional[sqlite3.Connection] = None) -> None:
+    """
+    Sets up the database and associated tables by applying any pending
+    MIGRATIONS. A database already at SCHEMA_VERSION is left untouched.
+
+    Args:
+        conn (sqlite3.Connection, optional): An existing database
+        connection. If not provided, a new connection will be created.
+    """
+    if schema_version(conn) >= SCHEMA_VERSION:
+        return
+
     conn.commit()
+    # Taking the write lock before re-reading the version keeps two processes
+    # starting at once from applying the same migration twice.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        current = schema_version(conn)
+        for number, migration in enumerate(MIGRATIONS[current:], start=current + 1):
+            logger.info("Applying migration %d: %s", number, migration.__name__)
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+def invalid_entry(d: Any, error: Exception) -> ValueError:
+    """
+    The ValueError for a resource entry a *_row() function failed to read.
+    """
+    if isinstance(d, dict):
+        return ValueError(f"entry is missing {error}")
+    return ValueError(f"entry must be an object, not {type(d).__name__}")
+
+
+def ec2_row(d: dict) -> tuple:
+    """
+    Convert an EC2Instances entry into an ec2instances row.
+
+    Raises:
+        ValueError: if the entry is not an object or lacks a field
+    """
+    try:
+        return (
+            d["GroupId"],
+            d["GroupName"],
+            json.dumps(d["IpPermissions"]),
+            d["Description"],
+            d["PublicIp"],
+            d["PrivateIp"],
+        )
+    except (KeyError, TypeError) as e:
+        raise invalid_entry(d, e) from None
+
+
+def s3_row(d: dict) -> tuple:
+    """
+    Convert an S3Buckets entry into an s3buckets row.
+
+    Raises:
+        ValueError: if the entry is not an object or lacks a field
+    """
+    try:
+        return (
+            d["Name"],
+            d["CreationDate"],
+            d["PublicAccess"],
+            d["Encrypted"],
+            d["LoggingEnabled"],
+        )
+    except (KeyError, TypeError) as e:
+        raise invalid_entry(d, e) from None
+
+
+def rds_row(d: dict) -> tuple:
+    """
+    Convert an RDSInstances entry into an rdsinstances row.
+
+    Raises:
+        ValueError: if the entry is not an object or lacks a field
+    """
+    try:
+        return (
+            d["DBInstanceIdentifier"],
+            d["DBInstanceClass"],
+            d["Engine"],
+            d["PubliclyAccessible"],
+            d["StorageEncrypted"],
+            d["DBPortNumber"],
+            d["PublicIp"],
+            d["PrivateIp"],
+        )
+    except (KeyError, TypeError) as e:
+        raise invalid_entry(d, e) from None
 
 
 @autolog(__name__)
 @with_db_connection()
 def batch_insert_ec2(
     data: List[dict], conn: Optional[sqlite3.Connection] = None
-) -> bool:
+) -> dict:
     """
     Batch insert ec2 entries into SQLite DB table 'ec2instances'
 
     data: List of dictionaries containing EC2 instances
     conn (Optional): SQLite3 connection. Supplied by @with_db_connection() decorator
+
+    returns:
+        dict of inserted, updated and unchanged counts
     """
-    cursor = conn.cursor()
-    cursor.executemany(
-        """
-        INSERT OR REPLACE INTO ec2instances (group_id, group_name, ip_perms, description, public_ip, private_ip)
-        VALUES (?, ?, ?, ?, ?, ?)
-        """,
-        [
-            (
-                d["GroupId"],
-                d["GroupName"],
-                json.dumps(d["IpPermissions"]),
-                d["Description"],
-                d["PublicIp"],
-                d["PrivateIp"],
-            )
-            for d in data
-        ],
+    return insert_ec2_rows(
+        [ec2_row(d) for d in data],
+        [explode_ip_permissions(d["GroupId"], d["IpPermissions"]) for d in data],
+        conn=conn,
     )
-    conn.commit()
 
 
 @autolog(__name__)
 @with_db_connection()
 def batch_insert_s3(
     data: List[dict], conn: Optional[sqlite3.Connection] = None
-) -> bool:
+) -> dict:
     """
     Batch insert s3 bucket entries into SQLite DB table 's3buckets'
 
     data: List of dictionaries containing S3 Bucket entries
     conn (Optional): SQLite3 connection. Supplied by @with_db_connection() decorator
+
+    returns:
+        dict of inserted, updated and unchanged counts
     """
-    cursor = conn.cursor()
-    cursor.executemany(
-        """
-        INSERT OR REPLACE INTO s3buckets (name, creation_date, public_access, encryption, logging_enabled)
-        VALUES (?, ?, ?, ?, ?)
-        """,
-        [
-            (
-                d["Name"],
-                d["CreationDate"],
-                d["PublicAccess"],
-                d["Encrypted"],
-                d["LoggingEnabled"],
-            )
-            for d in data
-        ],
-    )
-    conn.commit()
+    return insert_s3_rows([s3_row(d) for d in data], conn=conn)
 
 
 @autolog(__name__)
 @with_db_connection()
 def batch_insert_rds(
     data: List[dict], conn: Optional[sqlite3.Connection] = None
-) -> bool:
+) -> dict:
     """
     Batch insert RDS entries into SQLite DB table 'rdsinstances'
 
     data: List of dictionaries containing RDS instances
     conn (Optional): SQLite3 connection. Supplied by @with_db_connection() decorator
+
+    returns:
+        dict of inserted, updated and unchanged counts
     """
-    cursor = conn.cursor()
-    cursor.executemany(
+    return insert_rds_rows([rds_row(d) for d in data], conn=conn)
+
+
+def content_hash(row: tuple) -> bytes:
+    """
+    Hash of a row built by ec2_row(), s3_row() or rds_row(), with booleans
+    hashed as the integers SQLite stores them as.
+    """
+    values = [int(value) if isinstance(value, bool) else value for value in row]
+    return hashlib.blake2b(json.dumps(values).encode(), digest_size=16).digest()
+
+
+def stored_hashes(
+    table: str, keys: List[tuple], conn: sqlite3.Connection
+) -> Dict[tuple, bytes]:
+    """
+    Look up the content hashes of the rows with the given keys.
+
+    returns:
+        dict of key -> content_hash for the keys that exist
+    """
+    key_columns = RESOURCE_KEYS[table]
+    wanted = set(keys)
+    hashes = {}
+    first = list(dict.fromkeys(key[0] for key in keys))
+    for i in range(0, len(first), LOOKUP_CHUNK):
+        chunk = first[i : i + LOOKUP_CHUNK]
+        for row in conn.execute(
+            f"SELECT {', '.join(key_columns)}, content_hash FROM {table} "
+            f"WHERE {key_columns[0]} IN ({', '.join('?' * len(chunk))})",
+            chunk,
+        ):
+            if row[:-1] in wanted:
+                hashes[row[:-1]] = row[-1]
+    return hashes
+
+
+def classify_changes(
+    table: str, rows: List[tuple], conn: sqlite3.Connection
+) -> Tuple[List[tuple], List[tuple], dict]:
+    """
+    Split rows into new and changed ones by comparing content hashes with the
+    stored ones. When the same resource appears more than once, its last row
+    wins.
+
+    table: ec2instances, s3buckets or rdsinstances
+    rows: Rows built by the matching *_row() function
+    conn: SQLite3 connection of the write being made
+
+    returns:
+        (INSERT parameters, UPDATE parameters, dict of inserted, updated and
+        unchanged counts)
+    """
+    width = len(RESOURCE_KEYS[table])
+    latest = {row[:width]: row for row in rows}
+    existing = stored_hashes(table, list(latest), conn)
+
+    inserts, updates = [], []
+    for key, row in latest.items():
+        digest = content_hash(row)
+        if key not in existing:
+            inserts.append(row + (digest,))
+        elif existing[key] != digest:
+            updates.append(row[width:] + (digest,) + key)
+
+    counts = {
+        "inserted": len(inserts),
+        "updated": len(updates),
+        "unchanged": len(rows) - len(inserts) - len(updates),
+    }
+    return inserts, updates, counts
+
+
+def write_changes(
+    table: str,
+    inserts: List[tuple],
+    updates: List[tuple],
+    conn: sqlite3.Connection,
+) -> None:
+    """
+    Write the rows classify_changes() found new or changed, updating changed
+    rows in place so their ids are kept, and bump the data generation if
+    anything was written.
+    """
+    key_columns = RESOURCE_KEYS[table]
+    columns = RESOURCE_COLUMNS[table][1:] + ("content_hash",)
+    if inserts:
+        conn.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) "
+            f"VALUES ({', '.join('?' * len(columns))})",
+            inserts,
+        )
+    if updates:
+        conn.executemany(
+            f"UPDATE {table} SET "
+            f"{', '.join(f'{column} = ?' for column in columns[len(key_columns):])} "
+            f"WHERE {' AND '.join(f'{column} = ?' for column in key_columns)}",
+            updates,
+        )
+    if inserts or updates:
+        bump_generation(conn)
+
+
+@with_db_connection()
+def insert_ec2_rows(
+    rows: List[tuple],
+    permissions: List[List[tuple]],
+    conn: Optional[sqlite3.Connection] = None,
+) -> dict:
+    """
+    Insert or update rows built by ec2_row() and rewrite the
+    explode_ip_permissions() rows of the groups that changed.
+
+    When a group appears more than once, its last row wins, and only that
+    row's permissions are written.
+
+    rows: ec2instances rows
+    permissions: ec2permissions rows of each row, in the same order as rows
+    conn (Optional): SQLite3 connection. Supplied by @with_db_connection() decorator
+
+    returns:
+        dict of inserted, updated and unchanged counts
+    """
+    inserts, updates, counts = classify_changes("ec2instances", rows, conn)
+    changed = {row[0] for row in inserts} | {row[-1] for row in updates}
+    # Permissions are written first so the findings triggers on ec2instances
+    # see the new permissions of the group.
+    if changed:
+        latest = {row[0]: group for row, group in zip(rows, permissions)}
+        conn.executemany(
+            "DELETE FROM ec2permissions WHERE group_id = ?",
+            [(group_id,) for group_id in changed],
+        )
+        conn.executemany(
+            """
+            INSERT INTO ec2permissions (group_id, protocol, from_port, to_port, family, prefix_len, cidr_start, cidr_end)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [permission for group_id in changed for permission in latest[group_id]],
+        )
+    write_changes("ec2instances", inserts, updates, conn)
+    metrics.add_rows("insert.ec2instances", len(rows))
+    return counts
+
+
+@with_db_connection()
+def insert_s3_rows(
+    rows: List[tuple], conn: Optional[sqlite3.Connection] = None
+) -> dict:
+    """
+    Insert or update rows built by s3_row().
+
+    rows: s3buckets rows
+    conn (Optional): SQLite3 connection. Supplied by @with_db_connection() decorator
+
+    returns:
+        dict of inserted, updated and unchanged counts
+    """
+    inserts, updates, counts = classify_changes("s3buckets", rows, conn)
+    write_changes("s3buckets", inserts, updates, conn)
+    metrics.add_rows("insert.s3buckets", len(rows))
+    return counts
+
+
+@with_db_connection()
+def insert_rds_rows(
+    rows: List[tuple], conn: Optional[sqlite3.Connection] = None
+) -> dict:
+    """
+    Insert or update rows built by rds_row().
+
+    rows: rdsinstances rows
+    conn (Optional): SQLite3 connection. Supplied by @with_db_connection() decorator
+
+    returns:
+        dict of inserted, updated and unchanged counts
+    """
+    inserts, updates, counts = classify_changes("rdsinstances", rows, conn)
+    write_changes("rdsinstances", inserts, updates, conn)
+    metrics.add_rows("insert.rdsinstances", len(rows))
+    return counts
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_cidr(cidr: Any) -> Optional[Tuple[int, int, Optional[int], Optional[int]]]:
+    """
+    Parse a CIDR block into (family, prefix_len, cidr_start, cidr_end), or
+    None if it is not valid. Cached, as the same blocks recur across groups.
+    """
+    try:
+        network = ipaddress.ip_network(cidr, strict=False)
+    except (TypeError, ValueError):
+        return None
+    if network.version == 4:
+        start = int(network.network_address)
+        end = int(network.broadcast_address)
+    else:
+        start = end = None
+    return network.version, network.prefixlen, start, end
+
+
+def explode_ip_permissions(group_id: str, ip_permissions: List[dict]) -> List[tuple]:
+    """
+    Flatten a security group's IpPermissions into ec2permissions rows.
+
+    Every IPv4 and IPv6 range of every permission becomes one row. IPv4 ranges
+    are stored as the integer first and last address so containment and width
+    checks are plain range predicates; IPv6 addresses do not fit in an SQLite
+    integer, so only their prefix length is kept. A protocol of -1 (all
+    traffic) has no ports and is stored as 0-65535. Ranges that are not valid
+    CIDR blocks are skipped.
+
+    group_id (str): GroupId the permissions belong to
+    ip_permissions (list): IpPermissions as returned by describe_security_groups
+
+    Returns:
+        list of (group_id, protocol, from_port, to_port, family, prefix_len,
+        cidr_start, cidr_end) tuples
+
+    Raises:
+        ValueError: if ip_permissions is not a list of objects
+    """
+    rows = []
+    try:
+        for permission in ip_permissions or []:
+            protocol = str(permission.get("IpProtocol", "-1")).lower()
+            from_port = permission.get("FromPort")
+            to_port = permission.get("ToPort")
+            if protocol == "-1" or from_port is None:
+                from_port, to_port = 0, 65535
+            cidrs = [r.get("CidrIp") for r in permission.get("IpRanges", [])]
+            cidrs += [r.get("CidrIpv6") for r in permission.get("Ipv6Ranges", [])]
+            for cidr in cidrs:
+                parsed = parse_cidr(cidr)
+                if parsed is not None:
+                    rows.append((group_id, protocol, from_port, to_port) + parsed)
+    except (AttributeError, TypeError):
+        raise ValueError("IpPermissions must be a list of objects") from None
+    return rows
+
+
+def bump_generation(conn: sqlite3.Connection) -> None:
+    """
+    Increment the 'data_generation' flag. Called by write_changes() inside
+    the transaction of any write that changed rows, so cached results keyed
+    on the previous generation are no longer served. The finding changes
+    logged under the new generation become visible with it.
+
+    conn: SQLite3 connection of the write being made
+    """
+    settle_changes(conn)
+    conn.execute(
+        """
+        INSERT INTO flags (key, value) VALUES ('data_generation', 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1
+        """
+    )
+
+
+def settle_changes(conn: sqlite3.Connection) -> bool:
+    """
+    Drop the finding changes of the write in progress that cancelled out, such
+    as a finding deleted and inserted again with the same score.
+
+    returns:
+        whether any changes are left
+    """
+    generation = data_generation(conn=conn) + 1
+    conn.execute(
+        "DELETE FROM finding_changes WHERE generation = ? AND old_score IS new_score",
+        (generation,),
+    )
+    return (
+        conn.execute(
+            "SELECT 1 FROM finding_changes WHERE generation = ? LIMIT 1", (generation,)
+        ).fetchone()
+        is not None
+    )
+
+
+def record_scan(conn: sqlite3.Connection, previous: int, started: float) -> int:
+    """
+    Record a load in the scans table, at the end of its transaction. Finding
+    changes made after the load's last bump_generation(), such as those of
+    the bulk load hooks, get a generation of their own.
+
+    previous: Data generation when the load started
+    started: time.time() when the load started
+
+    returns:
+        data generation the load ended at
+    """
+    if settle_changes(conn):
+        bump_generation(conn)
+    generation = data_generation(conn=conn)
+    changes = conn.execute(
+        "SELECT COUNT(*) FROM finding_changes WHERE generation > ?", (previous,)
+    ).fetchone()[0]
+    conn.execute(
         """
-        INSERT OR REPLACE INTO rdsinstances (db_name, db_instance_type, db_software, public_access, encryption, db_portnumber, public_ip, private_ip)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        INSERT INTO scans
+            (generation, previous_generation, started, finished, finding_changes)
+        VALUES (?, ?, ?, ?, ?)
         """,
-        [
-            (
-                d["DBInstanceIdentifier"],
-                d["DBInstanceClass"],
-                d["Engine"],
-                d["PubliclyAccessible"],
-                d["StorageEncrypted"],
-                d["DBPortNumber"],
-                d["PublicIp"],
-                d["PrivateIp"],
-            )
-            for d in data
-        ],
+        (generation, previous, started, time.time(), changes),
     )
-    conn.commit()
+    prune_changes(conn, CHANGE_LOG_SCANS)
+    return generation
+
+
+def prune_changes(conn: sqlite3.Connection, keep: int) -> None:
+    """
+    Drop the scans older than the last keep and the finding changes made
+    before them, and move the 'change_log_start' flag up to where the log now
+    starts, so diffs from an earlier generation are refused.
+
+    keep: Number of scans to keep the changes of
+    """
+    row = conn.execute(
+        "SELECT id, previous_generation FROM scans ORDER BY id DESC LIMIT 1 OFFSET ?",
+        (keep - 1,),
+    ).fetchone()
+    if row is None:
+        return
+    oldest, start = row
+    conn.execute("DELETE FROM scans WHERE id < ?", (oldest,))
+    conn.execute("DELETE FROM finding_changes WHERE generation <= ?", (start,))
+    conn.execute(
+        """
+        UPDATE flags SET value = ?
+        WHERE key = 'change_log_start' AND CAST(value AS INTEGER) < ?
+        """,
+        (start, start),
+    )
+
+
+@with_db_connection()
+def data_generation(conn: Optional[sqlite3.Connection] = None) -> int:
+    """
+    Get the current data generation.
+
+    conn (Optional): SQLite3 connection. Supplied by @with_db_connection() decorator
+
+    Returns:
+        int, 0 if nothing has been inserted yet
+    """
+    row = conn.execute(
+        "SELECT value FROM flags WHERE key = 'data_generation'"
+    ).fetchone()
+    return int(row[0]) if row else 0
+
+
+@with_db_connection()
+def data_version(
+    conn: Optional[sqlite3.Connection] = None,
+) -> Tuple[int, Optional[str]]:
+    """
+    Get the data generation and the rules version in one read. Together they
+    identify the results any check would return, so HTTP responses can be
+    validated against them without running the check.
+
+    conn (Optional): SQLite3 connection. Supplied by @with_db_connection() decorator
+
+    Returns:
+        (data generation, rules version or None)
+    """
+    flags = dict(
+        conn.execute(
+            "SELECT key, value FROM flags "
+            "WHERE key IN ('data_generation', 'rules_version')"
+        ).fetchall()
+    )
+    return int(flags.get("data_generation", 0)), flags.get("rules_version")
 
 
 def fetch_entry_by_id(
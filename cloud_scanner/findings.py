@@ -0,0 +1,512 @@
+"""
+findings.py
+
+Materialized findings, maintained at write time.
+
+Violations only depend on a resource's own columns, so instead of evaluating
+the rules on every read they are evaluated once per written row by triggers on
+the resource tables, which keep one row per (resource, violation) in the
+'findings' table together with the resource's score, the sum of the
+risk_score weights (see rule_runner.rule_weights()) of its violations:
+
+    BEFORE INSERT   drop the findings of the row an INSERT OR REPLACE is about
+                    to replace (REPLACE does not fire delete triggers unless
+                    recursive_triggers is on)
+    AFTER INSERT    add the findings of the new row
+    AFTER UPDATE    replace the findings of the row
+    AFTER DELETE    drop the findings of the row
+
+Each trigger also logs the old and new findings of the row to the
+finding_changes log (see database_ops.py and changes.py), one statement per
+row rather than a trigger per finding.
+
+The triggers are generated from the rulesets rule_engine.py compiles from the
+rules table, with the weights inlined. A hash of the rulesets and weights is
+stored in the flags table and setup_findings() rebuilds the triggers and the
+table when it no longer matches; rebuild_findings() (or `cloudscanner
+--rebuild-findings`) forces it. Reads check the 'rules_version' flag first, so
+adding, changing or deleting a rule takes effect on the next read.
+
+Reads are lookups on the (resource_table, score, resource_id) index joined to
+the resource table by primary key; top=N reads the first N entries of it.
+findings_check_types() reads several resource types concurrently, each on its
+own pooled connection, and merges them into one ranking.
+"""
+
+import hashlib
+import heapq
+import itertools
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from database_ops import (
+    RESOURCE_COLUMNS,
+    bump_generation,
+    register_bulk_load_hook,
+    with_db_connection,
+)
+from decorator import autolog
+import metrics
+from rule_engine import RESOURCE_TABLES, rules_version, rulesets
+from rule_runner import (
+    MASK_BITS,
+    Finding,
+    Layout,
+    decode_cursor,
+    encode_cursor,
+    rule_weights,
+    tag,
+)
+
+TRIGGER_EVENTS = ("before_insert", "after_insert", "after_update", "after_delete")
+
+# Part of rules_hash(), so changing the generated SQL rebuilds the triggers.
+TRIGGER_VERSION = 2
+
+# Generation the write in progress will be committed as.
+NEXT_GENERATION = (
+    "COALESCE((SELECT value + 1 FROM flags WHERE key = 'data_generation'), 1)"
+)
+
+# rules_version last seen by sync_findings(), per database file
+_synced_rules_versions: Dict[str, Optional[str]] = {}
+
+
+def all_weights(conn: sqlite3.Connection) -> Dict[str, Dict[str, float]]:
+    """
+    Weights of every ruleset, keyed by table.
+    """
+    return {
+        ruleset["table"]: rule_weights(ruleset, conn)
+        for ruleset in rulesets(conn=conn).values()
+    }
+
+
+def rules_hash(sets: Dict[str, dict], weights: Dict[str, Dict[str, float]]) -> str:
+    """
+    Hash of the rulesets and weights the triggers are generated from.
+    """
+    return hashlib.sha256(
+        json.dumps([TRIGGER_VERSION, sets, weights], sort_keys=True).encode()
+    ).hexdigest()
+
+
+def _literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _number(value: float) -> str:
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _insert_statements(
+    ruleset: dict, where: str, weights: Dict[str, float]
+) -> List[str]:
+    """
+    One INSERT per rule adding the findings of the rows matching where.
+    """
+    table = ruleset["table"]
+    score = " + ".join(
+        f"CASE WHEN ({predicate}) THEN {_number(weights[name])} ELSE 0 END"
+        for name, predicate in ruleset["rules"].items()
+    )
+    return [
+        f"""
+        INSERT INTO findings (resource_table, resource_id, violation, score)
+        SELECT {_literal(table)}, id, {_literal(name)}, {score}
+        FROM {table} WHERE ({where}) AND ({predicate})
+        """
+        for name, predicate in ruleset["rules"].items()
+    ]
+
+
+def _log_statement(table: str, where: str, new: bool) -> str:
+    """
+    Log the findings of the resources matching where to finding_changes: as
+    their old state before they are deleted, or their new state once
+    inserted.
+    """
+    if new:
+        scores, update = "NULL, score", "new_score = excluded.new_score"
+    else:
+        scores, update = "score, NULL", "new_score = NULL"
+    return f"""
+        INSERT INTO finding_changes
+            (generation, resource_table, resource_id, violation, old_score, new_score)
+        SELECT {NEXT_GENERATION}, resource_table, resource_id, violation, {scores}
+        FROM findings WHERE resource_table = {_literal(table)} AND ({where})
+        ON CONFLICT DO UPDATE SET {update}
+        """
+
+
+def _trigger_statements(ruleset: dict, weights: Dict[str, float]) -> List[str]:
+    table = ruleset["table"]
+    delete_old = (
+        _log_statement(table, "resource_id = OLD.id", new=False)
+        + f"; DELETE FROM findings WHERE resource_table = {_literal(table)} "
+        f"AND resource_id = OLD.id;"
+    )
+    key_match = " AND ".join(f"{column} IS NEW.{column}" for column in ruleset["key"])
+    replaced = f"resource_id IN (SELECT id FROM {table} WHERE {key_match})"
+    insert_new = (
+        "".join(
+            statement + ";"
+            for statement in _insert_statements(ruleset, "id = NEW.id", weights)
+        )
+        + _log_statement(table, "resource_id = NEW.id", new=True)
+        + ";"
+    )
+    return [
+        f"""
+        CREATE TRIGGER findings_{table}_before_insert BEFORE INSERT ON {table}
+        BEGIN
+            {_log_statement(table, replaced, new=False)};
+            DELETE FROM findings WHERE resource_table = {_literal(table)}
+            AND {replaced};
+        END
+        """,
+        f"""
+        CREATE TRIGGER findings_{table}_after_insert AFTER INSERT ON {table}
+        BEGIN {insert_new} END
+        """,
+        f"""
+        CREATE TRIGGER findings_{table}_after_update AFTER UPDATE ON {table}
+        BEGIN {delete_old} {insert_new} END
+        """,
+        f"""
+        CREATE TRIGGER findings_{table}_after_delete AFTER DELETE ON {table}
+        BEGIN {delete_old} END
+        """,
+    ]
+
+
+@autolog(__name__)
+@with_db_connection()
+def setup_findings(conn: Optional[sqlite3.Connection] = None) -> None:
+    """
+    Rebuild the findings if the rulesets or their weights changed. The table
+    itself is created by a database_ops migration.
+
+    Args:
+        conn (sqlite3.Connection, optional): An existing database
+        connection. If not provided, a new connection will be created.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT value FROM flags WHERE key = 'findings_rules_hash'")
+    row = cursor.fetchone()
+    if row is None or row[0] != rules_hash(rulesets(conn=conn), all_weights(conn)):
+        rebuild_findings(conn=conn)
+    conn.commit()
+
+
+def sync_findings(conn: sqlite3.Connection) -> None:
+    """
+    Run setup_findings() if the rules table changed since the last call, so
+    new weights are applied before findings are read.
+    """
+    database = conn.execute("PRAGMA database_list").fetchone()[2]
+    version = rules_version(conn)
+    if _synced_rules_versions.get(database, "") != version:
+        setup_findings(conn=conn)
+        _synced_rules_versions[database] = version
+
+
+@autolog(__name__)
+@with_db_connection()
+def rebuild_findings(conn: Optional[sqlite3.Connection] = None) -> None:
+    """
+    Regenerate the findings triggers and recompute every finding, in one
+    transaction. Bumps the data generation, as scores may have changed.
+
+    Args:
+        conn (sqlite3.Connection, optional): An existing database
+        connection. If not provided, a new connection will be created.
+    """
+    cursor = conn.cursor()
+    if not conn.in_transaction:
+        cursor.execute("BEGIN IMMEDIATE")
+    sets = rulesets(conn=conn)
+    weights = all_weights(conn)
+    for ruleset in sets.values():
+        table = ruleset["table"]
+        for event in TRIGGER_EVENTS:
+            cursor.execute(f"DROP TRIGGER IF EXISTS findings_{table}_{event}")
+        for statement in _trigger_statements(ruleset, weights[table]):
+            cursor.execute(statement)
+    recompute_findings(conn, weights)
+
+    cursor.execute(
+        """
+        INSERT INTO flags (key, value) VALUES ('findings_rules_hash', ?)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        """,
+        (rules_hash(sets, weights),),
+    )
+    bump_generation(conn)
+    conn.commit()
+
+
+def recompute_findings(
+    conn: sqlite3.Connection, weights: Optional[Dict[str, Dict[str, float]]] = None
+) -> None:
+    """
+    Recompute every finding from the resource tables, without committing.
+    Also run at the end of bulk loads, which skip the triggers. Every finding
+    is logged as changed; those that come back the same cancel out when the
+    generation is bumped.
+    """
+    if weights is None:
+        weights = all_weights(conn)
+    for ruleset in rulesets(conn=conn).values():
+        table = ruleset["table"]
+        conn.execute(_log_statement(table, "1", new=False))
+        conn.execute("DELETE FROM findings WHERE resource_table = ?", (table,))
+        for statement in _insert_statements(ruleset, "1", weights[table]):
+            conn.execute(statement)
+        conn.execute(_log_statement(table, "1", new=True))
+
+
+register_bulk_load_hook("findings_%", recompute_findings)
+
+
+def _resolve(
+    resource_type: str, violation: Optional[str], conn: sqlite3.Connection
+) -> dict:
+    if str(resource_type).lower() not in RESOURCE_TABLES:
+        raise ValueError(f"Invalid resource type: {resource_type}")
+    ruleset = rulesets(conn=conn)[str(resource_type).lower()]
+    if violation is not None and violation not in ruleset["rules"]:
+        raise ValueError(f"Unknown violation: {violation}")
+    return ruleset
+
+
+def read_findings(
+    ruleset: dict,
+    conn: sqlite3.Connection,
+    min_score: float = 0,
+    violation: Optional[str] = None,
+    limit: Optional[int] = None,
+    after: Optional[Tuple[float, int]] = None,
+) -> List[dict]:
+    """
+    Read materialized findings for a ruleset, highest score first.
+
+    The matching (score, resource_id) pairs are selected from the findings
+    indexes first, optionally limited to one page starting after the given
+    keyset, and only then joined to the resource rows. The violations of each
+    resource are folded into a Finding bitmask by SQLite, or by Python past
+    MASK_BITS rules.
+
+    returns:
+        list of Finding, ordered by (score DESC, id)
+    """
+    table = ruleset["table"]
+    if not ruleset["rules"]:
+        return []
+    conditions = ["resource_table = ?"]
+    params = [table]
+    if min_score:
+        conditions.append("score >= ?")
+        params.append(min_score)
+    if violation is not None:
+        conditions.append(
+            "resource_id IN (SELECT resource_id FROM findings "
+            "WHERE resource_table = ? AND violation = ?)"
+        )
+        params.extend((table, violation))
+    if after is not None:
+        # The score <= ? bound lets SQLite seek findings_by_score to the
+        # keyset, so a page costs the same however deep it is.
+        conditions.append("score <= ? AND (score < ? OR resource_id > ?)")
+        params.extend((after[0], after[0], after[1]))
+    page = ""
+    if limit is not None:
+        page = "LIMIT ?"
+        params.append(limit)
+
+    layout = Layout(RESOURCE_COLUMNS[table], tuple(ruleset["rules"]))
+    wide = len(layout.rules) > MASK_BITS
+    if wide:
+        # Too many rules for one integer: the names, folded in Python.
+        violations = "json_group_array(f.violation)"
+        positions = {name: i for i, name in enumerate(layout.rules)}
+    else:
+        bits = " ".join(f"WHEN ? THEN {1 << i}" for i in range(len(layout.rules)))
+        violations = f"SUM(CASE f.violation {bits} ELSE 0 END)"
+        params += list(layout.rules)
+    cursor = conn.cursor()
+    cursor.execute(
+        f"""
+        WITH selected AS (
+            SELECT DISTINCT score, resource_id FROM findings
+            WHERE {' AND '.join(conditions)}
+            ORDER BY score DESC, resource_id {page}
+        )
+        SELECT {', '.join(f'r.{column}' for column in layout.columns)}, s.score,
+            (SELECT {violations} FROM findings f
+             WHERE f.resource_table = ? AND f.resource_id = s.resource_id)
+        FROM selected s
+        JOIN {table} r ON r.id = s.resource_id
+        ORDER BY s.score DESC, s.resource_id
+        """,
+        params + [table],
+    )
+
+    if wide:
+        results = [
+            Finding(
+                row,
+                sum(1 << positions[v] for v in json.loads(row[-1]) if v in positions),
+                row[-2],
+                layout,
+            )
+            for row in cursor
+        ]
+    else:
+        results = [Finding(row, row[-1], row[-2], layout) for row in cursor]
+    metrics.add_rows(f"findings.{table}", len(results))
+    return results
+
+
+@autolog(__name__)
+@with_db_connection()
+def findings_check(
+    resource_type: str,
+    conn: Optional[sqlite3.Connection] = None,
+    min_score: float = 0,
+    violation: Optional[str] = None,
+    top: Optional[int] = None,
+) -> dict:
+    """
+    Materialized equivalent of the rule_runner *_check() functions.
+
+    resource_type (str): s3, ec2 or rds
+    conn: SQLite Connection Object supplied by decorator
+    min_score (float): Minimum risk score
+    violation (str, optional): Name of a violation the resource must have
+    top (int, optional): Only return this many of the highest-scoring resources
+
+    returns:
+        dict of ID -> Finding, sorted by score in descending order
+    """
+    if top is not None and top < 1:
+        raise ValueError("top must be at least 1")
+    sync_findings(conn)
+    ruleset = _resolve(resource_type, violation, conn)
+    return {
+        finding.id: finding
+        for finding in read_findings(ruleset, conn, min_score, violation, top)
+    }
+
+
+@autolog(__name__)
+@with_db_connection()
+def findings_page(
+    resource_type: str,
+    conn: Optional[sqlite3.Connection] = None,
+    min_score: float = 0,
+    violation: Optional[str] = None,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+) -> Tuple[List[dict], Optional[str]]:
+    """
+    Materialized equivalent of rule_runner.rule_check_page().
+
+    returns:
+        (list of Finding, cursor for the next page or None)
+    """
+    if limit < 1:
+        raise ValueError("limit must be at least 1")
+
+    sync_findings(conn)
+    ruleset = _resolve(resource_type, violation, conn)
+    after = decode_cursor(cursor) if cursor else None
+    page = read_findings(ruleset, conn, min_score, violation, limit, after)
+    next_cursor = None
+    if len(page) == limit:
+        last = page[-1]
+        next_cursor = encode_cursor((last.score, last.id))
+    return page, next_cursor
+
+
+def resolve_types(
+    resource_types: Iterable[str],
+    violation: Optional[str],
+    sets: Optional[Dict[str, dict]] = None,
+) -> List[str]:
+    """
+    Validate and de-duplicate resource types, keeping those whose ruleset in
+    sets (see rule_engine.rulesets()) defines the violation if one is given.
+    Without sets, the violation is not checked.
+    """
+    resource_types = list(dict.fromkeys(str(t).lower() for t in resource_types))
+    if not resource_types:
+        raise ValueError("No resource types given")
+    for resource_type in resource_types:
+        if resource_type not in RESOURCE_TABLES:
+            raise ValueError(f"Invalid resource type: {resource_type}")
+    if violation is not None and sets is not None:
+        resource_types = [t for t in resource_types if violation in sets[t]["rules"]]
+        if not resource_types:
+            raise ValueError(f"Unknown violation: {violation}")
+    return resource_types
+
+
+def merge_ranked(
+    results: Iterable[List[Finding]], top: Optional[int] = None
+) -> List[Finding]:
+    """
+    Merge result lists that are each ordered by score descending.
+    """
+    merged = heapq.merge(*results, key=lambda finding: -finding.score)
+    if top is not None:
+        merged = itertools.islice(merged, top)
+    return list(merged)
+
+
+@autolog(__name__)
+def findings_check_types(
+    resource_types: Iterable[str],
+    min_score: float = 0,
+    violation: Optional[str] = None,
+    top: Optional[int] = None,
+) -> Tuple[List[Finding], Dict[str, float]]:
+    """
+    Run findings_check() for several resource types in parallel and merge
+    the results, highest score first.
+
+    Every type is read in its own thread on its own pooled connection
+    (SQLite releases the GIL while it steps a query), so the wall-clock time
+    is close to that of the slowest type rather than the sum.
+
+    resource_types: s3, ec2 and/or rds
+    min_score (float): Minimum risk score
+    violation (str, optional): Name of a violation the resource must have.
+        Only the types that define it are read.
+    top (int, optional): Only return this many of the highest-scoring resources
+
+    returns:
+        (resources, each with its "type", ordered by score descending then
+        type, seconds spent on each type)
+    """
+    resource_types = resolve_types(resource_types, violation, rulesets())
+
+    def check(resource_type: str) -> Tuple[List[Finding], float]:
+        start = time.perf_counter()
+        found = findings_check(
+            resource_type, min_score=min_score, violation=violation, top=top
+        )
+        resources = list(found.values())
+        tag(resources, type=resource_type)
+        return resources, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=len(resource_types)) as pool:
+        results = dict(zip(resource_types, pool.map(check, resource_types)))
+
+    merged = merge_ranked((resources for resources, _ in results.values()), top)
+    timings = {t: seconds for t, (_, seconds) in results.items()}
+    return merged, timings
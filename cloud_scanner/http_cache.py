@@ -0,0 +1,74 @@
+"""
+http_cache.py
+
+Conditional requests and compression for the JSON API.
+
+A response is identified by an ETag hashed from its cache key: the normalized
+request parameters and the version of the data they were read from (the data
+generation and rules version, see database_ops.data_version()). The version
+is one indexed read, so a request whose If-None-Match already holds the ETag
+is answered 304 Not Modified before any check runs.
+
+Otherwise the serialized body is kept in the result cache under the ETag,
+along with its gzip-compressed form once a client has asked for it, so a
+repeated request is neither re-serialized nor re-compressed. Bodies smaller
+than GZIP_MIN_SIZE are sent as they are.
+
+ETags are weak, as the gzip and identity encodings of a body share one.
+"""
+
+import gzip
+import hashlib
+import json
+from typing import Any, Callable, Hashable
+
+from flask import Response, jsonify, request
+
+from result_cache import results as result_cache
+
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+
+
+def etag_for(key: Hashable) -> str:
+    """
+    Hash a cache key, which must include the data version, into an ETag.
+    """
+    encoded = json.dumps(key, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()[:32]
+
+
+def accepts_gzip() -> bool:
+    return request.accept_encodings["gzip"] > 0
+
+
+def cached_json(key: Hashable, compute: Callable[[], Any]) -> Response:
+    """
+    Respond with the JSON serialization of compute(), cached under key.
+
+    key: the request parameters and data version the result depends on
+    compute: returns the payload; only called when no cached body exists
+
+    returns:
+        304 if the client's If-None-Match holds the ETag, otherwise the body,
+        gzip-compressed when accepted and at least GZIP_MIN_SIZE bytes
+    """
+    etag = etag_for(key)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        body = result_cache.get_or_compute(
+            ("body", etag), lambda: jsonify(compute()).get_data()
+        )
+        response = Response(body, mimetype="application/json")
+        if accepts_gzip() and len(body) >= GZIP_MIN_SIZE:
+            response.set_data(
+                result_cache.get_or_compute(
+                    ("gzip", etag),
+                    lambda: gzip.compress(body, GZIP_LEVEL, mtime=0),
+                )
+            )
+            response.headers["Content-Encoding"] = "gzip"
+    response.set_etag(etag, weak=True)
+    response.vary.add("Accept-Encoding")
+    return response
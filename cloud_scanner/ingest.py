@@ -0,0 +1,502 @@
+"""
+ingest.py
+
+Streaming ingestion of cloud resource documents.
+
+The input documents can be several GB in size, so instead of calling
+json.load() on the whole thing, the top level object is walked incrementally
+and each element of the EC2Instances, S3Buckets and RDSInstances arrays is
+decoded one at a time. Elements are grouped into fixed-size chunks and flushed
+through the existing batch_insert_* functions, so peak memory is bounded by
+chunk_size and the size of the largest single element, not the document.
+
+bulk_ingest() loads many files at once: a process pool parses and validates
+the files into database rows, and the calling process is the only writer,
+inserting each file's rows as soon as it has been parsed. The load is one
+transaction: if any file fails to parse, none of them is kept unless partial
+loads are asked for.
+"""
+
+import codecs
+import glob
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import IO, Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+import sqlite3
+
+import database_ops as db
+from decorator import autolog
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 64 * 1024
+CHUNK_SIZE = 1000
+
+INSERTERS: Dict[str, Callable] = {
+    "EC2Instances": db.batch_insert_ec2,
+    "S3Buckets": db.batch_insert_s3,
+    "RDSInstances": db.batch_insert_rds,
+}
+
+_WHITESPACE = " \t\n\r"
+_NUMBER_CHARS = "0123456789+-.eE"
+# Literals raw_decode() reports as "Expecting value" while only a prefix is read.
+_LITERALS = ("true", "false", "null", "NaN", "Infinity", "-Infinity")
+
+
+class BulkLoadError(ValueError):
+    """
+    Raised by bulk_ingest() when files fail to parse. The load was rolled back.
+
+    errors: path -> error of every file that failed
+    """
+
+    def __init__(self, errors: Dict[str, str]):
+        super().__init__(f"{len(errors)} file(s) failed to parse; nothing was loaded")
+        self.errors = errors
+
+
+class JSONStreamReader:
+    """
+    Incremental reader over a text or binary file object.
+
+    Only the unconsumed tail of the input is kept in memory. Values are
+    decoded with json.JSONDecoder.raw_decode, reading more input only when a
+    value is cut off at the end of the buffer; a malformed value is reported
+    as soon as it is seen, with its offset (in characters) in the input.
+    """
+
+    def __init__(self, fp: IO, read_size: int = READ_SIZE):
+        self.fp = fp
+        self.read_size = read_size
+        self.buffer = ""
+        self.pos = 0
+        # Characters dropped from the front of the buffer so far.
+        self.offset = 0
+        self.eof = False
+        self._decoder = json.JSONDecoder()
+        self._bytes_decoder = codecs.getincrementaldecoder("utf-8-sig")()
+
+    def _fill(self, size: Optional[int] = None) -> bool:
+        """
+        Read more input into the buffer, dropping what was already consumed.
+        Returns False once the input is exhausted.
+        """
+        if self.eof:
+            return False
+        while True:
+            raw = self.fp.read(size or self.read_size)
+            chunk = raw
+            if isinstance(raw, bytes):
+                chunk = self._bytes_decoder.decode(raw, final=not raw)
+            if chunk or not raw:
+                break
+            # Only part of a multi-byte character was read; keep reading.
+        if not chunk:
+            self.eof = True
+            return False
+        self.offset += self.pos
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """
+        Skip whitespace and return the next character without consuming it.
+        Returns an empty string at end of input.
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, chars: str) -> str:
+        """
+        Consume the next non-whitespace character, which must be one of chars.
+        """
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(
+                f"Expected one of {chars!r} but found {char or 'end of input'!r}"
+            )
+        self.pos += 1
+        return char
+
+    def _incomplete(self, error: json.JSONDecodeError) -> bool:
+        """
+        Whether a decode error only means the value runs past the end of the
+        buffer, rather than that it is malformed.
+        """
+        if error.pos >= len(self.buffer) or error.msg.startswith("Unterminated"):
+            return True
+        tail = self.buffer[error.pos :]
+        if error.msg == "Expecting value":
+            return any(literal.startswith(tail) for literal in _LITERALS)
+        # A \uXXXX escape cut off after fewer than four digits.
+        return error.msg.startswith("Invalid \\uXXXX") and len(tail) < 6
+
+    def decode_value(self) -> Any:
+        """
+        Decode the next complete JSON value.
+
+        Raises:
+            ValueError: if the value is malformed or the input ends inside it
+        """
+        self.peek()
+        read_size = self.read_size
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as e:
+                if not self._incomplete(e):
+                    raise ValueError(
+                        f"Malformed JSON value at offset {self.offset + self.pos}: "
+                        f"{e.msg} at offset {self.offset + e.pos}"
+                    ) from None
+                start = self.offset + self.pos
+                if not self._fill(read_size):
+                    raise ValueError(
+                        f"Input ends inside the JSON value at offset {start}"
+                    ) from None
+                # Grow reads geometrically so one huge value is not
+                # re-decoded once per READ_SIZE chunk.
+                read_size *= 2
+                continue
+            # A number ending the buffer, even in "1." or "1e", may continue in
+            # the next read, so only trust it once more input has been seen.
+            if not self.eof and not self.buffer[end:].strip(_NUMBER_CHARS):
+                self._fill(read_size)
+                continue
+            self.pos = end
+            return value
+
+
+def iter_resources(
+    fp: IO, keys: Tuple[str, ...] = tuple(INSERTERS), read_size: int = READ_SIZE
+) -> Iterator[Tuple[str, Any]]:
+    """
+    Yield (key, element) for every element of the top level arrays named in keys.
+
+    Other top level members are decoded and discarded.
+
+    fp: Text or binary file object containing a JSON object
+    keys: Names of the top level arrays to stream
+    """
+    reader = JSONStreamReader(fp, read_size)
+    reader.expect("{")
+    if reader.peek() == "}":
+        reader.pos += 1
+    else:
+        yield from _iter_members(reader, keys)
+
+    if reader.peek():
+        raise ValueError("Extra data after end of JSON document")
+
+
+def _iter_members(
+    reader: JSONStreamReader, keys: Tuple[str, ...]
+) -> Iterator[Tuple[str, Any]]:
+    """
+    Walk the members of the top level object up to and including its closing brace.
+    """
+    while True:
+        key = reader.decode_value()
+        if not isinstance(key, str):
+            raise ValueError("Object keys must be strings")
+        reader.expect(":")
+
+        if key in keys and reader.peek() == "[":
+            reader.pos += 1
+            if reader.peek() == "]":
+                reader.pos += 1
+            else:
+                while True:
+                    yield key, reader.decode_value()
+                    if reader.expect(",]") == "]":
+                        break
+        else:
+            reader.decode_value()
+
+        if reader.expect(",}") == "}":
+            break
+
+
+@autolog(__name__)
+@db.with_ingest_session()
+def stream_ingest(
+    fp: IO,
+    chunk_size: int = CHUNK_SIZE,
+    *,
+    bulk: bool = False,
+    progress: Optional[Callable[[int], None]] = None,
+    conn: Optional[sqlite3.Connection] = None,
+) -> dict:
+    """
+    Stream a resource document into the database in chunks.
+
+    The whole document is loaded in one transaction: if it turns out to be
+    invalid part way through, nothing from it is kept.
+
+    fp: Text or binary file object containing the resource document
+    chunk_size: Number of elements per executemany call
+    bulk: Load with the bulk profile of database_ops.ingest_session()
+    progress: Called with the number of rows written so far after each chunk
+    conn (Optional): SQLite3 connection. Supplied by @with_ingest_session() decorator
+
+    returns:
+        dict of per-type counts, total rows, inserted/updated/unchanged
+        counts, elapsed seconds and rows/sec
+
+    Raises:
+        ValueError: if the document is not valid JSON or an element does not
+        have the shape of its array, naming the element, e.g. "S3Buckets[3]"
+    """
+    start = time.perf_counter()
+    counts = {key: 0 for key in INSERTERS}
+    changes = dict.fromkeys(db.CHANGE_COUNTS, 0)
+    pending = {key: [] for key in INSERTERS}
+
+    def flush(key: str) -> None:
+        if pending[key]:
+            try:
+                inserted = INSERTERS[key](data=pending[key], conn=conn)
+            except ValueError as e:
+                # Only look for the element at fault once a chunk failed.
+                raise ValueError(
+                    _invalid_element(key, pending[key], counts[key]) or str(e)
+                ) from None
+            add_changes(changes, inserted)
+            counts[key] += len(pending[key])
+            pending[key] = []
+            if progress is not None:
+                progress(sum(counts.values()))
+
+    for key, item in iter_resources(fp):
+        pending[key].append(item)
+        if len(pending[key]) >= chunk_size:
+            flush(key)
+
+    for key in INSERTERS:
+        flush(key)
+
+    elapsed = time.perf_counter() - start
+    total = sum(counts.values())
+    stats = {
+        **counts,
+        "total": total,
+        **changes,
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": round(total / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+    logger.info(
+        "Ingested %d rows (%d inserted, %d updated, %d unchanged) in %.3f seconds "
+        "(%.1f rows/sec)",
+        total,
+        changes["inserted"],
+        changes["updated"],
+        changes["unchanged"],
+        elapsed,
+        stats["rows_per_sec"],
+    )
+    return stats
+
+
+def build_rows(key: str, item: Any) -> tuple:
+    """
+    Database rows of one element of the key array: the ec2 row and its
+    permission rows, or the s3 or rds row.
+
+    Raises:
+        ValueError: if the element does not have the shape of its array
+    """
+    if key == "EC2Instances":
+        row = db.ec2_row(item)
+        return row, db.explode_ip_permissions(item["GroupId"], item["IpPermissions"])
+    if key == "S3Buckets":
+        return (db.s3_row(item),)
+    return (db.rds_row(item),)
+
+
+def _invalid_element(key: str, items: List[Any], first: int) -> Optional[str]:
+    """
+    Describe the first element of items, numbered from first, that
+    build_rows() rejects, or None if it accepts all of them.
+    """
+    for index, item in enumerate(items, first):
+        try:
+            build_rows(key, item)
+        except ValueError as e:
+            return f"{key}[{index}]: {e}"
+    return None
+
+
+def add_changes(total: dict, changes: dict) -> None:
+    """
+    Add the inserted/updated/unchanged counts of one write to a running total.
+    """
+    for key in db.CHANGE_COUNTS:
+        total[key] += changes[key]
+
+
+def parse_file(path: str) -> dict:
+    """
+    Parse and validate one resource file into database rows.
+
+    Runs in a worker process of bulk_ingest().
+
+    path: Path to the JSON file
+
+    returns:
+        dict with the ec2 rows, the ec2 permission rows of each of them, the
+        s3 and rds rows, or the error
+    """
+    rows = {"ec2": [], "permissions": [], "s3": [], "rds": []}
+    counts = dict.fromkeys(INSERTERS, 0)
+    try:
+        with open(path, "rb") as fp:
+            for key, item in iter_resources(fp):
+                try:
+                    built = build_rows(key, item)
+                except ValueError as e:
+                    raise ValueError(f"{key}[{counts[key]}]: {e}") from None
+                counts[key] += 1
+                if key == "EC2Instances":
+                    rows["ec2"].append(built[0])
+                    rows["permissions"].append(built[1])
+                elif key == "S3Buckets":
+                    rows["s3"].append(built[0])
+                else:
+                    rows["rds"].append(built[0])
+    except (OSError, ValueError) as e:
+        return {"path": path, "error": f"{type(e).__name__}: {e}"}
+    return {"path": path, **rows}
+
+
+def expand_paths(patterns: Iterable[str]) -> List[str]:
+    """
+    Expand directories (to their *.json files) and glob patterns into file paths.
+    """
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*.json")
+        paths.extend(sorted(glob.glob(pattern, recursive=True)))
+    return list(dict.fromkeys(paths))
+
+
+@autolog(__name__)
+@db.with_ingest_session()
+def bulk_ingest(
+    paths: List[str],
+    workers: Optional[int] = None,
+    progress: Optional[IO] = sys.stderr,
+    *,
+    bulk: bool = False,
+    partial: bool = False,
+    conn: Optional[sqlite3.Connection] = None,
+) -> dict:
+    """
+    Parse files in a process pool and insert them through a single writer,
+    in one transaction.
+
+    At most two files per worker are parsed ahead of the writer, so memory
+    stays bounded however many files are given. When a file fails to parse
+    no more files are started, and the load is rolled back once the files
+    already being parsed are done, unless partial is set: the files that
+    failed are then skipped and reported, and everything else is loaded.
+
+    paths: JSON files to load
+    workers: Number of parser processes (default: CPU count)
+    progress: Stream for per-file progress lines, or None
+    bulk: Load with the bulk profile of database_ops.ingest_session()
+    partial: Keep the files that parsed when others fail
+    conn (Optional): SQLite3 connection. Supplied by @with_ingest_session() decorator
+
+    returns:
+        dict of per-type counts, total rows, inserted/updated/unchanged
+        counts, elapsed seconds, rows/sec and the errors of files that
+        failed to parse (only ever non-empty with partial)
+
+    Raises:
+        BulkLoadError: if a file failed to parse and partial is not set
+    """
+    start = time.perf_counter()
+    counts = {key: 0 for key in INSERTERS}
+    changes = dict.fromkeys(db.CHANGE_COUNTS, 0)
+    errors = {}
+    workers = workers or os.cpu_count() or 1
+    pending = iter(paths)
+    done_files = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = set()
+        while True:
+            while len(in_flight) < workers * 2 and (partial or not errors):
+                path = next(pending, None)
+                if path is None:
+                    break
+                in_flight.add(pool.submit(parse_file, path))
+            if not in_flight:
+                break
+
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                result = future.result()
+                done_files += 1
+                if "error" in result:
+                    errors[result["path"]] = result["error"]
+                elif partial or not errors:
+                    # Past a failure without partial the load is rolled
+                    # back, so the files still being parsed are not written.
+                    for written in (
+                        db.insert_ec2_rows(
+                            result["ec2"], result["permissions"], conn=conn
+                        ),
+                        db.insert_s3_rows(result["s3"], conn=conn),
+                        db.insert_rds_rows(result["rds"], conn=conn),
+                    ):
+                        add_changes(changes, written)
+                    counts["EC2Instances"] += len(result["ec2"])
+                    counts["S3Buckets"] += len(result["s3"])
+                    counts["RDSInstances"] += len(result["rds"])
+
+                if progress is not None:
+                    elapsed = time.perf_counter() - start
+                    status = errors.get(result["path"], "ok")
+                    if status == "ok" and errors and not partial:
+                        status = "not loaded"
+                    print(
+                        f"[{done_files}/{len(paths)}] {result['path']}: {status} "
+                        f"({sum(counts.values()) / elapsed:.0f} rows/sec)",
+                        file=progress,
+                    )
+
+    if errors and not partial:
+        raise BulkLoadError(errors)
+
+    elapsed = time.perf_counter() - start
+    total = sum(counts.values())
+    stats = {
+        **counts,
+        "total": total,
+        **changes,
+        "files": len(paths),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": round(total / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+    logger.info(
+        "Bulk ingested %d rows from %d files in %.3f seconds (%.1f rows/sec)",
+        total,
+        len(paths),
+        elapsed,
+        stats["rows_per_sec"],
+    )
+    return stats
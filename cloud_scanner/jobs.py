@@ -0,0 +1,297 @@
+"""
+jobs.py
+
+Background ingest jobs for /upload.
+
+An upload is spooled to a file in SPOOL_DIR and queued; a worker thread loads
+queued files one at a time with ingest.stream_ingest(), so the HTTP worker is
+free as soon as the upload has been written to disk.
+
+A job can name an account, in which case it is loaded into that account's
+shard (see shards.py) rather than data.db. Every shard has its own queue and
+worker, so one account's reload never waits behind another's. Each queue
+holds at most MAX_QUEUED_JOBS files, all of them together MAX_PENDING_JOBS,
+and at most MAX_WORKERS shards are loaded at once; submit() raises QueueFull
+beyond that, which the API reports as 429 Too Many Requests, so uploads
+naming many accounts cannot create threads and spooled files without bound. A job submitted with a profiling
+mode is profiled (see profiler.py) and reports the id of its profile.
+
+Job state is kept in memory, for the last MAX_JOB_HISTORY jobs, by the
+process that accepted the upload.
+"""
+
+import logging
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import IO, Optional
+
+from database_ops import shard_path
+from profiler import Profile
+from shards import ingest_account
+
+logger = logging.getLogger(__name__)
+
+SPOOL_DIR = os.path.join(tempfile.gettempdir(), "cloudscanner-spool")
+MAX_QUEUED_JOBS = 8
+MAX_PENDING_JOBS = 32
+MAX_WORKERS = 8
+# Seconds a shard's worker waits for another job before exiting
+IDLE_TIMEOUT = 30
+MAX_JOB_HISTORY = 1000
+COPY_BUFFER = 1024 * 1024
+
+
+class QueueFull(Exception):
+    """
+    Raised by JobQueue.submit() when MAX_QUEUED_JOBS uploads are waiting for
+    the same shard, MAX_PENDING_JOBS for any, or a new shard would need a
+    worker while MAX_WORKERS are busy.
+    """
+
+
+class Job:
+    """
+    State of one ingest job.
+
+    status: queued, running, done or failed
+    """
+
+    def __init__(
+        self,
+        job_id: str,
+        path: str,
+        size: int,
+        account: Optional[str] = None,
+        profile_mode: Optional[str] = None,
+    ):
+        self.id = job_id
+        self.path = path
+        self.size = size
+        self.account = account
+        self.profile_mode = profile_mode
+        self.profile_id = None
+        self.status = "queued"
+        self.bytes_read = 0
+        self.rows = 0
+        self.stats = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "account": self.account,
+            "progress": round(self.bytes_read / self.size, 4) if self.size else 0.0,
+            "bytes": self.size,
+            "rows": self.rows,
+            "stats": self.stats,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "profile_id": self.profile_id,
+        }
+
+
+class _ProgressReader:
+    """
+    File wrapper recording how far into the spooled file the ingest has read.
+    """
+
+    def __init__(self, fp: IO, job: Job):
+        self._fp = fp
+        self._job = job
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self._fp.read(size)
+        self._job.bytes_read += len(chunk)
+        return chunk
+
+
+class JobQueue:
+    """
+    Bounded queues of spooled uploads, one per shard, each with the worker
+    thread that loads it.
+
+    Jobs for the same shard are loaded one at a time, in order, as they
+    would contend for the shard's write lock anyway; jobs for different
+    shards are loaded in parallel. A worker exits once its queue has been
+    empty for IDLE_TIMEOUT seconds, so idle shards hold no thread.
+    """
+
+    def __init__(
+        self,
+        spool_dir: str = SPOOL_DIR,
+        maxsize: int = MAX_QUEUED_JOBS,
+        history: int = MAX_JOB_HISTORY,
+        max_pending: int = MAX_PENDING_JOBS,
+        max_workers: int = MAX_WORKERS,
+    ):
+        self.spool_dir = spool_dir
+        self.history = history
+        self.maxsize = maxsize
+        self.max_pending = max_pending
+        self.max_workers = max_workers
+        # shard path -> its queue and worker
+        self._queues = {}
+        self._workers = {}
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _full(self, shard: str) -> bool:
+        """
+        Whether a job for shard has to be refused. Called with the lock held;
+        may retire an idle worker to make room for the shard's.
+        """
+        shard_queue = self._queues.get(shard)
+        if shard_queue is not None and shard_queue.full():
+            return True
+        if sum(q.qsize() for q in self._queues.values()) >= self.max_pending:
+            return True
+        worker = self._workers.get(shard)
+        if worker is not None and worker.is_alive():
+            return False
+        live = sum(w.is_alive() for w in self._workers.values())
+        return live >= self.max_workers and not self._retire_idle_worker()
+
+    def _retire_idle_worker(self) -> bool:
+        """
+        Tell one worker with nothing left to load to exit now rather than
+        after IDLE_TIMEOUT. Called with the lock held.
+        """
+        for shard, shard_queue in self._queues.items():
+            if shard_queue.unfinished_tasks == 0:
+                del self._queues[shard]
+                del self._workers[shard]
+                shard_queue.put_nowait(None)
+                return True
+        return False
+
+    def submit(
+        self,
+        stream: IO,
+        account: Optional[str] = None,
+        profile_mode: Optional[str] = None,
+    ) -> Job:
+        """
+        Spool an upload to disk and queue it for ingestion, into the shard of
+        account if one is given, profiled if profile_mode is.
+
+        Raises:
+            QueueFull: if the shard's queue or all queues are full, or the
+                shard has no worker and no other can be started
+            ValueError: for an invalid account name
+        """
+        shard = os.path.abspath(shard_path(account))
+        # Checked before spooling so a full queue does not cost a disk write,
+        # and again below for uploads racing for the last slot.
+        with self._lock:
+            if self._full(shard):
+                raise QueueFull()
+
+        os.makedirs(self.spool_dir, exist_ok=True)
+        job_id = uuid.uuid4().hex
+        path = os.path.join(self.spool_dir, f"{job_id}.json")
+        with open(path, "wb") as spool:
+            shutil.copyfileobj(stream, spool, COPY_BUFFER)
+        job = Job(job_id, path, os.path.getsize(path), account, profile_mode)
+
+        with self._lock:
+            if self._full(shard):
+                os.remove(path)
+                raise QueueFull()
+            shard_queue = self._queues.get(shard)
+            if shard_queue is None:
+                shard_queue = self._queues[shard] = queue.Queue(maxsize=self.maxsize)
+            shard_queue.put_nowait(job)
+
+            self._jobs[job_id] = job
+            while len(self._jobs) > self.history:
+                self._jobs.popitem(last=False)
+            worker = self._workers.get(shard)
+            if worker is None or not worker.is_alive():
+                worker = self._workers[shard] = threading.Thread(
+                    target=self._run,
+                    args=(shard, shard_queue),
+                    name=f"ingest-worker-{account or 'default'}",
+                    daemon=True,
+                )
+                worker.start()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def pending(self) -> int:
+        with self._lock:
+            return sum(q.qsize() for q in self._queues.values())
+
+    def _run(self, shard: str, shard_queue: queue.Queue) -> None:
+        while True:
+            try:
+                job = shard_queue.get(timeout=IDLE_TIMEOUT)
+            except queue.Empty:
+                # submit() queues under the lock, so nothing can be added
+                # between this check and the worker going away.
+                with self._lock:
+                    if shard_queue.empty():
+                        del self._queues[shard]
+                        del self._workers[shard]
+                        return
+                continue
+            if job is None:
+                # Retired by _retire_idle_worker().
+                return
+            self._load(job)
+            shard_queue.task_done()
+
+    def _load(self, job: Job) -> None:
+        if job.profile_mode is None:
+            self._ingest(job)
+            return
+        with Profile(f"ingest job {job.id}", job.profile_mode) as profile:
+            job.profile_id = profile.id
+            self._ingest(job)
+
+    def _ingest(self, job: Job) -> None:
+        job.status = "running"
+        job.started = time.time()
+
+        def progress(rows: int) -> None:
+            job.rows = rows
+
+        try:
+            with open(job.path, "rb") as fp:
+                job.stats = ingest_account(
+                    _ProgressReader(fp, job), job.account, progress=progress
+                )
+            job.rows = job.stats["total"]
+            job.status = "done"
+        except Exception as e:
+            if isinstance(e, ValueError):
+                job.error = f"Invalid JSON input: {e}"
+            else:
+                logger.exception("Ingest job %s failed", job.id)
+                job.error = f"{type(e).__name__}: {e}"
+            # The load runs in one transaction, so none of its rows were kept.
+            job.rows = 0
+            job.status = "failed"
+        finally:
+            job.finished = time.time()
+            try:
+                os.remove(job.path)
+            except OSError:
+                pass
+
+
+jobs = JobQueue()
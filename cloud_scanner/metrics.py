@@ -0,0 +1,210 @@
+"""
+metrics.py
+
+In-process metrics, exported in the Prometheus text format at /metrics.
+
+Recorded per instrumented function:
+    cloudscanner_function_calls_total        calls
+    cloudscanner_function_errors_total       calls that raised
+    cloudscanner_function_duration_seconds   latency histogram (perf_counter)
+
+and per operation:
+    cloudscanner_rows_processed_total        rows inserted or evaluated
+
+Functions are recorded by instrument() or, together with entry and exit
+logging, by decorator.autolog(). When metrics are disabled
+(CLOUDSCANNER_METRICS=0 or set_enabled(False)) an instrument()ed call costs
+one flag check on top of the function call itself; an autolog()ged one also
+checks the logger level.
+
+Other modules can add their own samples with register_collector().
+"""
+
+import bisect
+import functools
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Tuple, Any
+
+BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# (name, type, help, labels, value) as yielded by register_collector() callables
+Sample = Tuple[str, str, str, Dict[str, str], float]
+
+enabled = os.environ.get("CLOUDSCANNER_METRICS", "1") != "0"
+
+_lock = threading.Lock()
+# function -> [calls, errors, total seconds, bucket counts...]
+_functions: Dict[str, List[float]] = {}
+_rows: Dict[str, int] = {}
+_collectors: List[Callable[[], Iterable[Sample]]] = []
+
+
+def set_enabled(value: bool) -> None:
+    global enabled
+    enabled = value
+
+
+def reset() -> None:
+    """
+    Drop everything recorded so far.
+    """
+    with _lock:
+        _functions.clear()
+        _rows.clear()
+
+
+def observe(name: str, seconds: float, error: bool = False) -> None:
+    """
+    Record one call of a function.
+    """
+    bucket = bisect.bisect_left(BUCKETS, seconds)
+    with _lock:
+        stats = _functions.get(name)
+        if stats is None:
+            stats = _functions[name] = [0, 0, 0.0] + [0] * (len(BUCKETS) + 1)
+        stats[0] += 1
+        stats[1] += error
+        stats[2] += seconds
+        stats[3 + bucket] += 1
+
+
+def add_rows(operation: str, count: int) -> None:
+    """
+    Count rows processed by an operation.
+    """
+    if not enabled or not count:
+        return
+    with _lock:
+        _rows[operation] = _rows.get(operation, 0) + count
+
+
+def instrument(name: str) -> Callable:
+    """
+    Decorator recording calls, errors and latency of a function under name.
+    """
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if not enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            error = True
+            try:
+                result = func(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                observe(name, time.perf_counter() - start, error)
+
+        return wrapper
+
+    return decorator
+
+
+def register_collector(collector: Callable[[], Iterable[Sample]]) -> None:
+    """
+    Add a callable returning extra samples to render().
+    """
+    _collectors.append(collector)
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+        + "}"
+    )
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render() -> str:
+    """
+    Render every metric in the Prometheus text exposition format.
+    """
+    with _lock:
+        functions = {name: list(stats) for name, stats in _functions.items()}
+        rows = dict(_rows)
+
+    lines = [
+        "# HELP cloudscanner_function_calls_total Calls of instrumented functions.",
+        "# TYPE cloudscanner_function_calls_total counter",
+    ]
+    lines += [
+        f"cloudscanner_function_calls_total{_labels({'function': name})} {stats[0]}"
+        for name, stats in sorted(functions.items())
+    ]
+    lines += [
+        "# HELP cloudscanner_function_errors_total Calls of instrumented functions that raised.",
+        "# TYPE cloudscanner_function_errors_total counter",
+    ]
+    lines += [
+        f"cloudscanner_function_errors_total{_labels({'function': name})} {stats[1]}"
+        for name, stats in sorted(functions.items())
+    ]
+    lines += [
+        "# HELP cloudscanner_function_duration_seconds Latency of instrumented functions.",
+        "# TYPE cloudscanner_function_duration_seconds histogram",
+    ]
+    for name, stats in sorted(functions.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + (float("inf"),), stats[3:]):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(
+                f"cloudscanner_function_duration_seconds_bucket"
+                f"{_labels({'function': name, 'le': le})} {cumulative}"
+            )
+        lines.append(
+            f"cloudscanner_function_duration_seconds_sum{_labels({'function': name})} "
+            f"{_number(stats[2])}"
+        )
+        lines.append(
+            f"cloudscanner_function_duration_seconds_count{_labels({'function': name})} "
+            f"{stats[0]}"
+        )
+    lines += [
+        "# HELP cloudscanner_rows_processed_total Rows inserted or evaluated.",
+        "# TYPE cloudscanner_rows_processed_total counter",
+    ]
+    lines += [
+        f"cloudscanner_rows_processed_total{_labels({'operation': operation})} {count}"
+        for operation, count in sorted(rows.items())
+    ]
+
+    seen = set()
+    for collector in _collectors:
+        for name, kind, help_text, labels, value in collector():
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name}{_labels(labels)} {_number(value)}")
+
+    return "\n".join(lines) + "\n"
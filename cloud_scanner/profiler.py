@@ -0,0 +1,216 @@
+"""
+profiler.py
+
+Opt-in per-request profiling.
+
+A request is profiled when it carries an X-Profile header (sample or cprofile)
+together with the admin token, or while profiling is switched on for every
+request with set_enabled() (POST /admin/profiling). Both need the
+CLOUDSCANNER_ADMIN_TOKEN environment variable; without it profiling cannot be
+turned on at all. Uploads profiled this way also profile their ingest job.
+
+Two modes:
+    sample      a thread reads the profiled thread's stack every INTERVAL
+                seconds (sys._current_frames()), so the profiled code runs
+                at full speed; kept as collapsed stacks, one
+                "frame;frame;frame count" line per stack, ready for
+                flamegraph.pl or speedscope
+    cprofile    deterministic cProfile of the thread, kept as a pstats dump
+                (load it with pstats.Stats); exact call counts, but slower
+
+The last MAX_PROFILES profiles are kept in memory and served by the
+/admin/profiles endpoints. When profiling is off, a request costs one flag
+check and one header lookup; the after-request hooks only look for a profile
+while one is running.
+"""
+
+import cProfile
+import hmac
+import marshal
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from typing import Callable, List, Optional
+
+ADMIN_TOKEN = os.environ.get("CLOUDSCANNER_ADMIN_TOKEN") or None
+MODES = ("sample", "cprofile")
+INTERVAL = 0.005
+MAX_DEPTH = 128
+MAX_PROFILES = 50
+
+# Profile every request, in this mode, until switched off.
+enabled = False
+mode = "sample"
+
+# Profiles started and not yet stopped, so request hooks can skip looking
+# for one when none is running.
+running = 0
+_running_lock = threading.Lock()
+
+
+def set_enabled(value: bool, profile_mode: str = "sample") -> None:
+    global enabled, mode
+    if profile_mode not in MODES:
+        raise ValueError(f"Unknown profiling mode: {profile_mode}")
+    mode = profile_mode
+    enabled = value
+
+
+def authorized(token: Optional[str]) -> bool:
+    """
+    Whether token is the admin token. Always False when none is configured.
+    """
+    if ADMIN_TOKEN is None or token is None:
+        return False
+    return hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+
+def requested_mode(
+    header: Optional[str], token: Callable[[], Optional[str]]
+) -> Optional[str]:
+    """
+    Profiling mode for a request, from its X-Profile header and admin token,
+    or None if it should not be profiled. token is only called when the header
+    asks for a profile.
+    """
+    if enabled:
+        return mode
+    if header is None:
+        return None
+    if header.lower() in MODES and authorized(token()):
+        return header.lower()
+    return None
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{frame.f_globals.get('__name__', '?')}.{code.co_qualname}"
+
+
+def collapse(frame) -> str:
+    """
+    Stack of frame, outermost first, joined with semicolons.
+    """
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Profile:
+    """
+    Profile of one request or job, running on the thread that calls start().
+    """
+
+    def __init__(self, label: str, profile_mode: str = "sample"):
+        self.id = uuid.uuid4().hex
+        self.label = label
+        self.mode = profile_mode
+        self.started = None
+        self.duration = None
+        self.samples = Counter()
+        self.pstats = None
+        self._thread_id = None
+        self._clock = None
+        self._stop = threading.Event()
+        self._sampler = None
+        self._cprofile = None
+
+    def start(self) -> "Profile":
+        global running
+        with _running_lock:
+            running += 1
+        self.started = time.time()
+        self._thread_id = threading.get_ident()
+        if self.mode == "cprofile":
+            self._cprofile = cProfile.Profile()
+            try:
+                self._cprofile.enable()
+            except ValueError:
+                # Another profiler is already active on this thread.
+                self._cprofile = None
+                self.mode = "sample"
+        if self.mode == "sample":
+            self._sampler = threading.Thread(
+                target=self._sample, name=f"profiler-{self.id[:8]}", daemon=True
+            )
+            self._sampler.start()
+        self._clock = time.perf_counter()
+        return self
+
+    def _sample(self) -> None:
+        while not self._stop.wait(INTERVAL):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is not None:
+                self.samples[collapse(frame)] += 1
+
+    def stop(self) -> "Profile":
+        global running
+        if self.duration is not None:
+            return self
+        self.duration = time.perf_counter() - self._clock
+        with _running_lock:
+            running -= 1
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.create_stats()
+            self.pstats = marshal.dumps(self._cprofile.stats)
+            self._cprofile = None
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+        return self
+
+    def __enter__(self) -> "Profile":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        store.add(self.stop())
+
+    def collapsed(self) -> str:
+        return "".join(
+            f"{stack} {count}\n" for stack, count in self.samples.most_common()
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "label": self.label,
+            "mode": self.mode,
+            "started": self.started,
+            "duration": self.duration,
+            "samples": sum(self.samples.values()),
+        }
+
+
+class ProfileStore:
+    """
+    The last MAX_PROFILES finished profiles.
+    """
+
+    def __init__(self, maxsize: int = MAX_PROFILES):
+        self.maxsize = maxsize
+        self._profiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, profile: Profile) -> None:
+        with self._lock:
+            self._profiles[profile.id] = profile
+            while len(self._profiles) > self.maxsize:
+                self._profiles.popitem(last=False)
+
+    def get(self, profile_id: str) -> Optional[Profile]:
+        with self._lock:
+            return self._profiles.get(profile_id)
+
+    def list(self) -> List[dict]:
+        with self._lock:
+            return [profile.to_dict() for profile in reversed(self._profiles.values())]
+
+
+store = ProfileStore()
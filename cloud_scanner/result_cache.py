@@ -0,0 +1,70 @@
+"""
+result_cache.py
+
+Bounded LRU cache for rule check results.
+
+The API caches serialized response bodies here (see http_cache.py), keyed on
+the ETag of the request, which is derived from the data generation and rules
+version read from the flags table (see database_ops.data_version()). Every
+batch insert bumps the generation and every change to the rules table bumps
+the rules version, so results computed before an ingest or a weight change are
+never served after it; they simply stop being looked up and age out of the LRU.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+DEFAULT_MAXSIZE = 64
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache with hit/miss counters.
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_MAXSIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """
+        Return the cached value for key, calling compute() on a miss.
+
+        compute() runs outside the lock, so two concurrent misses on the same
+        key may both compute; the last one to finish is kept.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+
+        value = compute()
+
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+            }
+
+
+results = ResultCache()
@@ -0,0 +1,355 @@
+"""
+rule_dsl.py
+
+Expression language for rule conditions.
+
+    public_access = 1 AND (encryption = 0 OR logging_enabled = 0)
+    NOT public_ip IS NULL
+    db_software IN ('mysql', 'mariadb') AND db_portnumber != 3306
+    EXISTS permissions (prefix_len <= 8 AND from_port <= 22 AND to_port >= 22)
+
+Grammar, loosest binding first:
+
+    expression := and_expr (OR and_expr)*
+    and_expr   := not_expr (AND not_expr)*
+    not_expr   := NOT not_expr | primary
+    primary    := '(' expression ')'
+                | EXISTS relation '(' expression ')'
+                | operand [comparison]
+    comparison := op operand | IS [NOT] NULL | [NOT] IN '(' operand (',' operand)* ')'
+    op         := = | == | != | <> | < | <= | > | >=
+    operand    := field | number | 'string' | TRUE | FALSE | NULL
+
+Keywords are case-insensitive. Fields must be columns of the resource table
+(or, inside EXISTS, of the related table), so field names never reach SQL
+unchecked; literals are bound as parameters, or escaped by sql_literal() when
+they are inlined.
+
+An expression is parsed once and compiled to either
+    compile_sql(expression, table)       -> (WHERE fragment, parameters)
+    compile_predicate(expression, table) -> WHERE fragment, literals inlined
+and both are cached by expression text, so compiling a rule again costs no
+parsing. rule_engine.py compiles the rules table with compile_predicate(), so
+expressions are evaluated by SQLite, in the findings triggers and the
+rule_runner checks; there is no Python evaluator for rows outside the database.
+"""
+
+import functools
+import re
+from typing import Any, Dict, List, Tuple
+
+from database_ops import RESOURCE_COLUMNS
+
+PERMISSION_COLUMNS = (
+    "group_id",
+    "protocol",
+    "from_port",
+    "to_port",
+    "family",
+    "prefix_len",
+    "cidr_start",
+    "cidr_end",
+)
+
+# Tables reachable with EXISTS <relation> (...), per resource table.
+RELATIONS = {
+    "ec2instances": {
+        "permissions": {
+            "table": "ec2permissions",
+            "column": "group_id",
+            "parent": "group_id",
+            "columns": PERMISSION_COLUMNS,
+        }
+    }
+}
+
+KEYWORDS = ("AND", "OR", "NOT", "EXISTS", "IS", "IN", "NULL", "TRUE", "FALSE")
+
+# Operator as written -> SQL operator
+COMPARISONS = {
+    "=": "=",
+    "==": "=",
+    "!=": "!=",
+    "<>": "!=",
+    "<": "<",
+    "<=": "<=",
+    ">": ">",
+    ">=": ">=",
+}
+
+_TOKEN = re.compile(
+    r"""
+    (?P<space>\s+)
+    | (?P<number>-?\d+(?:\.\d+)?)
+    | (?P<string>'(?:[^']|'')*')
+    | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<op><=|>=|<>|!=|==|=|<|>)
+    | (?P<punct>[(),])
+    """,
+    re.VERBOSE,
+)
+
+
+class ExpressionError(ValueError):
+    """
+    Raised for expressions that cannot be tokenized, parsed or compiled.
+    """
+
+
+def tokenize(text: str) -> List[Tuple[str, Any, int]]:
+    """
+    Split an expression into (kind, value, position) tokens.
+
+    kind is one of number, string, name, keyword, op or punct; the list ends
+    with an ("end", None, len(text)) token.
+    """
+    tokens = []
+    position = 0
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        if match is None:
+            raise ExpressionError(
+                f"Unexpected character {text[position]!r} at {position}"
+            )
+        kind = match.lastgroup
+        value = match.group()
+        if kind == "number":
+            tokens.append(
+                (kind, float(value) if "." in value else int(value), position)
+            )
+        elif kind == "string":
+            tokens.append((kind, value[1:-1].replace("''", "'"), position))
+        elif kind == "name" and value.upper() in KEYWORDS:
+            tokens.append(("keyword", value.upper(), position))
+        elif kind != "space":
+            tokens.append((kind, value, position))
+        position = match.end()
+    tokens.append(("end", None, len(text)))
+    return tokens
+
+
+class Parser:
+    """
+    Recursive descent parser producing a tuple AST:
+
+        ("or", node, node, ...)          ("and", node, node, ...)
+        ("not", node)                    ("exists", relation, node)
+        ("compare", op, left, right)     ("is_null", operand, negated)
+        ("in", operand, (operand, ...), negated)
+        ("field", name)                  ("value", literal)
+    """
+
+    def __init__(self, text: str):
+        self.tokens = tokenize(text)
+        self.position = 0
+
+    def peek(self) -> Tuple[str, Any, int]:
+        return self.tokens[self.position]
+
+    def accept(self, kind: str, value: Any = None) -> bool:
+        token = self.peek()
+        if token[0] == kind and (value is None or token[1] == value):
+            self.position += 1
+            return True
+        return False
+
+    def expect(self, kind: str, value: Any = None) -> Tuple[str, Any, int]:
+        token = self.peek()
+        if not self.accept(kind, value):
+            found = "end of expression" if token[0] == "end" else repr(token[1])
+            raise ExpressionError(
+                f"Expected {value or kind} but found {found} at {token[2]}"
+            )
+        return token
+
+    def parse(self) -> tuple:
+        node = self.expression()
+        self.expect("end")
+        return node
+
+    def expression(self) -> tuple:
+        nodes = [self.and_expr()]
+        while self.accept("keyword", "OR"):
+            nodes.append(self.and_expr())
+        return nodes[0] if len(nodes) == 1 else ("or", *nodes)
+
+    def and_expr(self) -> tuple:
+        nodes = [self.not_expr()]
+        while self.accept("keyword", "AND"):
+            nodes.append(self.not_expr())
+        return nodes[0] if len(nodes) == 1 else ("and", *nodes)
+
+    def not_expr(self) -> tuple:
+        if self.accept("keyword", "NOT"):
+            return ("not", self.not_expr())
+        return self.primary()
+
+    def primary(self) -> tuple:
+        if self.accept("punct", "("):
+            node = self.expression()
+            self.expect("punct", ")")
+            return node
+        if self.accept("keyword", "EXISTS"):
+            relation = self.expect("name")[1]
+            self.expect("punct", "(")
+            node = self.expression()
+            self.expect("punct", ")")
+            return ("exists", relation, node)
+
+        left = self.operand()
+        token = self.peek()
+        if token[0] == "op":
+            self.position += 1
+            return ("compare", COMPARISONS[token[1]], left, self.operand())
+        if self.accept("keyword", "IS"):
+            negated = self.accept("keyword", "NOT")
+            self.expect("keyword", "NULL")
+            return ("is_null", left, negated)
+        negated = self.accept("keyword", "NOT")
+        if self.accept("keyword", "IN"):
+            self.expect("punct", "(")
+            values = [self.operand()]
+            while self.accept("punct", ","):
+                values.append(self.operand())
+            self.expect("punct", ")")
+            return ("in", left, tuple(values), negated)
+        if negated:
+            raise ExpressionError(f"Expected IN after NOT at {self.peek()[2]}")
+        if left[0] != "field":
+            raise ExpressionError(f"Expected a comparison at {token[2]}")
+        # A bare field is true when it is set and not zero, as in SQL.
+        return ("compare", "!=", left, ("value", 0))
+
+    def operand(self) -> tuple:
+        kind, value, position = self.peek()
+        self.position += 1
+        if kind == "name":
+            return ("field", value)
+        if kind in ("number", "string"):
+            return ("value", value)
+        if kind == "keyword" and value in ("NULL", "TRUE", "FALSE"):
+            return ("value", {"NULL": None, "TRUE": 1, "FALSE": 0}[value])
+        found = "end of expression" if kind == "end" else repr(value)
+        raise ExpressionError(
+            f"Expected a field or value but found {found} at {position}"
+        )
+
+
+@functools.lru_cache(maxsize=4096)
+def parse(expression: str) -> tuple:
+    """
+    Parse an expression into its AST. Cached by expression text.
+    """
+    return Parser(expression).parse()
+
+
+def _check_field(name: str, columns: Tuple[str, ...], table: str) -> None:
+    if name not in columns:
+        raise ExpressionError(f"{name} is not a column of {table}")
+
+
+def _relation(table: str, name: str) -> dict:
+    relation = RELATIONS.get(table, {}).get(name)
+    if relation is None:
+        raise ExpressionError(f"{table} has no relation {name}")
+    return relation
+
+
+def _sql(
+    node: tuple, table: str, columns: Tuple[str, ...], prefix: str
+) -> Tuple[str, list]:
+    kind = node[0]
+    if kind in ("and", "or"):
+        parts, params = [], []
+        for child in node[1:]:
+            sql, child_params = _sql(child, table, columns, prefix)
+            parts.append(f"({sql})")
+            params.extend(child_params)
+        return f" {kind.upper()} ".join(parts), params
+    if kind == "not":
+        sql, params = _sql(node[1], table, columns, prefix)
+        return f"NOT ({sql})", params
+    if kind == "exists":
+        relation = _relation(table, node[1])
+        sql, params = _sql(node[2], relation["table"], relation["columns"], "r.")
+        return (
+            f"EXISTS (SELECT 1 FROM {relation['table']} r "
+            f"WHERE r.{relation['column']} = {table}.{relation['parent']} AND ({sql}))",
+            params,
+        )
+    if kind == "compare":
+        left, left_params = _sql(node[2], table, columns, prefix)
+        right, right_params = _sql(node[3], table, columns, prefix)
+        return f"{left} {node[1]} {right}", left_params + right_params
+    if kind == "is_null":
+        sql, params = _sql(node[1], table, columns, prefix)
+        return f"{sql} IS {'NOT ' if node[2] else ''}NULL", params
+    if kind == "in":
+        sql, params = _sql(node[1], table, columns, prefix)
+        values = []
+        for value in node[2]:
+            value_sql, value_params = _sql(value, table, columns, prefix)
+            values.append(value_sql)
+            params.extend(value_params)
+        return f"{sql} {'NOT ' if node[3] else ''}IN ({', '.join(values)})", params
+    if kind == "field":
+        _check_field(node[1], columns, table)
+        return f'{prefix}"{node[1]}"', []
+    return "?", [node[1]]
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_sql(expression: str, table: str) -> Tuple[str, tuple]:
+    """
+    Compile an expression into a WHERE fragment over table.
+
+    returns:
+        (SQL fragment with ? placeholders, tuple of parameters)
+    """
+    if table not in RESOURCE_COLUMNS:
+        raise ExpressionError(f"Unknown table: {table}")
+    sql, params = _sql(parse(expression), table, RESOURCE_COLUMNS[table], "")
+    return sql, tuple(params)
+
+
+def sql_literal(value: Any) -> str:
+    """
+    Render a literal as SQL text.
+    """
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_predicate(expression: str, table: str) -> str:
+    """
+    Compile an expression into a SQL condition over table with its literals
+    inlined, for SQL that cannot take parameters such as trigger bodies.
+
+    compile_sql() only emits ? as placeholders (fields are checked column
+    names and every literal is bound), so each one is replaced in turn.
+    """
+    sql, params = compile_sql(expression, table)
+    parts = sql.split("?")
+    return parts[0] + "".join(
+        sql_literal(param) + part for param, part in zip(params, parts[1:])
+    )
+
+
+def cache_info() -> Dict[str, Any]:
+    """
+    Hit and miss counters of the parse and compile caches.
+    """
+    return {
+        name: function.cache_info()._asdict()
+        for name, function in (
+            ("parse", parse),
+            ("compile_sql", compile_sql),
+            ("compile_predicate", compile_predicate),
+        )
+    }
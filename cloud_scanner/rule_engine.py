@@ -0,0 +1,206 @@
+"""
+rule_engine.py
+
+Compiles the rules stored in the 'rules' table into rulesets.
+
+A ruleset maps the name of each violation of a resource table to the SQL
+predicate that detects it, together with the columns identifying a resource:
+
+    {"table": ..., "key": (...), "group_by": "...", "rules": {name: predicate}}
+
+The findings triggers (findings.py), the rule_runner checks and the change
+log diffs (changes.py) are all built from the rulesets, so adding, changing or
+deleting a row of the rules table changes which resources are flagged without
+a code change. Predicates have their literals inlined, as trigger bodies cannot
+take parameters.
+
+Compiled rulesets are cached per database file and table, and only rebuilt
+when the 'rules_version' flag changes, which the triggers created by
+database_ops.setup_database() bump on every insert, update or delete against
+the rules table.
+
+Conditions:
+    condition_field is the column to test, condition_value the value to
+    compare it with. condition_value may start with one of the operators
+    =, !=, >=, <=, > or < (default =). The literal NULL compares against
+    SQL NULL, so "!=NULL" means "is set".
+
+    A rule without a condition_field takes condition_value as a rule_dsl
+    expression instead, e.g. "public_access = 1 AND encryption = 0".
+
+    Several rows with the same rule_name and table flag the violation when
+    any of their conditions holds.
+"""
+
+import logging
+import sqlite3
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from database_ops import RESOURCE_COLUMNS, RESOURCE_KEYS, with_db_connection
+from rule_dsl import ExpressionError, compile_predicate, sql_literal
+
+logger = logging.getLogger(__name__)
+
+RESOURCE_TABLES = {
+    "s3": "s3buckets",
+    "ec2": "ec2instances",
+    "rds": "rdsinstances",
+}
+
+# Columns per_rule_check() groups the rows of each table by.
+GROUP_BY = {
+    "s3buckets": "name, creation_date",
+    "ec2instances": "group_id, group_name",
+    "rdsinstances": "db_name",
+}
+
+OPERATORS = {
+    "!=": "IS NOT",
+    ">=": ">=",
+    "<=": "<=",
+    "=": "IS",
+    ">": ">",
+    "<": "<",
+}
+
+# (database file, table) -> (rules_version, ruleset)
+_ruleset_cache: Dict[Tuple[str, str], Tuple[Optional[str], dict]] = {}
+_ruleset_lock = threading.Lock()
+
+
+def resolve_table(resource_type: str) -> str:
+    """
+    Map a resource type (s3, ec2, rds) or table name to its table name.
+    """
+    table = RESOURCE_TABLES.get(resource_type.lower(), resource_type.lower())
+    if table not in RESOURCE_TABLES.values():
+        raise ValueError(f"Invalid resource type: {resource_type}")
+    return table
+
+
+def parse_condition(condition_value: Optional[str]) -> Tuple[str, Any]:
+    """
+    Split a condition_value into its SQL operator and the value to compare.
+    """
+    value = "NULL" if condition_value is None else str(condition_value)
+    operator = "="
+    for candidate in OPERATORS:
+        if value.startswith(candidate):
+            operator = candidate
+            value = value[len(candidate) :]
+            break
+    value = value.strip()
+    if value.upper() == "NULL":
+        if operator not in ("=", "!="):
+            raise ValueError(f"Operator {operator} cannot be used with NULL")
+        value = None
+    return OPERATORS[operator], value
+
+
+def rules_version(conn: sqlite3.Connection) -> Optional[str]:
+    """
+    Current value of the 'rules_version' flag.
+    """
+    row = conn.execute("SELECT value FROM flags WHERE key = 'rules_version'").fetchone()
+    return row[0] if row else None
+
+
+def compile_condition(table: str, field: Optional[str], value: Optional[str]) -> str:
+    """
+    Compile the condition of one row of the rules table into a SQL predicate.
+
+    Raises:
+        ValueError: if the field is not a column of the table or the value
+        (or expression) cannot be parsed
+    """
+    if not field:
+        return compile_predicate(value or "", table)
+    if field not in RESOURCE_COLUMNS[table]:
+        raise ValueError(f"{field} is not a column of {table}")
+    operator, bound = parse_condition(value)
+    return f'"{field}" {operator} {sql_literal(bound)}'
+
+
+def compile_ruleset(table: str, conn: sqlite3.Connection) -> dict:
+    """
+    Compile the rules for one table into a ruleset.
+
+    Rules whose condition cannot be compiled are skipped with a warning.
+    """
+    rows = conn.execute(
+        """
+        SELECT id, rule_name, condition_field, condition_value
+        FROM rules WHERE resource_table = ? ORDER BY id
+        """,
+        (table,),
+    ).fetchall()
+
+    conditions: Dict[str, list] = {}
+    for rule_id, name, field, value in rows:
+        try:
+            predicate = compile_condition(table, field, value)
+        except (ExpressionError, ValueError) as e:
+            logger.warning("Skipping rule %s: %s", rule_id, e)
+            continue
+        conditions.setdefault(name, []).append(predicate)
+
+    return {
+        "table": table,
+        "key": RESOURCE_KEYS[table],
+        "group_by": GROUP_BY[table],
+        "rules": {
+            name: (
+                predicates[0]
+                if len(predicates) == 1
+                else " OR ".join(f"({predicate})" for predicate in predicates)
+            )
+            for name, predicates in conditions.items()
+        },
+    }
+
+
+def ruleset(resource_type: str, conn: sqlite3.Connection) -> dict:
+    """
+    Return the cached ruleset of a resource type in the database of conn,
+    recompiling it if the rules changed.
+    """
+    table = resolve_table(resource_type)
+    database = conn.execute("PRAGMA database_list").fetchone()[2]
+    version = rules_version(conn)
+    if not database:
+        # Every in-memory database has the same (empty) name.
+        return compile_ruleset(table, conn)
+
+    key = (database, table)
+    cached = _ruleset_cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    with _ruleset_lock:
+        cached = _ruleset_cache.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        compiled = compile_ruleset(table, conn)
+        _ruleset_cache[key] = (version, compiled)
+        return compiled
+
+
+@with_db_connection()
+def rulesets(conn: Optional[sqlite3.Connection] = None) -> Dict[str, dict]:
+    """
+    The ruleset of every resource type, keyed by type.
+
+    conn (Optional): SQLite3 connection. Supplied by @with_db_connection() decorator
+    """
+    return {
+        resource_type: ruleset(resource_type, conn) for resource_type in RESOURCE_TABLES
+    }
+
+
+def invalidate() -> None:
+    """
+    Drop every cached ruleset.
+    """
+    with _ruleset_lock:
+        _ruleset_cache.clear()
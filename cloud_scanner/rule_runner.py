@@ -6,181 +6,496 @@ The purpose of this module is to serve as the runner of the rules.
 Each of the *_check() functions work in the same way:
 1. Uses the @with_db_connection() decorator from database_ops to seamlessly
 handle connection management to connect to the DB
-2. The for loop runs each of the SQL queries, using the key of the query as the
-name of the violation
-3. Re-assembles the data into a dictionary of dictionaries, with the ID from the SQLite DB
+2. Looks up its ruleset, compiled by rule_engine.py from the rules table, which
+maps the name of each violation to the SQL predicate that detects it
+3. By default, single_pass_check() evaluates every rule in one scan of the table,
+computing a flag per rule and the weighted risk score for each row: the sum of
+the risk_score, in the rules table, of every rule the row violates
+4. Re-assembles the data into a dictionary of Finding records, with the ID from the SQLite DB
 as the primary key (given that duplicate entries were found in the original data load, so the 
 name field could not be used for this)
-4. Assign Violation nested key to each primary key with the name of the violation.
-5. Read this dictionary into all_results dict
-6. Repeat for all existing queries
-7. Sort by len() of violation subkey, in descending order
-8. return json_output
+5. Each Finding records its violations as a bitmask over the ruleset, computed in SQL.
+6. Rows come back sorted by score, in descending order, with the score as RiskScore
+7. return json_output
+
+A Finding keeps the row tuple SQLite returned, the bitmask and the score, with
+the column and rule names shared by every record of the result (Layout). It
+only becomes a dict, with its Violations and RiskScore keys, when it is
+serialized with to_dict() or to_dicts().
+
+min_score and violation filters are pushed into the query, top=N returns only
+the N highest scores through ORDER BY ... LIMIT, and rule_check_page() serves
+the same results in pages using a keyset cursor.
+
+per_rule_check() keeps the original behaviour of one query per rule, merged and
+sorted in Python, and produces the same output.
 """
 
-from database_ops import with_db_connection
+from database_ops import RESOURCE_COLUMNS, with_db_connection
+import metrics
+import rule_engine
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+import base64
+import heapq
+import json
 import sqlite3
 
 
+class Layout:
+    """
+    What the Finding records of one result share: the names of the resource
+    columns at the start of each row, the rule names the violation bitmask
+    refers to, and fields added to every record when it is serialized.
+    """
+
+    __slots__ = ("columns", "rules", "extra")
+
+    def __init__(
+        self,
+        columns: Tuple[str, ...],
+        rules: Tuple[str, ...],
+        extra: Optional[Dict[str, Any]] = None,
+    ):
+        self.columns = columns
+        self.rules = rules
+        self.extra = extra or {}
+
+    def tagged(self, **fields: Any) -> "Layout":
+        return Layout(self.columns, self.rules, {**self.extra, **fields})
+
+
+class Finding:
+    """
+    One resource and its violations.
+
+    values: the row as returned by SQLite; its first len(layout.columns)
+        items are the resource columns
+    mask: bit i is set when the resource violates layout.rules[i]
+    score: weighted risk score
+    """
+
+    __slots__ = ("values", "mask", "score", "layout")
+
+    def __init__(self, values: tuple, mask: int, score: float, layout: Layout):
+        self.values = values
+        self.mask = mask
+        self.score = score
+        self.layout = layout
+
+    @property
+    def id(self) -> int:
+        return self.values[0]
+
+    @property
+    def violations(self) -> List[str]:
+        mask = self.mask
+        return [name for i, name in enumerate(self.layout.rules) if mask >> i & 1]
+
+    def to_dict(self) -> dict:
+        data = dict(zip(self.layout.columns, self.values))
+        data["Violations"] = self.violations
+        data["RiskScore"] = self.score
+        data.update(self.layout.extra)
+        return data
+
+
+# Rule flags SQLite can fold into one (signed 64-bit) integer.
+MASK_BITS = 63
+
+
+def to_dicts(results: Union[Dict[int, Finding], Iterable[Finding]]) -> Any:
+    """
+    Serialize a result: a dict of ID -> Finding into a dict of ID -> dict,
+    anything else into a list of dicts.
+    """
+    if isinstance(results, dict):
+        return {row_id: finding.to_dict() for row_id, finding in results.items()}
+    return [finding.to_dict() for finding in results]
+
+
+def tag(results: Iterable[Finding], **fields: Any) -> None:
+    """
+    Add fields to every record of a result when it is serialized, without
+    touching the records one field at a time.
+    """
+    layouts = {}
+    for finding in results:
+        layout = layouts.get(finding.layout)
+        if layout is None:
+            layout = layouts[finding.layout] = finding.layout.tagged(**fields)
+        finding.layout = layout
+
+
 @with_db_connection()
-def s3_rule_check(conn):
+def s3_rule_check(conn, single_pass=True, min_score=0, violation=None, top=None):
     """
-    Process the three S3 rules and identify most at risk resources by weighted risk score.
+    Process the S3 rules of the rules table and identify most at risk resources by weighted risk score.
 
 
 
-    Rules:
-        Assign 1 point if Public Access is true
-        Assign 1 point if Encrypted is false
-        Assign 1 point if logging_enabled is false
+    Default rules:
+        Assign the rule's risk_score (1 by default) if Public Access is true
+        Assign the rule's risk_score (1 by default) if Encrypted is false
+        Assign the rule's risk_score (1 by default) if logging_enabled is false
 
 
     conn: SQLite Connection Object supplied by decorator
+    single_pass: Evaluate all rules in one table scan (default) instead of one query per rule
+    min_score: Only return resources with at least this risk score
+    violation: Only return resources with this violation
+    top: Only return the top highest-scoring resources
 
     returns:
-        dict
+        dict of ID -> Finding
 
     """
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    return run_rules(
+        rule_engine.ruleset("s3", conn), conn, single_pass, min_score, violation, top
+    )
 
-    queries = {
-        "PublicAccessEnabled": "SELECT DISTINCT * FROM s3buckets WHERE public_access = 1 GROUP BY name, creation_date",
-        "EncryptionDisabled": "SELECT DISTINCT * FROM s3buckets WHERE encryption = 0 GROUP BY name, creation_date",
-        "LoggingDisabled": "SELECT DISTINCT * FROM s3buckets WHERE logging_enabled = 0 GROUP BY name, creation_date",
-    }
-    all_results = {}
 
-    for violation_type, query in queries.items():
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        processed_rows = process_results(violation_type, rows)
+@with_db_connection()
+def ec2_instance_check(conn, single_pass=True, min_score=0, violation=None, top=None):
+    """
+    Process the EC2 rules of the rules table and identify most at risk resources by weighted risk score.
 
-        for row_id, data in processed_rows.items():
-            if row_id in all_results:
-                all_results[row_id]["Violations"].extend(data["Violations"])
-            else:
-                all_results[row_id] = data
+    Default rules:
+        Assign the rule's risk_score (1 by default) if IpPermissions opens an admin
+        port (database_ops.ADMIN_PORTS) to a /8 or wider range
+        Assign the rule's risk_score (1 by default) if public IP is present.
 
-    for data in all_results.values():
-        data["Violations"] = list(set(data["Violations"]))
 
-    sorted_results = sorted(
-        all_results.items(), key=lambda item: len(item[1]["Violations"]), reverse=True
-    )
+    conn: SQLite Connection Object supplied by decorator
+    single_pass: Evaluate all rules in one table scan (default) instead of one query per rule
+    min_score: Only return resources with at least this risk score
+    violation: Only return resources with this violation
+    top: Only return the top highest-scoring resources
 
-    json_output = {row_id: data for row_id, data in sorted_results}
-    return json_output
+    returns:
+        dict of ID -> Finding
+
+    """
+    return run_rules(
+        rule_engine.ruleset("ec2", conn), conn, single_pass, min_score, violation, top
+    )
 
 
 @with_db_connection()
-def ec2_instance_check(conn):
+def rds_rule_check(conn, single_pass=True, min_score=0, violation=None, top=None):
     """
-    Process the 2 EC2 rules and identify most at risk resources by weighted risk score.
+    Process the RDS rules of the rules table and identify most at risk resources by weighted risk score.
+
 
-    Rules:
-        Assign 1 point if IpPermissions exists with an insecure CIDR range
-        Assign 1 point if public IP is present.
 
+    Default rules:
+        Assign the rule's risk_score (1 by default) if Encrypted is false
+        Assign the rule's risk_score (1 by default) if Public Access is enabled
 
     conn: SQLite Connection Object supplied by decorator
+    single_pass: Evaluate all rules in one table scan (default) instead of one query per rule
+    min_score: Only return resources with at least this risk score
+    violation: Only return resources with this violation
+    top: Only return the top highest-scoring resources
 
     returns:
-        dict
+        dict of ID -> Finding
 
     """
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    return run_rules(
+        rule_engine.ruleset("rds", conn), conn, single_pass, min_score, violation, top
+    )
 
-    queries = {
-        "PublicIPExposure": "SELECT DISTINCT * FROM ec2instances WHERE public_ip IS NOT NULL GROUP BY group_id, group_name",
-        "InsecureCIDRRange": "SELECT DISTINCT * FROM ec2instances WHERE ip_perms IS NOT '[]' GROUP BY group_id, group_name",
-    }
-    all_results = {}
 
-    for violation_type, query in queries.items():
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        processed_rows = process_results(violation_type, rows)
+def rule_weights(ruleset: dict, conn: sqlite3.Connection) -> Dict[str, float]:
+    """
+    Weight of each violation of a ruleset: the risk_score of the rule with
+    the same name and table in the rules table, or 1 if there is none.
+    """
+    weights = {name: 1 for name in ruleset["rules"]}
+    cursor = conn.execute(
+        "SELECT rule_name, risk_score FROM rules WHERE resource_table = ? ORDER BY id",
+        (ruleset["table"],),
+    )
+    for name, risk_score in cursor:
+        if name in weights and risk_score is not None:
+            weights[name] = risk_score
+    return weights
+
+
+def run_rules(
+    ruleset: dict,
+    conn: sqlite3.Connection,
+    single_pass: bool = True,
+    min_score: float = 0,
+    violation: Optional[str] = None,
+    top: Optional[int] = None,
+) -> dict:
+    """
+    Evaluate a ruleset against its table.
 
-        for row_id, data in processed_rows.items():
-            if row_id in all_results:
-                all_results[row_id]["Violations"].extend(data["Violations"])
-            else:
-                all_results[row_id] = data
+    ruleset (dict): table, group_by and rules (violation name -> SQL predicate)
+    conn: SQLite Connection Object
+    single_pass (bool): Use single_pass_check() rather than per_rule_check()
+    min_score (float): Minimum risk score
+    violation (str, optional): Name of a violation the resource must have
+    top (int, optional): Only return this many of the highest-scoring resources
 
-    for data in all_results.values():
-        data["Violations"] = list(set(data["Violations"]))
+    returns:
+        dict of ID -> Finding
+    """
+    if violation is not None and violation not in ruleset["rules"]:
+        raise ValueError(f"Unknown violation: {violation}")
+    if top is not None and top < 1:
+        raise ValueError("top must be at least 1")
+    weights = rule_weights(ruleset, conn)
+    if single_pass:
+        return single_pass_check(
+            ruleset, conn, min_score, violation, top, weights=weights
+        )
+
+    return per_rule_check(ruleset, conn, weights, min_score, violation, top)
+
+
+def single_pass_check(
+    ruleset: dict,
+    conn: sqlite3.Connection,
+    min_score: float = 0,
+    violation: Optional[str] = None,
+    limit: Optional[int] = None,
+    after: Optional[Tuple[float, int]] = None,
+    weights: Optional[Dict[str, float]] = None,
+) -> dict:
+    """
+    Evaluate every rule of a ruleset in one scan of its table.
+
+    Each rule becomes a CASE flag column next to the row, the score is the sum
+    of the weights of the flagged rules, and the ORDER BY reproduces the
+    ordering of per_rule_check(): score descending, then the first rule the
+    row violated, then the GROUP BY columns. Rows are streamed off the cursor
+    and turned into a dict once.
+
+    The flags are folded into the Finding bitmask by SQLite, or by Python
+    past MASK_BITS rules.
+
+    The score threshold and violation filter are applied in the WHERE clause.
+    When limit is given the rows are instead ordered by (score DESC, id) and
+    only the first limit rows are kept by SQLite; after, the (score, id) of
+    the last row of the previous page, seeks past the rows already returned.
+
+    ruleset (dict): table, group_by and rules (violation name -> SQL predicate)
+    conn: SQLite Connection Object
+    min_score (float): Minimum risk score
+    violation (str, optional): Name of a violation the resource must have
+    limit (int, optional): Maximum number of rows to return
+    after (tuple, optional): Keyset (score, id) to continue from
+    weights (dict, optional): Weight per violation, from rule_weights() by default
 
-    sorted_results = sorted(
-        all_results.items(), key=lambda item: len(item[1]["Violations"]), reverse=True
+    returns:
+        dict of ID -> Finding
+    """
+    if not ruleset["rules"]:
+        return {}
+    if weights is None:
+        weights = rule_weights(ruleset, conn)
+    names = list(ruleset["rules"])
+    predicates = list(ruleset["rules"].values())
+    selected = ", ".join(RESOURCE_COLUMNS[ruleset["table"]])
+    flags = ", ".join(
+        f"CASE WHEN ({predicate}) THEN 1 ELSE 0 END AS v{i}"
+        for i, predicate in enumerate(predicates)
+    )
+    weighted = " + ".join(f"v{i} * ?" for i in range(len(names)))
+    wide = len(names) > MASK_BITS
+    if wide:
+        # Too many rules for one integer: the flags as a string, v0 first.
+        mask = " || ".join(f"v{i}" for i in range(len(names)))
+    else:
+        mask = " | ".join(f"(v{i} << {i})" for i in range(len(names)))
+    score = "risk_score"
+    # Rows are selected with the rule predicates themselves, which SQLite can
+    # answer from the partial indexes in database_ops.RULE_INDEXES.
+    if violation is not None:
+        matching = predicates[names.index(violation)]
+    else:
+        matching = " OR ".join(f"({predicate})" for predicate in predicates)
+    conditions = []
+    # The weights are bound first as they appear before the filters in the query text.
+    params = [weights[name] for name in names]
+
+    if min_score:
+        conditions.append(f"{score} >= ?")
+        params.append(min_score)
+
+    if limit is None:
+        first_rule = " ".join(f"WHEN v{i} THEN {i}" for i in range(len(names)))
+        order = f"{score} DESC, CASE {first_rule} END, {ruleset['group_by']}"
+    else:
+        if after is not None:
+            conditions.append(f"({score} < ? OR ({score} = ? AND id > ?))")
+            params.extend((after[0], after[0], after[1]))
+        order = f"{score} DESC, id LIMIT ?"
+        params.append(limit)
+
+    where = f"WHERE ({') AND ('.join(conditions)}) " if conditions else ""
+    query = (
+        f"SELECT {selected}, {score}, {mask} FROM "
+        f"(SELECT *, {weighted} AS risk_score FROM "
+        f"(SELECT {selected}, {flags} FROM {ruleset['table']} WHERE {matching})) "
+        f"{where}ORDER BY {order}"
     )
-    json_output = {row_id: data for row_id, data in sorted_results}
 
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    layout = Layout(RESOURCE_COLUMNS[ruleset["table"]], tuple(names))
+
+    json_output = {}
+    for row in cursor:
+        bits = int(row[-1][::-1], 2) if wide else row[-1]
+        json_output[row[0]] = Finding(row, bits, row[-2], layout)
+    metrics.add_rows(f"rule_check.{ruleset['table']}", len(json_output))
     return json_output
 
 
 @with_db_connection()
-def rds_rule_check(conn):
+def rule_check_page(
+    resource_type: str,
+    conn: Optional[sqlite3.Connection] = None,
+    min_score: float = 0,
+    violation: Optional[str] = None,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+) -> Tuple[List[dict], Optional[str]]:
     """
-    Process the two RDS rules and identify most at risk resources by weighted risk score.
+    Fetch one page of a resource type's violations, highest score first.
 
+    Pages are keyed on (score, id), so they never skip or repeat a resource,
+    but the score is computed: every page evaluates the rules over the whole
+    table and sorts the matches. findings.findings_page() serves the same
+    pages from the findings score index, at a cost that does not grow with
+    depth.
 
-
-    Rules:
-        Assign 1 point if Encrypted is false
-        Assign 1 point if Public IP exists
-
+    resource_type (str): s3, ec2 or rds
     conn: SQLite Connection Object supplied by decorator
+    min_score (float): Minimum risk score
+    violation (str, optional): Name of a violation the resource must have
+    limit (int): Page size
+    cursor (str, optional): next_cursor returned with the previous page
 
     returns:
-        dict
+        (list of Finding, cursor for the next page or None)
+    """
+    rules = rule_engine.ruleset(resource_type, conn)
+    if violation is not None and violation not in rules["rules"]:
+        raise ValueError(f"Unknown violation: {violation}")
+    if limit < 1:
+        raise ValueError("limit must be at least 1")
+
+    after = decode_cursor(cursor) if cursor else None
+    page = list(
+        single_pass_check(rules, conn, min_score, violation, limit, after).values()
+    )
+    next_cursor = None
+    if len(page) == limit:
+        last = page[-1]
+        next_cursor = encode_cursor((last.score, last.id))
+    return page, next_cursor
+
 
+def encode_cursor(keyset: Tuple[float, int]) -> str:
     """
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    Encode a (score, id) keyset as an opaque cursor string.
+    """
+    return base64.urlsafe_b64encode(json.dumps(keyset).encode()).decode()
 
-    queries = {
-        "PublicAccessEnabled": "SELECT DISTINCT * FROM rdsinstances WHERE public_access = 1 GROUP BY db_name",
-        "EncryptionDisabled": "SELECT DISTINCT * FROM rdsinstances WHERE encryption = 0 GROUP BY db_name",
-    }
-    all_results = {}
 
-    for violation_type, query in queries.items():
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        processed_rows = process_results(violation_type, rows)
+def decode_cursor(cursor: str) -> Tuple[float, int]:
+    """
+    Decode a cursor produced by encode_cursor().
+    """
+    try:
+        score, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(score), int(row_id)
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def per_rule_check(
+    ruleset: dict,
+    conn: sqlite3.Connection,
+    weights: Optional[Dict[str, float]] = None,
+    min_score: float = 0,
+    violation: Optional[str] = None,
+    top: Optional[int] = None,
+) -> dict:
+    """
+    Evaluate a ruleset with one query per rule, merging the results in Python.
+
+    With top, the highest-scoring rows are picked with a heap of size top
+    instead of sorting every row.
 
-        for row_id, data in processed_rows.items():
-            if row_id in all_results:
-                all_results[row_id]["Violations"].extend(data["Violations"])
-            else:
-                all_results[row_id] = data
+    ruleset (dict): table, group_by and rules (violation name -> SQL predicate)
+    conn: SQLite Connection Object
+    weights (dict, optional): Weight per violation, from rule_weights() by default
+    min_score (float): Minimum risk score
+    violation (str, optional): Name of a violation the resource must have
+    top (int, optional): Only return this many of the highest-scoring resources
 
-    for data in all_results.values():
-        data["Violations"] = list(set(data["Violations"]))
+    returns:
+        dict of ID -> Finding
+    """
+    if weights is None:
+        weights = rule_weights(ruleset, conn)
+    names = tuple(ruleset["rules"])
+    layout = Layout(RESOURCE_COLUMNS[ruleset["table"]], names)
+    cursor = conn.cursor()
 
-    sorted_results = sorted(
-        all_results.items(), key=lambda item: len(item[1]["Violations"]), reverse=True
-    )
+    all_results = {}
 
-    json_output = {row_id: data for row_id, data in sorted_results}
+    for bit, predicate in enumerate(ruleset["rules"].values()):
+        cursor.execute(
+            f"SELECT DISTINCT {', '.join(layout.columns)} "
+            f"FROM {ruleset['table']} WHERE {predicate} "
+            f"GROUP BY {ruleset['group_by']}"
+        )
+        process_results(1 << bit, cursor, all_results, layout)
+
+    required = 0 if violation is None else 1 << names.index(violation)
+    for finding in all_results.values():
+        finding.score = sum(weights[name] for name in finding.violations)
+
+    matching = (
+        finding
+        for finding in all_results.values()
+        if finding.score >= min_score and finding.mask & required == required
+    )
+    if top is None:
+        sorted_results = sorted(
+            matching, key=lambda finding: finding.score, reverse=True
+        )
+    else:
+        sorted_results = heapq.nlargest(
+            top, matching, key=lambda finding: finding.score
+        )
+
+    json_output = {finding.id: finding for finding in sorted_results}
     return json_output
 
 
-def process_results(violation_type: str, rows: dict) -> dict:
+def process_results(
+    bit: int, rows: Iterable[tuple], results: Dict[int, Finding], layout: Layout
+) -> None:
     """
-    Assign violation nested key + append new violations to ID
+    Add rows violating the rule of a bit to results, keyed by ID, setting the
+    bit on records that are already there.
 
-    violation_type (str): Text of Violation string
-    rows (dict):  rows from SQL query.
+    bit (int): Bit of the violated rule in the Finding mask
+    rows: rows from SQL query, starting with the ID
+    results (dict): ID -> Finding, updated in place
+    layout (Layout): Layout of new records
     """
-    processed_rows = {}
     for row in rows:
-        row_id = row["id"]
-        if row_id not in processed_rows:
-            processed_rows[row_id] = dict(row)
-            processed_rows[row_id]["Violations"] = [violation_type]
+        finding = results.get(row[0])
+        if finding is None:
+            results[row[0]] = Finding(row, bit, 0, layout)
         else:
-            processed_rows[row_id]["Violations"].append(violation_type)
-    return processed_rows
+            finding.mask |= bit
@@ -0,0 +1,153 @@
+"""
+shards.py
+
+Per-account database files.
+
+Resources of an account (or tenant) can be loaded into their own database
+file, database_ops.shard_path(account), instead of the shared data.db. Every
+shard has its own schema, rules, findings and write lock, so reloading one
+account never waits on, or blocks, the loads of another, and one account can
+be queried without touching the rest.
+
+findings_check_shards() reads any number of shards in parallel, one task per
+(account, resource type) on a connection from that shard's pool, and merges
+the results into a single ranking.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Dict, Iterable, List, Optional, Tuple
+
+import database_ops as db
+from decorator import autolog
+from findings import findings_check, merge_ranked, resolve_types, setup_findings
+from rule_engine import rulesets
+from rule_runner import Finding, tag
+from ingest import stream_ingest
+
+MAX_WORKERS = 8
+
+_prepared = set()
+_prepare_lock = threading.Lock()
+
+
+def prepare_shard(account: Optional[str]) -> str:
+    """
+    Create or upgrade the database file of an account, once per process.
+
+    returns:
+        path of the shard
+    """
+    path = db.shard_path(account)
+    key = os.path.abspath(path)
+    if key in _prepared:
+        return path
+    with _prepare_lock:
+        if key not in _prepared:
+            os.makedirs(os.path.dirname(key), exist_ok=True)
+            db.setup_database(db_path=path)
+            setup_findings(db_path=path)
+            _prepared.add(key)
+    return path
+
+
+def existing_shards(accounts: Optional[Iterable[str]] = None) -> Dict[str, str]:
+    """
+    Map accounts to their shard paths, every shard in SHARD_DIR by default.
+
+    Raises:
+        ValueError: for an invalid account or one without a shard
+    """
+    if accounts is None:
+        accounts = db.shard_accounts()
+    shards = {}
+    for account in dict.fromkeys(accounts):
+        path = db.shard_path(account)
+        if not os.path.exists(path):
+            raise ValueError(f"Unknown account: {account}")
+        shards[account] = prepare_shard(account)
+    return shards
+
+
+def ingest_account(fp: IO, account: Optional[str], **kwargs) -> dict:
+    """
+    stream_ingest() into the shard of an account.
+    """
+    return stream_ingest(fp, db_path=prepare_shard(account), **kwargs)
+
+
+def versions(
+    accounts: Optional[Iterable[str]] = None,
+) -> Dict[str, Tuple[int, Optional[str]]]:
+    """
+    Data generation and rules version of each shard, to key and validate
+    cached cross-shard results.
+    """
+    return {
+        account: db.data_version(db_path=path)
+        for account, path in existing_shards(accounts).items()
+    }
+
+
+@autolog(__name__)
+def findings_check_shards(
+    accounts: Optional[Iterable[str]],
+    resource_types: Iterable[str],
+    min_score: float = 0,
+    violation: Optional[str] = None,
+    top: Optional[int] = None,
+) -> Tuple[List[Finding], Dict[str, Dict[str, float]]]:
+    """
+    Run findings_check() on several shards and resource types in parallel
+    and merge the results, highest score first.
+
+    accounts: Accounts to read, or None for every shard
+    resource_types: s3, ec2 and/or rds
+    min_score (float): Minimum risk score
+    violation (str, optional): Name of a violation the resource must have.
+        Only the shards and types whose rules define it are read.
+    top (int, optional): Only return this many of the highest-scoring resources
+
+    returns:
+        (resources, each with its "account" and "type", seconds spent on each
+        account and type)
+    """
+    shards = existing_shards(accounts)
+    resource_types = resolve_types(resource_types, None)
+    tasks = []
+    for account, path in shards.items():
+        # Each shard has its own rules table.
+        sets = rulesets(db_path=path)
+        tasks.extend(
+            (account, t)
+            for t in resource_types
+            if violation is None or violation in sets[t]["rules"]
+        )
+    if violation is not None and shards and not tasks:
+        raise ValueError(f"Unknown violation: {violation}")
+    if not tasks:
+        return [], {}
+
+    def check(task: Tuple[str, str]) -> Tuple[List[Finding], float]:
+        account, resource_type = task
+        start = time.perf_counter()
+        found = findings_check(
+            resource_type,
+            min_score=min_score,
+            violation=violation,
+            top=top,
+            db_path=shards[account],
+        )
+        resources = list(found.values())
+        tag(resources, account=account, type=resource_type)
+        return resources, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(tasks))) as pool:
+        results = list(pool.map(check, tasks))
+
+    timings = {account: {} for account in shards}
+    for (account, resource_type), (_, seconds) in zip(tasks, results):
+        timings[account][resource_type] = seconds
+    return merge_ranked((resources for resources, _ in results), top), timings
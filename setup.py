@@ -9,7 +9,7 @@ setup(
     long_description=open("README.md").read(),
     long_description_content_type="text/markdown",
     url="https://github.com/nuclear-treestump/cloud_scanner",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
     entry_points={
         "console_scripts": ["cloudscanner=cloud_scanner.__main__:main"],
     },
@@ -0,0 +1,84 @@
+import json
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The modules import each other by their flat names (see cloud_scanner/__init__.py).
+sys.path.insert(0, os.path.join(REPO_ROOT, "cloud_scanner"))
+sys.path.insert(1, REPO_ROOT)
+
+import database_ops as db  # noqa: E402
+from findings import setup_findings  # noqa: E402
+from result_cache import results  # noqa: E402
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """
+    Run the test in an empty directory with a fresh data.db.
+    """
+    monkeypatch.chdir(tmp_path)
+    results.clear()
+    db.setup_database()
+    setup_findings()
+    yield tmp_path
+    db.close_pools()
+    results.clear()
+
+
+def ec2(group_id, cidr="10.0.0.0/8", port=22, public_ip=None):
+    return {
+        "GroupId": group_id,
+        "GroupName": group_id,
+        "IpPermissions": [
+            {
+                "IpProtocol": "tcp",
+                "FromPort": port,
+                "ToPort": port,
+                "IpRanges": [{"CidrIp": cidr}],
+            }
+        ],
+        "Description": "",
+        "PublicIp": public_ip,
+        "PrivateIp": "10.0.0.1",
+    }
+
+
+def s3(name, public=False, encrypted=True, logging=True):
+    return {
+        "Name": name,
+        "CreationDate": "2024-01-01T00:00:00",
+        "PublicAccess": public,
+        "Encrypted": encrypted,
+        "LoggingEnabled": logging,
+    }
+
+
+def rds(name, public=False, encrypted=True, port=3306):
+    return {
+        "DBInstanceIdentifier": name,
+        "DBInstanceClass": "db.t3.micro",
+        "Engine": "mysql",
+        "PubliclyAccessible": public,
+        "StorageEncrypted": encrypted,
+        "DBPortNumber": port,
+        "PublicIp": None,
+        "PrivateIp": "10.0.0.2",
+    }
+
+
+def inventory(ec2_items=(), s3_items=(), rds_items=()):
+    return {
+        "EC2Instances": list(ec2_items),
+        "S3Buckets": list(s3_items),
+        "RDSInstances": list(rds_items),
+    }
+
+
+def write_inventory(path, document):
+    with open(path, "w") as fp:
+        json.dump(document, fp)
+    return str(path)
@@ -0,0 +1,139 @@
+import io
+import json
+
+import pytest
+
+import ingest
+from conftest import inventory, s3
+
+
+@pytest.fixture
+def client(workdir):
+    from app import app
+
+    return app.test_client()
+
+
+def load(document):
+    ingest.stream_ingest(io.BytesIO(json.dumps(document).encode()))
+
+
+@pytest.mark.parametrize("cursor", [123, ["a"], {"score": 1}, True])
+def test_non_string_cursor_is_rejected(client, cursor):
+    response = client.post("/api/resources", json={"type": "s3", "cursor": cursor})
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "cursor must be a string"}
+
+
+@pytest.mark.parametrize("violation", [["x"], {"a": 1}, 1, True])
+@pytest.mark.parametrize(
+    "query", [{"type": "s3"}, {"type": "all"}, {"type": ["s3"], "account": "*"}]
+)
+def test_non_string_violation_is_rejected(client, query, violation):
+    response = client.post("/api/resources", json={**query, "violation": violation})
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "violation must be a string"}
+
+
+@pytest.mark.parametrize("cursor", ["garbage", "WzEsICJ4Il0=", "MTIz"])
+def test_invalid_cursor_is_rejected(client, cursor):
+    response = client.post("/api/resources", json={"type": "s3", "cursor": cursor})
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "Invalid cursor"}
+
+
+def test_body_must_be_an_object(client):
+    response = client.post("/api/resources", json=["s3"])
+    assert response.status_code == 400
+
+
+def test_pages_cover_every_resource_once(client):
+    # Scores 1, 2 and 3 with many ties, so pages split runs of equal scores.
+    load(
+        inventory(
+            s3_items=[
+                s3(
+                    f"b-{i}",
+                    public=i % 2 == 0,
+                    encrypted=i % 3 != 0,
+                    logging=i % 5 != 0,
+                )
+                for i in range(40)
+            ]
+        )
+    )
+    everything = client.post("/api/resources", json={"type": "s3"}).get_json()
+    expected = sorted(
+        ((r["RiskScore"], r["id"]) for r in everything.values()),
+        key=lambda item: (-item[0], item[1]),
+    )
+
+    seen, cursor = [], None
+    while True:
+        body = {"type": "s3", "limit": 7}
+        if cursor is not None:
+            body["cursor"] = cursor
+        page = client.post("/api/resources", json=body).get_json()
+        seen.extend((r["RiskScore"], r["id"]) for r in page["resources"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+
+    assert seen == expected
+
+
+def test_conditional_requests(client):
+    load(inventory(s3_items=[s3("a", public=True)]))
+    query = {"type": "s3", "limit": 10}
+
+    first = client.post("/api/resources", json=query)
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+    assert etag.startswith('W/"')
+    assert "Accept-Encoding" in first.headers["Vary"]
+
+    again = client.post("/api/resources", json=query, headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.data == b""
+    assert again.headers["ETag"] == etag
+
+    # Other parameters are another resource.
+    other = client.post(
+        "/api/resources", json={**query, "limit": 5}, headers={"If-None-Match": etag}
+    )
+    assert other.status_code == 200 and other.headers["ETag"] != etag
+
+    load(inventory(s3_items=[s3("a", public=True), s3("b", public=True)]))
+    changed = client.post("/api/resources", json=query, headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert [r["name"] for r in changed.get_json()["resources"]] == ["a", "b"]
+
+
+def test_gzip_responses(client):
+    import gzip
+
+    import http_cache
+
+    load(inventory(s3_items=[s3(f"b-{i}", public=True) for i in range(30)]))
+    query = {"type": "s3", "limit": 50}
+    plain = client.post("/api/resources", json=query)
+    assert "Content-Encoding" not in plain.headers
+    assert len(plain.data) >= http_cache.GZIP_MIN_SIZE
+
+    for _ in range(2):
+        compressed = client.post(
+            "/api/resources", json=query, headers={"Accept-Encoding": "gzip"}
+        )
+        assert compressed.headers["Content-Encoding"] == "gzip"
+        assert compressed.headers["Vary"] == "Accept-Encoding"
+        assert compressed.headers["ETag"] == plain.headers["ETag"]
+        assert gzip.decompress(compressed.data) == plain.data
+
+    small = client.post(
+        "/api/resources",
+        json={"type": "s3", "limit": 1},
+        headers={"Accept-Encoding": "gzip"},
+    )
+    assert len(small.data) < http_cache.GZIP_MIN_SIZE
+    assert "Content-Encoding" not in small.headers
@@ -0,0 +1,93 @@
+import io
+import json
+import sqlite3
+
+import pytest
+
+import database_ops as db
+import ingest
+from changes import HistoryUnavailable, findings_diff, scan_history
+from conftest import inventory, s3
+
+
+@pytest.fixture
+def client(workdir):
+    from app import app
+
+    return app.test_client()
+
+
+def load(*buckets):
+    ingest.stream_ingest(io.BytesIO(json.dumps(inventory(s3_items=buckets)).encode()))
+    return db.data_generation()
+
+
+def names(resources):
+    return [(resource["name"], resource["Violations"]) for resource in resources]
+
+
+def test_diff_reports_added_resolved_and_changed(workdir):
+    since = load(s3("open", public=True), s3("plain"), s3("quiet", logging=False))
+    load(
+        s3("open"),
+        s3("plain", encrypted=False),
+        s3("quiet", public=True, logging=False),
+    )
+
+    diff = findings_diff(since, ["s3"])
+    assert diff["generation"] == db.data_generation()
+    assert names(diff["added"]) == [("plain", ["EncryptionDisabled"])]
+    assert names(diff["resolved"]) == [("open", [])]
+    assert diff["resolved"][0]["Previous"]["Violations"] == ["PublicAccessEnabled"]
+    assert names(diff["changed"]) == [
+        ("quiet", ["PublicAccessEnabled", "LoggingDisabled"])
+    ]
+    assert diff["changed"][0]["Previous"]["Violations"] == ["LoggingDisabled"]
+
+    assert findings_diff(diff["generation"], ["s3"])["changed"] == []
+
+
+def test_reloading_the_same_data_changes_nothing(workdir):
+    since = load(s3("open", public=True))
+    load(s3("open", public=True))
+    diff = findings_diff(since, ["s3"])
+    assert diff["added"] == diff["resolved"] == diff["changed"] == []
+
+
+def test_log_keeps_the_last_scans(workdir, monkeypatch):
+    monkeypatch.setattr(db, "CHANGE_LOG_SCANS", 2)
+    first = load(s3("a", public=True))
+    second = load(s3("a"))
+    third = load(s3("a", encrypted=False))
+
+    history = scan_history()
+    assert history["change_log_start"] == first
+    assert [scan["generation"] for scan in history["scans"]] == [third, second]
+    with pytest.raises(HistoryUnavailable):
+        findings_diff(first - 1, ["s3"])
+    assert names(findings_diff(first, ["s3"])["changed"]) == [
+        ("a", ["EncryptionDisabled"])
+    ]
+
+    conn = sqlite3.connect("data.db")
+    oldest = conn.execute("SELECT MIN(generation) FROM finding_changes").fetchone()[0]
+    assert oldest > first
+    assert conn.execute("SELECT COUNT(*) FROM scans").fetchone() == (2,)
+    conn.close()
+
+
+def test_diff_api(client):
+    since = load(s3("a"))
+    load(s3("a", public=True))
+
+    response = client.get(f"/api/diff?since={since}&type=s3")
+    assert response.status_code == 200
+    assert names(response.get_json()["added"]) == [("a", ["PublicAccessEnabled"])]
+
+    start = client.get("/api/scans").get_json()["change_log_start"]
+    response = client.get(f"/api/diff?since={start - 1}")
+    assert response.status_code == 410
+    assert "not recorded" in response.get_json()["error"]
+
+    assert client.get("/api/diff?since=x").status_code == 400
+    assert client.get("/api/diff?since=999999").status_code == 400
@@ -0,0 +1,45 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(*args, cwd):
+    return subprocess.run(
+        [sys.executable, "-m", "cloud_scanner", *args],
+        cwd=cwd,
+        env={**os.environ, "PYTHONPATH": ROOT},
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+
+
+@pytest.mark.parametrize(
+    "document, message",
+    [
+        ({"S3Buckets": [1]}, "S3Buckets[0]: entry must be an object, not int"),
+        (
+            {"S3Buckets": [{"Name": "x"}]},
+            "S3Buckets[0]: entry is missing 'CreationDate'",
+        ),
+        (
+            {"EC2Instances": [{"GroupId": "sg", "IpPermissions": [1]}]},
+            "EC2Instances[0]: entry is missing 'GroupName'",
+        ),
+    ],
+)
+@pytest.mark.parametrize("command", [["scan"], ["-f"]])
+def test_badly_shaped_input_exits_with_a_message(tmp_path, command, document, message):
+    path = tmp_path / "input.json"
+    path.write_text(json.dumps(document))
+
+    result = run(*command, str(path), cwd=tmp_path)
+
+    assert result.returncode == 1
+    assert message in result.stdout + result.stderr
+    assert "Traceback" not in result.stderr
@@ -0,0 +1,222 @@
+import datetime
+import json
+import sqlite3
+import threading
+
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+from botocore.stub import Stubber  # noqa: E402
+
+import collector  # noqa: E402
+import database_ops as db  # noqa: E402
+
+
+def stubbed(service):
+    client = boto3.session.Session(
+        aws_access_key_id="test",
+        aws_secret_access_key="test",
+        region_name="us-east-1",
+    ).client(service)
+    stubber = Stubber(client)
+    return client, stubber
+
+
+def test_collect_with_stubbed_clients(workdir):
+    ec2, ec2_stub = stubbed("ec2")
+    ec2_stub.add_response(
+        "describe_instances",
+        {
+            "Reservations": [
+                {
+                    "Instances": [
+                        {
+                            "PublicIpAddress": "1.2.3.4",
+                            "PrivateIpAddress": "10.0.0.1",
+                            "SecurityGroups": [{"GroupId": "sg-1"}],
+                        }
+                    ]
+                }
+            ]
+        },
+        {"MaxResults": 1000},
+    )
+    ec2_stub.add_response(
+        "describe_security_groups",
+        {
+            "SecurityGroups": [
+                {
+                    "GroupId": "sg-1",
+                    "GroupName": "web",
+                    "Description": "",
+                    "IpPermissions": [
+                        {
+                            "IpProtocol": "tcp",
+                            "FromPort": 22,
+                            "ToPort": 22,
+                            "IpRanges": [{"CidrIp": "0.0.0.0/0"}],
+                        }
+                    ],
+                }
+            ]
+        },
+        {"MaxResults": 1000},
+    )
+
+    s3, s3_stub = stubbed("s3")
+    created = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    s3_stub.add_response(
+        "list_buckets", {"Buckets": [{"Name": "logs", "CreationDate": created}]}, {}
+    )
+    s3_stub.add_client_error(
+        "get_public_access_block",
+        "NoSuchPublicAccessBlockConfiguration",
+        expected_params={"Bucket": "logs"},
+    )
+    s3_stub.add_client_error(
+        "get_bucket_encryption",
+        "ServerSideEncryptionConfigurationNotFoundError",
+        expected_params={"Bucket": "logs"},
+    )
+    s3_stub.add_response("get_bucket_logging", {}, {"Bucket": "logs"})
+
+    rds, rds_stub = stubbed("rds")
+    rds_stub.add_response(
+        "describe_db_instances",
+        {
+            "DBInstances": [
+                {
+                    "DBInstanceIdentifier": "db-1",
+                    "DBInstanceClass": "db.t3.micro",
+                    "Engine": "mysql",
+                    "PubliclyAccessible": True,
+                    "StorageEncrypted": False,
+                    "Endpoint": {"Address": "db-1.example", "Port": 3306},
+                }
+            ]
+        },
+        {"MaxRecords": 100},
+    )
+
+    clients = {"ec2": ec2, "s3": s3, "rds": rds}
+    with ec2_stub, s3_stub, rds_stub:
+        stats = collector.collect(
+            client_factory=lambda service, region, account: clients[service]
+        )
+        ec2_stub.assert_no_pending_responses()
+        s3_stub.assert_no_pending_responses()
+        rds_stub.assert_no_pending_responses()
+
+    assert stats["errors"] == []
+    assert (stats["ec2"], stats["s3"], stats["rds"]) == (1, 1, 1)
+    conn = sqlite3.connect("data.db")
+    assert conn.execute(
+        "SELECT group_id, public_ip, private_ip FROM ec2instances"
+    ).fetchall() == [("sg-1", "1.2.3.4", "10.0.0.1")]
+    assert conn.execute(
+        "SELECT name, creation_date, public_access, encryption, logging_enabled "
+        "FROM s3buckets"
+    ).fetchall() == [("logs", "2024-01-01T00:00:00+00:00", 1, 0, 0)]
+    assert conn.execute(
+        "SELECT db_name, public_access, encryption, db_portnumber, private_ip "
+        "FROM rdsinstances"
+    ).fetchall() == [("db-1", 1, 0, 3306, "db-1.example")]
+    conn.close()
+
+
+def record(workdir, document):
+    path = workdir / "recorded.json"
+    path.write_text(json.dumps(document))
+    return collector.recorded_client_factory(str(path))
+
+
+def bucket_pages(count):
+    return {
+        "s3": {
+            "list_buckets": [
+                {"Buckets": [{"Name": f"b-{i}", "CreationDate": "2024"}]}
+                for i in range(count)
+            ],
+            "get_public_access_block": {
+                "PublicAccessBlockConfiguration": {"BlockPublicAcls": True}
+            },
+            "get_bucket_encryption": {},
+            "get_bucket_logging": {},
+        }
+    }
+
+
+def test_failed_insert_does_not_hang(workdir, monkeypatch):
+    # Many more pages than the queue holds, so tasks block handing them over.
+    factory = record(workdir, bucket_pages(50))
+
+    def fail(data, conn):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    monkeypatch.setitem(collector.INSERTERS, "s3", fail)
+    outcome = []
+
+    def run():
+        try:
+            collector.collect(client_factory=factory, max_workers=2)
+        except sqlite3.OperationalError as e:
+            outcome.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive(), "collect() hung after a failed insert"
+    assert len(outcome) == 1
+
+
+def test_bucket_lookups_share_the_pool(workdir, monkeypatch):
+    document = bucket_pages(1)
+    document["s3"]["list_buckets"] = [
+        {
+            "Buckets": [
+                {"Name": f"b-{i}", "CreationDate": "2024"}
+                for i in range(collector.BUCKET_CHUNK * 3)
+            ]
+        }
+    ]
+    factory = record(workdir, document)
+    bucket_record = collector._bucket_record
+    threads = set()
+
+    def tracked(client, bucket):
+        threads.add(threading.current_thread().name)
+        return bucket_record(client, bucket)
+
+    monkeypatch.setattr(collector, "_bucket_record", tracked)
+    stats = collector.collect(client_factory=factory, max_workers=2)
+
+    assert stats["s3"] == collector.BUCKET_CHUNK * 3
+    assert stats["errors"] == []
+    assert 1 <= len(threads) <= 2
+
+
+def test_collection_is_recorded_as_a_scan(workdir, monkeypatch):
+    import io
+
+    import ingest
+    from changes import change_log_start
+    from conftest import inventory, s3
+
+    monkeypatch.setattr(db, "CHANGE_LOG_SCANS", 1)
+    ingest.stream_ingest(
+        io.BytesIO(json.dumps(inventory(s3_items=[s3("old", public=True)])).encode())
+    )
+    before = db.data_generation()
+
+    # Both buckets are flagged PublicAccessEnabled and LoggingDisabled.
+    collector.collect(client_factory=record(workdir, bucket_pages(2)))
+
+    conn = sqlite3.connect("data.db")
+    scans = conn.execute(
+        "SELECT previous_generation, generation, finding_changes FROM scans"
+    ).fetchall()
+    assert scans == [(before, db.data_generation(), 4)]
+    assert change_log_start(conn) == before
+    oldest = conn.execute("SELECT MIN(generation) FROM finding_changes").fetchone()
+    assert oldest[0] > before
+    conn.close()
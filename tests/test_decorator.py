@@ -0,0 +1,61 @@
+import logging
+
+import pytest
+
+import metrics
+from decorator import autolog
+
+
+@pytest.fixture
+def recorded(monkeypatch):
+    monkeypatch.setattr(metrics, "enabled", True)
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def test_autolog_is_one_wrapper():
+    def func(x):
+        return x + 1
+
+    wrapped = autolog("test")(func)
+    assert wrapped.__wrapped__ is func
+    assert wrapped(1) == 2
+
+
+def test_autolog_records_calls_and_errors(recorded):
+    @autolog("test")
+    def fail():
+        raise KeyError("x")
+
+    with pytest.raises(KeyError):
+        fail()
+    name = f"{fail.__module__}.{fail.__qualname__}"
+    assert metrics._functions[name][:2] == [1, 1]
+
+
+def test_autolog_logs_entry_and_exit(recorded, caplog):
+    @autolog("test.autolog")
+    def func():
+        return "ok"
+
+    with caplog.at_level(logging.INFO, logger="test.autolog"):
+        assert func() == "ok"
+    assert [record.getMessage().split(",")[0] for record in caplog.records] == [
+        "Entering func",
+        "Exiting func",
+    ]
+
+
+def test_disabled_autolog_records_nothing(monkeypatch):
+    monkeypatch.setattr(metrics, "enabled", False)
+    metrics.reset()
+    calls = []
+
+    @autolog("test.disabled")
+    def func():
+        calls.append(1)
+
+    func()
+    assert calls == [1]
+    assert metrics._functions == {}
@@ -0,0 +1,187 @@
+import io
+import json
+import sqlite3
+
+import pytest
+
+import database_ops as db
+import ingest
+from conftest import ec2, inventory, rds, s3, write_inventory
+from findings import findings_check
+
+
+def stream(document, **kwargs):
+    return ingest.stream_ingest(io.BytesIO(json.dumps(document).encode()), **kwargs)
+
+
+def violations(resource_type):
+    return {
+        finding.to_dict()["group_id"]: finding.violations
+        for finding in findings_check(resource_type).values()
+    }
+
+
+@pytest.mark.parametrize("bulk", [False, True])
+def test_duplicate_group_keeps_permissions_of_last_copy(workdir, bulk):
+    document = inventory(
+        [
+            ec2("sg-1", cidr="0.0.0.0/0", port=22),
+            ec2("sg-2", cidr="0.0.0.0/0", port=22),
+            ec2("sg-1", cidr="192.168.0.0/24", port=22),
+        ]
+    )
+    stream(document, bulk=bulk)
+
+    conn = sqlite3.connect("data.db")
+    permissions = conn.execute(
+        "SELECT group_id, prefix_len FROM ec2permissions ORDER BY group_id"
+    ).fetchall()
+    assert permissions == [("sg-1", 24), ("sg-2", 0)]
+    assert violations("ec2") == {"sg-2": ["InsecureCIDRRange"]}
+
+
+def test_duplicate_group_in_bulk_files(workdir):
+    path = write_inventory(
+        workdir / "a.json",
+        inventory(
+            [
+                ec2("sg-1", cidr="0.0.0.0/0", port=22),
+                ec2("sg-1", cidr="192.168.0.0/24", port=22),
+            ]
+        ),
+    )
+    stats = ingest.bulk_ingest([path], workers=1, progress=None)
+
+    assert stats["EC2Instances"] == 2
+    assert violations("ec2") == {}
+
+
+def bulk_files(workdir):
+    good = write_inventory(workdir / "a.json", inventory([ec2("sg-1")]))
+    bad = workdir / "b.json"
+    bad.write_text('{"EC2Instances": [')
+    return [good, str(bad)]
+
+
+def test_bulk_ingest_rolls_back_on_a_bad_file(workdir):
+    with pytest.raises(ingest.BulkLoadError) as raised:
+        ingest.bulk_ingest(bulk_files(workdir), workers=1, progress=None)
+
+    assert list(raised.value.errors) == [str(workdir / "b.json")]
+    conn = sqlite3.connect("data.db")
+    assert conn.execute("SELECT COUNT(*) FROM ec2instances").fetchone() == (0,)
+    assert conn.execute("SELECT COUNT(*) FROM scans").fetchone() == (0,)
+    conn.close()
+
+
+def test_bulk_ingest_partial(workdir):
+    stats = ingest.bulk_ingest(
+        bulk_files(workdir), workers=1, progress=None, partial=True
+    )
+
+    assert stats["EC2Instances"] == 1
+    assert list(stats["errors"]) == [str(workdir / "b.json")]
+    conn = sqlite3.connect("data.db")
+    assert conn.execute("SELECT group_id FROM ec2instances").fetchall() == [("sg-1",)]
+    conn.close()
+
+
+class CountingReader(io.BytesIO):
+    def __init__(self, data):
+        super().__init__(data)
+        self.consumed = 0
+
+    def read(self, size=-1):
+        chunk = super().read(size)
+        self.consumed += len(chunk)
+        return chunk
+
+
+def test_malformed_element_fails_without_reading_on(workdir):
+    good = json.dumps(ec2("sg-ok"))
+    data = (
+        ('{"EC2Instances": [' + good + ', {"GroupId": "sg-bad",, "x": 1}, ')
+        + ", ".join([good] * 50000)
+        + "]}"
+    )
+    fp = CountingReader(data.encode())
+    offset = data.index('{"GroupId": "sg-bad"')
+
+    with pytest.raises(ValueError, match=f"Malformed JSON value at offset {offset}"):
+        list(ingest.iter_resources(fp))
+    assert len(data) > 10_000_000
+    assert fp.consumed <= 2 * ingest.READ_SIZE
+
+
+@pytest.mark.parametrize(
+    "value",
+    [12.5e-3, -7, True, False, None, "téxt ☃", {"a": [1, {"b": "\\"}]}],
+)
+def test_values_split_across_reads(value):
+    data = json.dumps({"S3Buckets": [value, value]}, ensure_ascii=False)
+    for encoded in (data.encode(), json.dumps({"S3Buckets": [value] * 2}).encode()):
+        items = list(ingest.iter_resources(io.BytesIO(encoded), read_size=1))
+        assert items == [("S3Buckets", value), ("S3Buckets", value)]
+
+
+def test_truncated_input_is_reported():
+    with pytest.raises(
+        ValueError, match="Input ends inside the JSON value at offset 15"
+    ):
+        list(ingest.iter_resources(io.BytesIO(b'{"S3Buckets": [{"Name": "a"')))
+
+
+@pytest.mark.parametrize(
+    "element, message",
+    [
+        ("x", "S3Buckets[2]: entry must be an object, not str"),
+        ({"Name": "x"}, "S3Buckets[2]: entry is missing 'CreationDate'"),
+    ],
+)
+def test_badly_shaped_element_is_named(workdir, element, message):
+    document = {"S3Buckets": [s3("a"), s3("b"), element]}
+    with pytest.raises(ValueError) as raised:
+        stream(document, chunk_size=2)
+    assert str(raised.value) == message
+    conn = sqlite3.connect("data.db")
+    assert conn.execute("SELECT COUNT(*) FROM s3buckets").fetchone() == (0,)
+    conn.close()
+
+
+def test_malformed_permissions_fail_in_bulk_files(workdir):
+    path = workdir / "bad.json"
+    document = inventory([ec2("sg-1")])
+    document["EC2Instances"][0]["IpPermissions"] = ["tcp"]
+    path.write_text(json.dumps(document))
+    result = ingest.parse_file(str(path))
+    assert result["error"] == (
+        "ValueError: EC2Instances[0]: IpPermissions must be a list of objects"
+    )
+
+
+@pytest.mark.parametrize("bulk", [False, True])
+def test_reload_counts_unchanged_and_updated_rows(workdir, bulk):
+    document = inventory(
+        [ec2("sg-1"), ec2("sg-2")],
+        [s3("a"), s3("b")],
+        [rds("db-1")],
+    )
+    first = stream(document, bulk=bulk)
+    assert (first["inserted"], first["updated"], first["unchanged"]) == (5, 0, 0)
+    generation = db.data_generation()
+    conn = sqlite3.connect("data.db")
+    ids = conn.execute("SELECT id, name FROM s3buckets ORDER BY id").fetchall()
+
+    again = stream(document, bulk=bulk)
+    assert (again["inserted"], again["updated"], again["unchanged"]) == (0, 0, 5)
+    assert db.data_generation() == generation
+
+    document["S3Buckets"][1]["Encrypted"] = False
+    changed = stream(document, bulk=bulk)
+    assert (changed["inserted"], changed["updated"], changed["unchanged"]) == (0, 1, 4)
+    assert db.data_generation() > generation
+    assert conn.execute("SELECT id, name FROM s3buckets ORDER BY id").fetchall() == ids
+    assert conn.execute(
+        "SELECT encryption FROM s3buckets WHERE name = 'b'"
+    ).fetchone() == (0,)
+    conn.close()
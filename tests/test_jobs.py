@@ -0,0 +1,135 @@
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import database_ops as db
+import jobs
+from conftest import inventory, s3
+
+
+def wait(job, statuses=("done", "failed"), timeout=10):
+    deadline = time.monotonic() + timeout
+    while job.status not in statuses:
+        assert time.monotonic() < deadline, f"job {job.id} is still {job.status}"
+        time.sleep(0.01)
+    return job
+
+
+@pytest.fixture
+def queue(workdir, monkeypatch):
+    monkeypatch.setattr(db, "SHARD_DIR", str(workdir / "shards"))
+    return jobs.JobQueue(spool_dir=str(workdir / "spool"), maxsize=1)
+
+
+def upload(name):
+    return io.BytesIO(json.dumps(inventory(s3_items=[s3(name)])).encode())
+
+
+def test_shards_load_in_parallel(queue, monkeypatch):
+    release = threading.Event()
+    ingest_account = jobs.ingest_account
+
+    def blocking(fp, account, **kwargs):
+        if account == "slow":
+            release.wait(10)
+        return ingest_account(fp, account, **kwargs)
+
+    monkeypatch.setattr(jobs, "ingest_account", blocking)
+    slow = wait(queue.submit(upload("slow"), "slow"), ("running",))
+    # The slow shard's worker is busy and its queue holds one more job.
+    queue.submit(upload("slow-2"), "slow")
+    with pytest.raises(jobs.QueueFull):
+        queue.submit(upload("slow-3"), "slow")
+
+    fast = queue.submit(upload("fast"), "fast")
+    default = queue.submit(upload("default"))
+    assert wait(fast).status == "done"
+    assert wait(default).status == "done"
+    assert slow.status == "running"
+
+    release.set()
+    assert wait(slow).status == "done"
+    conn = sqlite3.connect(db.shard_path("fast"))
+    assert conn.execute("SELECT name FROM s3buckets").fetchall() == [("fast",)]
+    conn.close()
+
+
+def test_idle_workers_exit(queue, monkeypatch):
+    monkeypatch.setattr(jobs, "IDLE_TIMEOUT", 0.05)
+    job = queue.submit(upload("a"), "acct")
+    wait(job)
+    deadline = time.monotonic() + 2
+    while queue._workers and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert queue._workers == {} and queue._queues == {}
+
+    assert wait(queue.submit(upload("b"), "acct")).status == "done"
+
+
+def test_collect_writes_to_the_account_shard(workdir, monkeypatch):
+    from cloud_scanner.__main__ import collect_resources
+    from shards import prepare_shard
+
+    monkeypatch.setattr(db, "SHARD_DIR", str(workdir / "shards"))
+    recording = workdir / "recorded.json"
+    recording.write_text(
+        json.dumps(
+            {
+                "rds": {
+                    "describe_db_instances": [
+                        {"DBInstances": [{"DBInstanceIdentifier": "db-1"}]}
+                    ]
+                }
+            }
+        )
+    )
+    path = prepare_shard("acct")
+    collect_resources(["us-east-1"], [None], str(recording), 1, path)
+
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT db_name FROM rdsinstances").fetchall() == [("db-1",)]
+    conn.close()
+    conn = sqlite3.connect("data.db")
+    assert conn.execute("SELECT COUNT(*) FROM rdsinstances").fetchone() == (0,)
+    conn.close()
+
+
+def test_global_limits(workdir, monkeypatch):
+    monkeypatch.setattr(db, "SHARD_DIR", str(workdir / "shards"))
+    queue = jobs.JobQueue(
+        spool_dir=str(workdir / "spool"), maxsize=8, max_pending=2, max_workers=2
+    )
+    release = threading.Event()
+    ingest_account = jobs.ingest_account
+
+    def blocking(fp, account, **kwargs):
+        release.wait(10)
+        return ingest_account(fp, account, **kwargs)
+
+    monkeypatch.setattr(jobs, "ingest_account", blocking)
+    running = [wait(queue.submit(upload(a), a), ("running",)) for a in ("a", "b")]
+    # Both workers are busy: a third account gets no thread.
+    with pytest.raises(jobs.QueueFull):
+        queue.submit(upload("c"), "c")
+    queued = [queue.submit(upload("a"), "a"), queue.submit(upload("b"), "b")]
+    # The shard queues have room, but two jobs are waiting in total.
+    with pytest.raises(jobs.QueueFull):
+        queue.submit(upload("a"), "a")
+    assert len(queue._workers) == 2
+    assert len(os.listdir(workdir / "spool")) == 4
+
+    release.set()
+    for job in running + queued:
+        assert wait(job).status == "done"
+    deadline = time.monotonic() + 2
+    while any(q.unfinished_tasks for q in queue._queues.values()):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    # The idle worker of a or b makes way for c's.
+    assert wait(queue.submit(upload("c"), "c")).status == "done"
+    assert len(queue._workers) <= 2
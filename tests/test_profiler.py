@@ -0,0 +1,111 @@
+import pstats
+
+import pytest
+
+import profiler
+
+TOKEN = "secret"
+
+
+@pytest.fixture
+def client(workdir, monkeypatch):
+    from app import app
+
+    monkeypatch.setattr(profiler, "ADMIN_TOKEN", TOKEN)
+    monkeypatch.setattr(profiler, "store", profiler.ProfileStore())
+    monkeypatch.setattr(profiler, "enabled", False)
+    monkeypatch.setattr(profiler, "mode", "sample")
+    return app.test_client()
+
+
+def admin(token=TOKEN):
+    return {"X-Admin-Token": token}
+
+
+@pytest.mark.parametrize(
+    "path", ["/admin/profiling", "/admin/profiles", "/admin/profiles/x"]
+)
+@pytest.mark.parametrize("headers", [{}, admin("wrong"), admin("")])
+def test_admin_endpoints_need_the_token(client, path, headers):
+    response = client.get(path, headers=headers)
+    assert response.status_code == 403
+    assert response.get_json() == {"error": "Invalid admin token"}
+
+
+def test_admin_endpoints_are_off_without_a_token(client, monkeypatch):
+    monkeypatch.setattr(profiler, "ADMIN_TOKEN", None)
+    assert client.get("/admin/profiles", headers=admin()).status_code == 404
+
+
+@pytest.mark.parametrize("headers", [{}, admin("wrong")])
+def test_profile_header_needs_the_token(client, headers):
+    response = client.get("/api/cache", headers={"X-Profile": "sample", **headers})
+    assert response.status_code == 200
+    assert "X-Profile-Id" not in response.headers
+    assert client.get("/admin/profiles", headers=admin()).get_json() == []
+
+
+def test_profiled_request(client):
+    response = client.get("/api/cache", headers={"X-Profile": "sample", **admin()})
+    profile_id = response.headers["X-Profile-Id"]
+
+    listed = client.get("/admin/profiles", headers=admin()).get_json()
+    assert [(p["id"], p["label"], p["mode"]) for p in listed] == [
+        (profile_id, "GET /api/cache", "sample")
+    ]
+    collapsed = client.get(f"/admin/profiles/{profile_id}", headers=admin())
+    assert collapsed.status_code == 200
+    assert collapsed.mimetype == "text/plain"
+    pstats_response = client.get(
+        f"/admin/profiles/{profile_id}?format=pstats", headers=admin()
+    )
+    assert pstats_response.status_code == 400
+    assert client.get("/admin/profiles/nope", headers=admin()).status_code == 404
+
+
+def test_cprofile_request(client, workdir):
+    response = client.get("/api/cache", headers={"X-Profile": "cprofile", **admin()})
+    profile_id = response.headers["X-Profile-Id"]
+
+    dump = client.get(f"/admin/profiles/{profile_id}?format=pstats", headers=admin())
+    assert dump.status_code == 200
+    assert dump.headers["Content-Disposition"].endswith(f"{profile_id}.pstats")
+    path = workdir / "dump.pstats"
+    path.write_bytes(dump.data)
+    assert pstats.Stats(str(path)).total_calls > 0
+    assert (
+        client.get(f"/admin/profiles/{profile_id}", headers=admin()).status_code == 400
+    )
+
+
+@pytest.mark.parametrize("body", [None, ["enabled"], "on", 1])
+def test_profiling_settings_need_an_object(client, body):
+    if body is None:
+        response = client.post(
+            "/admin/profiling", data="", headers=admin(), content_type="text/plain"
+        )
+    else:
+        response = client.post("/admin/profiling", json=body, headers=admin())
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "Request body must be a JSON object"}
+
+
+def test_profiling_settings(client):
+    assert client.get("/admin/profiling", headers=admin()).get_json() == {
+        "enabled": False,
+        "mode": "sample",
+    }
+    response = client.post(
+        "/admin/profiling", json={"enabled": True, "mode": "bogus"}, headers=admin()
+    )
+    assert response.status_code == 400
+
+    response = client.post(
+        "/admin/profiling", json={"enabled": True, "mode": "cprofile"}, headers=admin()
+    )
+    assert response.get_json() == {"enabled": True, "mode": "cprofile"}
+    # Every request is profiled, without a header or token.
+    assert "X-Profile-Id" in client.get("/api/cache").headers
+
+    client.post("/admin/profiling", json={"enabled": False}, headers=admin())
+    assert "X-Profile-Id" not in client.get("/api/cache").headers
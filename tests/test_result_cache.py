@@ -0,0 +1,57 @@
+import re
+
+from result_cache import ResultCache
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResultCache(maxsize=2)
+    computed = []
+
+    def compute(key):
+        return lambda: computed.append(key) or key.upper()
+
+    assert cache.get_or_compute("a", compute("a")) == "A"
+    assert cache.get_or_compute("b", compute("b")) == "B"
+    # A hit makes "a" the most recently used, so "b" goes first.
+    assert cache.get_or_compute("a", compute("a")) == "A"
+    assert cache.get_or_compute("c", compute("c")) == "C"
+    assert cache.get_or_compute("a", compute("a")) == "A"
+    assert cache.get_or_compute("b", compute("b")) == "B"
+
+    assert computed == ["a", "b", "c", "b"]
+    assert cache.stats() == {"hits": 2, "misses": 4, "size": 2, "maxsize": 2}
+
+
+def test_counters_after_a_miss_and_a_hit():
+    cache = ResultCache()
+    cache.get_or_compute("key", lambda: 1)
+    assert (cache.hits, cache.misses) == (0, 1)
+    cache.get_or_compute("key", lambda: 2)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    cache.clear()
+    assert cache.stats() == {"hits": 1, "misses": 1, "size": 0, "maxsize": 64}
+
+
+def cache_counters(client):
+    text = client.get("/metrics").get_data(as_text=True)
+    return {
+        name: float(value)
+        for name, value in re.findall(
+            r"^cloudscanner_result_cache_(\w+) (\S+)$", text, re.MULTILINE
+        )
+    }
+
+
+def test_counters_on_metrics(workdir):
+    from app import app
+
+    client = app.test_client()
+    before = cache_counters(client)
+    client.post("/api/resources", json={"type": "s3"})
+    client.post("/api/resources", json={"type": "s3"})
+    after = cache_counters(client)
+
+    assert after["misses_total"] - before["misses_total"] == 1
+    assert after["hits_total"] - before["hits_total"] == 1
+    assert after["entries"] == 1
@@ -0,0 +1,76 @@
+import sqlite3
+
+import pytest
+
+from rule_dsl import ExpressionError, compile_predicate, compile_sql, parse
+
+
+def test_parse_precedence():
+    assert parse("a = 1 OR b = 2 AND NOT c IS NULL") == (
+        "or",
+        ("compare", "=", ("field", "a"), ("value", 1)),
+        (
+            "and",
+            ("compare", "=", ("field", "b"), ("value", 2)),
+            ("not", ("is_null", ("field", "c"), False)),
+        ),
+    )
+
+
+def test_compile_sql_binds_literals():
+    assert compile_sql("name IN ('a', 'b') AND encryption <> 1", "s3buckets") == (
+        '("name" IN (?, ?)) AND ("encryption" != ?)',
+        ("a", "b", 1),
+    )
+
+
+def test_compile_predicate_inlines_literals():
+    assert compile_predicate("name = 'it''s ?' OR public_access", "s3buckets") == (
+        "(\"name\" = 'it''s ?') OR (\"public_access\" != 0)"
+    )
+
+
+def test_exists_permissions():
+    predicate = compile_predicate(
+        "EXISTS permissions (prefix_len <= 8 AND protocol = '-1')", "ec2instances"
+    )
+    assert predicate == (
+        "EXISTS (SELECT 1 FROM ec2permissions r "
+        "WHERE r.group_id = ec2instances.group_id "
+        'AND ((r."prefix_len" <= 8) AND (r."protocol" = \'-1\')))'
+    )
+
+
+@pytest.mark.parametrize(
+    "expression, table, message",
+    [
+        ("owner = 'x'", "s3buckets", "owner is not a column of s3buckets"),
+        ("EXISTS permissions (port = 1)", "ec2instances", "port is not a column"),
+        ("EXISTS permissions (prefix_len = 1)", "s3buckets", "has no relation"),
+        ("name = = 'a'", "s3buckets", "Expected a field or value"),
+        ("name = 'a", "s3buckets", "Unexpected character"),
+        ("(name = 'a'", "s3buckets", r"Expected \)"),
+        ("1", "s3buckets", "Expected a comparison"),
+        ("name = 'a'", "users", "Unknown table"),
+    ],
+)
+def test_invalid_expressions(expression, table, message):
+    with pytest.raises(ExpressionError, match=message):
+        compile_predicate(expression, table)
+
+
+def test_predicate_matches_sqlite_semantics():
+    conn = sqlite3.connect(":memory:")
+    conn.execute(
+        "CREATE TABLE s3buckets (id INTEGER PRIMARY KEY, name TEXT, "
+        "creation_date TEXT, public_access INT, encryption INT, logging_enabled INT)"
+    )
+    conn.executemany(
+        "INSERT INTO s3buckets (name, public_access, encryption) VALUES (?, ?, ?)",
+        [("a", 1, 0), ("b", 1, 1), ("c", None, 0), ("d", 0, None)],
+    )
+    predicate = compile_predicate(
+        "public_access = 1 AND NOT encryption = 1 OR encryption IS NULL", "s3buckets"
+    )
+    rows = conn.execute(f"SELECT name FROM s3buckets WHERE {predicate} ORDER BY id")
+    assert [row[0] for row in rows] == ["a", "d"]
@@ -0,0 +1,189 @@
+import io
+import json
+import sqlite3
+
+import pytest
+
+import database_ops as db
+import ingest
+import rule_engine
+import rule_runner
+from conftest import ec2, inventory, rds, s3
+from findings import findings_check
+
+
+def load(document, **kwargs):
+    ingest.stream_ingest(io.BytesIO(json.dumps(document).encode()), **kwargs)
+
+
+def add_rule(name, table, expression, risk_score=1, path="data.db"):
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute(
+            """
+            INSERT INTO rules (rule_name, resource_table, condition_field, condition_value, risk_score)
+            VALUES (?, ?, NULL, ?, ?)
+            """,
+            (name, table, expression, risk_score),
+        )
+    conn.close()
+
+
+def violations(resource_type, column, **kwargs):
+    return {
+        finding.to_dict()[column]: finding.violations
+        for finding in findings_check(resource_type, **kwargs).values()
+    }
+
+
+def test_added_rule_flags_resources(workdir):
+    load(inventory(rds_items=[rds("db-1", port=3306), rds("db-2", port=5432)]))
+    assert violations("rds", "db_name") == {}
+
+    add_rule("DefaultPort", "rdsinstances", "db_portnumber = 3306", risk_score=3)
+
+    assert violations("rds", "db_name") == {"db-1": ["DefaultPort"]}
+    for single_pass in (True, False):
+        found = rule_runner.rds_rule_check(single_pass=single_pass)
+        assert [f.to_dict()["db_name"] for f in found.values()] == ["db-1"]
+        assert [f.score for f in found.values()] == [3]
+
+    # Rows written after the rule was added go through the new triggers.
+    load(inventory(rds_items=[rds("db-3", port=3306)]))
+    assert set(violations("rds", "db_name")) == {"db-1", "db-3"}
+
+
+def test_added_rule_reaches_the_api(workdir):
+    from app import app
+
+    load(inventory(s3_items=[s3("a"), s3("b-logs")]))
+    client = app.test_client()
+    before = client.post("/api/resources", json={"type": "s3"}).get_json()
+    assert before == {}
+
+    add_rule("NamedLogs", "s3buckets", "name IN ('b-logs')")
+
+    after = client.post("/api/resources", json={"type": "s3"}).get_json()
+    assert [r["name"] for r in after.values()] == ["b-logs"]
+    assert next(iter(after.values()))["Violations"] == ["NamedLogs"]
+    response = client.post(
+        "/api/resources", json={"type": "s3", "violation": "NamedLogs", "limit": 10}
+    )
+    assert [r["name"] for r in response.get_json()["resources"]] == ["b-logs"]
+
+
+def test_deleted_rule_stops_flagging(workdir):
+    load(inventory([ec2("sg-1", cidr="10.1.0.0/16", public_ip="1.2.3.4")]))
+    assert violations("ec2", "group_id") == {"sg-1": ["PublicIPExposure"]}
+
+    conn = sqlite3.connect("data.db")
+    with conn:
+        conn.execute("DELETE FROM rules WHERE rule_name = 'PublicIPExposure'")
+    conn.close()
+
+    assert violations("ec2", "group_id") == {}
+    with pytest.raises(ValueError, match="Unknown violation"):
+        findings_check("ec2", violation="PublicIPExposure")
+
+
+def test_insecure_cidr_range_expression(workdir):
+    load(
+        inventory(
+            [
+                ec2("sg-open", cidr="0.0.0.0/0", port=3389),
+                ec2("sg-web", cidr="0.0.0.0/0", port=443),
+                ec2("sg-narrow", cidr="10.1.0.0/16", port=22),
+            ]
+        )
+    )
+    assert violations("ec2", "group_id") == {"sg-open": ["InsecureCIDRRange"]}
+
+
+def test_condition_field_rules_and_invalid_rules(workdir):
+    load(inventory(s3_items=[s3("a"), s3("b")]))
+    conn = sqlite3.connect("data.db")
+    with conn:
+        conn.executemany(
+            """
+            INSERT INTO rules (rule_name, resource_table, condition_field, condition_value)
+            VALUES (?, 's3buckets', ?, ?)
+            """,
+            [
+                ("NamedB", "name", "b"),
+                ("NotAColumn", "owner", "x"),
+                ("BadExpression", None, "name = = 'a'"),
+            ],
+        )
+    conn.close()
+
+    assert violations("s3", "name") == {"b": ["NamedB"]}
+    assert set(rule_engine.rulesets()["s3"]["rules"]) == {
+        "PublicAccessEnabled",
+        "EncryptionDisabled",
+        "LoggingDisabled",
+        "NamedB",
+    }
+
+
+def test_rulesets_are_per_database(workdir):
+    other = str(workdir / "other.db")
+    db.setup_database(db_path=other)
+    add_rule("Everything", "s3buckets", "id > 0", path=other)
+
+    assert "Everything" in rule_engine.rulesets(db_path=other)["s3"]["rules"]
+    assert "Everything" not in rule_engine.rulesets()["s3"]["rules"]
+
+
+def test_legacy_rules_are_migrated(workdir):
+    conn = sqlite3.connect("data.db")
+    with conn:
+        conn.execute("DELETE FROM rules")
+        conn.executemany(
+            """
+            INSERT INTO rules (rule_name, resource_table, condition_field, condition_value, risk_score)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            [
+                (name, table) + db.LEGACY_CONDITIONS[(name, table)] + (score,)
+                for name, table, _, _, score, _ in db.DEFAULT_RULES
+            ],
+        )
+        conn.execute(
+            "UPDATE rules SET risk_score = 4 WHERE rule_name = 'LoggingDisabled'"
+        )
+        version = db.MIGRATIONS.index(db._expression_rules)
+        conn.execute(f"PRAGMA user_version = {version}")
+    db.close_pools()
+
+    db.setup_database()
+
+    rows = conn.execute(
+        "SELECT rule_name, resource_table, condition_field, condition_value, risk_score "
+        "FROM rules ORDER BY id"
+    ).fetchall()
+    assert rows == [
+        (name, table, None, value, 4 if name == "LoggingDisabled" else score)
+        for name, table, _, value, score, _ in db.DEFAULT_RULES
+    ]
+    conn.close()
+
+
+def test_more_rules_than_mask_bits(workdir):
+    load(inventory(s3_items=[s3("a", public=True), s3("b")]))
+    count = rule_runner.MASK_BITS + 5
+    conn = sqlite3.connect("data.db")
+    with conn:
+        conn.executemany(
+            """
+            INSERT INTO rules (rule_name, resource_table, condition_field, condition_value)
+            VALUES (?, 's3buckets', NULL, ?)
+            """,
+            [(f"Rule{i}", f"name = 'a' AND id > {-i}") for i in range(count)],
+        )
+    conn.close()
+
+    expected = ["PublicAccessEnabled"] + [f"Rule{i}" for i in range(count)]
+    assert violations("s3", "name") == {"a": expected}
+    for single_pass in (True, False):
+        found = rule_runner.s3_rule_check(single_pass=single_pass)
+        assert [f.violations for f in found.values()] == [expected]
@@ -0,0 +1,16 @@
+import os
+import statistics
+
+from benchmarks import startup
+
+# Overridable for slow CI machines; the default is the documented budget.
+BUDGET = float(os.environ.get("CLOUDSCANNER_STARTUP_BUDGET", startup.DEFAULT_BUDGET))
+
+
+def test_scan_imports_no_heavy_modules():
+    assert startup.heavy_imports() == []
+
+
+def test_scan_startup_within_budget():
+    timings = startup.measure(runs=5)
+    assert statistics.median(timings) <= BUDGET, timings
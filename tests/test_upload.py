@@ -0,0 +1,101 @@
+import io
+import json
+import threading
+import time
+
+import pytest
+
+import jobs
+from conftest import inventory, s3
+
+
+@pytest.fixture
+def queue(workdir, monkeypatch):
+    import app
+
+    queue = jobs.JobQueue(spool_dir=str(workdir / "spool"), maxsize=1)
+    monkeypatch.setattr(app, "jobs", queue)
+    return queue
+
+
+@pytest.fixture
+def client(queue):
+    from app import app
+
+    return app.test_client()
+
+
+def upload(client, body, **form):
+    return client.post(
+        "/upload",
+        data={"file": (io.BytesIO(body), "inventory.json"), **form},
+        content_type="multipart/form-data",
+    )
+
+
+def finished(client, response, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        job = client.get(response.headers["Location"]).get_json()
+        if job["status"] in ("done", "failed"):
+            return job
+        assert time.monotonic() < deadline, job
+        time.sleep(0.01)
+
+
+def test_upload_is_accepted_and_loaded(client):
+    body = json.dumps(inventory(s3_items=[s3("a"), s3("b")])).encode()
+    response = upload(client, body)
+
+    assert response.status_code == 202
+    data = response.get_json()
+    assert data["status_url"] == f"/jobs/{data['job_id']}"
+    assert response.headers["Location"] == data["status_url"]
+    job = finished(client, response)
+    assert job["status"] == "done"
+    assert job["rows"] == 2 and job["stats"]["inserted"] == 2
+
+
+def test_full_queue_answers_429(client, queue, workdir, monkeypatch):
+    release = threading.Event()
+    ingest_account = jobs.ingest_account
+
+    def blocking(fp, account, **kwargs):
+        release.wait(10)
+        return ingest_account(fp, account, **kwargs)
+
+    monkeypatch.setattr(jobs, "ingest_account", blocking)
+    body = json.dumps(inventory(s3_items=[s3("a")])).encode()
+    running = upload(client, body)
+    deadline = time.monotonic() + 10
+    while queue.get(running.get_json()["job_id"]).status != "running":
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    queued = upload(client, body)
+    assert queued.status_code == 202
+
+    refused = upload(client, body)
+    assert refused.status_code == 429
+    assert refused.headers["Retry-After"] == "30"
+    # The refused upload was not spooled.
+    assert len(list((workdir / "spool").iterdir())) == 2
+
+    release.set()
+    assert finished(client, running)["status"] == "done"
+    assert finished(client, queued)["status"] == "done"
+
+
+def test_failed_job_removes_its_spool_file(client, queue, workdir):
+    response = upload(client, b'{"S3Buckets": [1]}')
+    assert response.status_code == 202
+
+    job = finished(client, response)
+    assert job["status"] == "failed"
+    assert job["error"] == (
+        "Invalid JSON input: S3Buckets[0]: entry must be an object, not int"
+    )
+    assert list((workdir / "spool").iterdir()) == []
+
+
+def test_unknown_job(client):
+    assert client.get("/jobs/nope").status_code == 404